@@ -0,0 +1,75 @@
+# Сборка альбомов (media_group_id) в чатах поддержки. Telegram присылает каждую часть альбома
+# отдельным апдейтом; части собираются в окне ALBUM_WINDOW (окно продлевается с каждой частью)
+# и передаются в flush одним списком, чтобы переслать их одним send_media_group
+import asyncio
+import logging
+import os
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", 1.0))
+# Больше 10 элементов в одном send_media_group Bot API не принимает
+ALBUM_MAX_PARTS = 10
+
+ALBUM_PARTS = metrics.histogram("tango_album_parts", "Parts per relayed album", buckets=(1, 2, 3, 5, 10))
+
+
+class PendingAlbum:
+    __slots__ = ("key", "messages", "context", "handle")
+
+    def __init__(self, key, context):
+        self.key = key
+        self.messages = []
+        self.context = context
+        self.handle = None
+
+
+class AlbumCollector:
+    # flush(messages, context) — корутина, получает части альбома в порядке message_id
+    def __init__(self, flush, window=ALBUM_WINDOW):
+        self.flush = flush
+        self.window = window
+        self._pending = {}
+        # Цикл событий держит только слабые ссылки на задачи, поэтому запущенные отправки хранятся здесь
+        self._tasks = set()
+        metrics.gauge("tango_albums_pending", "Albums being collected", (), lambda: len(self._pending))
+
+    def add(self, message, context):
+        key = (message.chat_id, message.media_group_id)
+        album = self._pending.get(key)
+        if album is None:
+            album = self._pending[key] = PendingAlbum(key, context)
+        album.messages.append(message)
+        if album.handle is not None:
+            album.handle.cancel()
+        loop = asyncio.get_running_loop()
+        if len(album.messages) >= ALBUM_MAX_PARTS:
+            album.handle = None
+            self._spawn(key)
+        else:
+            album.handle = loop.call_later(self.window, self._spawn, key)
+
+    def _spawn(self, key):
+        task = asyncio.get_running_loop().create_task(self._release(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _release(self, key):
+        album = self._pending.pop(key, None)
+        if album is None:
+            return
+        messages = sorted(album.messages, key=lambda message: message.message_id)
+        ALBUM_PARTS.observe(len(messages))
+        try:
+            await self.flush(messages, album.context)
+        except Exception as e:
+            logger.error(f"Failed to relay album {key[1]} from chat {key[0]}: {e}")
+
+    async def release_all(self):
+        # При остановке недособранные альбомы пересылаются сразу
+        for key, album in list(self._pending.items()):
+            if album.handle is not None:
+                album.handle.cancel()
+            await self._release(key)
@@ -0,0 +1,216 @@
+# Очередь назначения запросов поддержки. Новый запрос предлагается одному оператору — наименее
+# загруженному из свободных (загрузка = открытые чаты + неотвеченные предложения относительно
+# ёмкости), с приоритетом тех, кто знает язык пользователя. Если свободных нет, запрос ждёт
+# в очереди и достаётся первому освободившемуся. Если за ASSIGN_TIMEOUT никто не принял запрос,
+# он рассылается всем операторам, как раньше.
+# Навыки и ёмкость: OPERATOR_SKILLS="2:ru,uk:3;5:en,es:1" (id:языки:ёмкость); без записи —
+# все языки и OPERATOR_CAPACITY
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+OPERATOR_CAPACITY = int(os.getenv("OPERATOR_CAPACITY", 1))
+ASSIGN_TIMEOUT = float(os.getenv("ASSIGN_TIMEOUT", 60))
+OPERATOR_SKILLS = os.getenv("OPERATOR_SKILLS", "")
+
+ASSIGNMENTS = metrics.counter("tango_support_assignments_total", "Support request routing decisions", ("outcome",))
+WAIT_TIME = metrics.histogram("tango_support_wait_seconds", "Time from support request to operator accept",
+                              ("route",), buckets=(5, 15, 30, 60, 120, 300, 600, 1800))
+HANDLE_TIME = metrics.histogram("tango_support_handle_seconds", "Time from operator accept to chat end",
+                                buckets=(60, 300, 600, 1200, 1800, 3600, 7200))
+
+
+class OperatorSlot:
+    __slots__ = ("operator_id", "languages", "capacity", "chats", "offers", "misses", "last_assigned")
+
+    def __init__(self, operator_id, languages=None, capacity=None):
+        self.operator_id = operator_id
+        # None — оператор берёт запросы на любом языке
+        self.languages = languages
+        self.capacity = OPERATOR_CAPACITY if capacity is None else capacity
+        # Открытые чаты: request_id -> время принятия (None для чатов, восстановленных после перезапуска)
+        self.chats = {}
+        self.offers = set()
+        self.misses = 0
+        self.last_assigned = 0.0
+
+    def load(self):
+        return len(self.chats) + len(self.offers)
+
+    def available(self):
+        return self.load() < self.capacity
+
+    def speaks(self, language):
+        return self.languages is None or language in self.languages
+
+
+class PendingRequest:
+    # offered_to — оператор с предложением; broadcast — запрос уже разослан всем
+    __slots__ = ("request_id", "language", "since", "offered_to", "broadcast")
+
+    def __init__(self, request_id, language, since):
+        self.request_id = request_id
+        self.language = language
+        self.since = since
+        self.offered_to = None
+        self.broadcast = False
+
+
+def configure(env):
+    # Нагрузка операторов из настроек бота (см. storage.configure)
+    global OPERATOR_CAPACITY, ASSIGN_TIMEOUT, OPERATOR_SKILLS
+    OPERATOR_CAPACITY = int(env.get("OPERATOR_CAPACITY", 1))
+    ASSIGN_TIMEOUT = float(env.get("ASSIGN_TIMEOUT", 60))
+    OPERATOR_SKILLS = env.get("OPERATOR_SKILLS", "")
+
+
+def parse_skills(value):
+    skills = {}
+    for item in filter(None, (part.strip() for part in value.split(";"))):
+        try:
+            operator_id, languages, capacity = item.split(":")
+            skills[int(operator_id)] = ({lang.strip() for lang in languages.split(",") if lang.strip()} or None,
+                                        int(capacity))
+        except ValueError:
+            logger.warning(f"Cannot parse OPERATOR_SKILLS entry: {item}")
+    return skills
+
+
+class AssignmentQueue:
+    # Все методы вызываются из цикла бота; блокировка нужна только для сбора метрик из потока Flask
+    def __init__(self, operator_ids, skills=None):
+        skills = parse_skills(OPERATOR_SKILLS) if skills is None else skills
+        self.operators = {}
+        for operator_id in operator_ids:
+            languages, capacity = skills.get(operator_id, (None, OPERATOR_CAPACITY))
+            self.operators[operator_id] = OperatorSlot(operator_id, languages, capacity)
+        self.pending = OrderedDict()
+        self._lock = threading.Lock()
+        metrics.gauge("tango_operator_load", "Open chats and pending offers per operator", ("operator", "state"),
+                      self._load_values)
+        metrics.gauge("tango_support_queue_depth", "Support requests waiting for an operator", ("stage",),
+                      self._queue_values)
+
+    def _load_values(self):
+        with self._lock:
+            values = {}
+            for slot in self.operators.values():
+                values[(str(slot.operator_id), "chats")] = len(slot.chats)
+                values[(str(slot.operator_id), "offers")] = len(slot.offers)
+                values[(str(slot.operator_id), "capacity")] = slot.capacity
+            return values
+
+    def _queue_values(self):
+        with self._lock:
+            stages = {("offered",): 0, ("queued",): 0, ("broadcast",): 0}
+            for request in self.pending.values():
+                stage = "broadcast" if request.broadcast else "offered" if request.offered_to else "queued"
+                stages[(stage,)] += 1
+            return stages
+
+    def pick(self, language):
+        # Наименее загруженный свободный оператор; знающие язык — в первую очередь. При равной загрузке
+        # выше тот, у кого язык указан явно, кто реже пропускал предложения и дольше не получал запросов
+        candidates = [slot for slot in self.operators.values() if slot.available()]
+        skilled = [slot for slot in candidates if slot.speaks(language)]
+        candidates = skilled or candidates
+        if not candidates:
+            return None
+        best = min(candidates, key=lambda slot: (slot.load() / slot.capacity, slot.languages is None, slot.misses,
+                                                 slot.last_assigned))
+        return best.operator_id
+
+    def submit(self, request_id, language, now):
+        # Оператор, которому нужно предложить запрос, или None, если запрос встал в очередь
+        request = PendingRequest(request_id, language, now)
+        with self._lock:
+            self.pending[request_id] = request
+            operator_id = self.pick(language)
+            if operator_id is None:
+                ASSIGNMENTS.inc(outcome="queued")
+                return None
+            self._offer(request, operator_id, now)
+        return operator_id
+
+    def _offer(self, request, operator_id, now):
+        slot = self.operators[operator_id]
+        slot.offers.add(request.request_id)
+        slot.last_assigned = now
+        request.offered_to = operator_id
+        ASSIGNMENTS.inc(outcome="offered")
+
+    def _withdraw(self, request):
+        if request.offered_to is not None and request.offered_to in self.operators:
+            self.operators[request.offered_to].offers.discard(request.request_id)
+
+    def accept(self, request_id, operator_id, now):
+        # Время ожидания запроса; None, если запрос не проходил через очередь (например, восстановлен)
+        with self._lock:
+            request = self.pending.pop(request_id, None)
+            slot = self.operators.get(operator_id)
+            if slot is not None:
+                slot.chats[request_id] = now
+                slot.misses = 0
+            if request is None:
+                return None
+            self._withdraw(request)
+        route = "broadcast" if request.broadcast else "offer" if request.offered_to == operator_id else "other"
+        ASSIGNMENTS.inc(outcome="accepted")
+        WAIT_TIME.observe(now - request.since, route=route)
+        return now - request.since
+
+    def finish(self, request_id, operator_id, now):
+        with self._lock:
+            request = self.pending.pop(request_id, None)
+            if request is not None:
+                self._withdraw(request)
+            accepted_at = None
+            if operator_id in self.operators:
+                accepted_at = self.operators[operator_id].chats.pop(request_id, None)
+        if accepted_at is not None:
+            HANDLE_TIME.observe(now - accepted_at)
+
+    def enqueue(self, request_id, language, since):
+        # Непринятый запрос, переданный предыдущим экземпляром: предлагается при следующем dispatch
+        with self._lock:
+            self.pending[request_id] = PendingRequest(request_id, language, since)
+
+    def restore_chat(self, request_id, operator_id):
+        with self._lock:
+            if operator_id in self.operators:
+                self.operators[operator_id].chats[request_id] = None
+
+    def dispatch(self, now):
+        # Запросы из очереди для освободившихся операторов: [(request_id, operator_id)]
+        offers = []
+        with self._lock:
+            for request in self.pending.values():
+                if request.offered_to is not None or request.broadcast:
+                    continue
+                operator_id = self.pick(request.language)
+                if operator_id is None:
+                    break
+                self._offer(request, operator_id, now)
+                offers.append((request.request_id, operator_id))
+        return offers
+
+    def expire(self, now, timeout=None):
+        # Запросы, которые никто не принял за timeout: предложение снимается, запрос уходит в общую рассылку
+        timeout = ASSIGN_TIMEOUT if timeout is None else timeout
+        expired = []
+        with self._lock:
+            for request in self.pending.values():
+                if request.broadcast or now - request.since < timeout:
+                    continue
+                if request.offered_to is not None and request.offered_to in self.operators:
+                    self.operators[request.offered_to].misses += 1
+                self._withdraw(request)
+                request.broadcast = True
+                expired.append(request.request_id)
+                ASSIGNMENTS.inc(outcome="broadcast")
+        return expired
@@ -0,0 +1,245 @@
+# Резервные копии users.db. Копия снимается онлайн-API резервного копирования SQLite порциями
+# по BACKUP_PAGES страниц с паузой между ними, внутри одной читающей транзакции: в режиме WAL
+# обработчики бота пишут в базу во время копирования, а снимок соответствует её началу.
+# Снимок проверяется (integrity_check), сжимается gzip и хранится в BACKUP_DIR: последние
+# BACKUP_KEEP_LAST копий и по одной за день за BACKUP_KEEP_DAYS дней.
+# Проверка и восстановление: python backup.py create|list|verify [файл]|restore файл
+# (восстанавливать нужно при остановленном боте: кэши в памяти не узнают о подмене базы)
+import gzip
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import metrics
+import storage
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL", 6 * 3600))
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES", 256))
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", 0.005))
+BACKUP_KEEP_LAST = int(os.getenv("BACKUP_KEEP_LAST", 8))
+BACKUP_KEEP_DAYS = int(os.getenv("BACKUP_KEEP_DAYS", 14))
+# Без этих таблиц копия не считается копией базы бота
+REQUIRED_TABLES = ("users", "posts", "scheduled_posts")
+_NAME_RE = re.compile(r"^users-(\d{8}-\d{6})\.db\.gz$")
+
+BACKUPS = metrics.counter("tango_backups_total", "Database backups", ("result",))
+BACKUP_SECONDS = metrics.histogram("tango_backup_seconds", "Database backup duration", ("stage",),
+                                   buckets=(0.1, 0.5, 1, 5, 15, 60, 300))
+_last = {"timestamp": 0.0, "bytes": 0}
+metrics.gauge("tango_backup_last", "Last successful database backup", ("stat",),
+              lambda: {("timestamp",): _last["timestamp"], ("bytes",): _last["bytes"]})
+
+
+class BackupError(Exception):
+    pass
+
+
+class BackupInfo:
+    __slots__ = ("path", "created_at", "size")
+
+    def __init__(self, path, created_at, size):
+        self.path = path
+        self.created_at = created_at
+        self.size = size
+
+
+def configure(env):
+    # Каталог и расписание копий из настроек бота (см. storage.configure)
+    global BACKUP_DIR, BACKUP_INTERVAL, BACKUP_KEEP_LAST, BACKUP_KEEP_DAYS
+    BACKUP_DIR = env.get("BACKUP_DIR", "backups")
+    BACKUP_INTERVAL = int(env.get("BACKUP_INTERVAL", 6 * 3600))
+    BACKUP_KEEP_LAST = int(env.get("BACKUP_KEEP_LAST", 8))
+    BACKUP_KEEP_DAYS = int(env.get("BACKUP_KEEP_DAYS", 14))
+
+
+def list_backups(directory=None):
+    # Копии от новых к старым
+    directory = directory or BACKUP_DIR
+    if not os.path.isdir(directory):
+        return []
+    backups = []
+    for name in os.listdir(directory):
+        match = _NAME_RE.match(name)
+        if match:
+            path = os.path.join(directory, name)
+            backups.append(BackupInfo(path, datetime.strptime(match.group(1), "%Y%m%d-%H%M%S"), os.path.getsize(path)))
+    return sorted(backups, key=lambda backup: backup.created_at, reverse=True)
+
+
+def copy_database(source_path, target_path, pages=BACKUP_PAGES, sleep=BACKUP_STEP_SLEEP):
+    source = sqlite3.connect(source_path, timeout=30, isolation_level=None)
+    target = sqlite3.connect(target_path)
+    try:
+        # Копирование идёт внутри одной читающей транзакции: в режиме WAL она не мешает писать,
+        # а запись другими соединениями не заставляет SQLite начинать копирование заново
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        source.backup(target, pages=pages, sleep=sleep)
+        source.execute("COMMIT")
+    finally:
+        target.close()
+        source.close()
+
+
+def check_database(path):
+    # Сводка по копии {таблица: строк}; BackupError, если файл повреждён или это не база бота
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        if result != "ok":
+            raise BackupError(f"integrity check failed: {result}")
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        missing = [table for table in REQUIRED_TABLES if table not in tables]
+        if missing:
+            raise BackupError(f"missing tables: {', '.join(missing)}")
+        return {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in REQUIRED_TABLES}
+    except sqlite3.DatabaseError as e:
+        raise BackupError(f"not a valid database: {e}")
+    finally:
+        conn.close()
+
+
+def _compress(source_path, target_path):
+    tmp_path = f"{target_path}.{os.getpid()}.tmp"
+    with open(source_path, "rb") as source, gzip.open(tmp_path, "wb", compresslevel=6) as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+    os.replace(tmp_path, target_path)
+
+
+def _decompress(source_path, target_path):
+    with gzip.open(source_path, "rb") as source, open(target_path, "wb") as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+
+
+def create_backup(directory=None, now=None):
+    # Снимок базы -> проверка -> gzip; возвращает BackupInfo новой копии
+    directory = directory or BACKUP_DIR
+    now = now or datetime.now()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"users-{now.strftime('%Y%m%d-%H%M%S')}.db.gz")
+    fd, snapshot = tempfile.mkstemp(suffix=".db", dir=directory)
+    os.close(fd)
+    try:
+        with BACKUP_SECONDS.time(stage="copy"):
+            copy_database(storage.DB_PATH, snapshot)
+        with BACKUP_SECONDS.time(stage="verify"):
+            counts = check_database(snapshot)
+        with BACKUP_SECONDS.time(stage="compress"):
+            _compress(snapshot, path)
+    except Exception:
+        BACKUPS.inc(result="error")
+        raise
+    finally:
+        os.unlink(snapshot)
+    size = os.path.getsize(path)
+    BACKUPS.inc(result="ok")
+    _last.update(timestamp=time.time(), bytes=size)
+    logger.info(f"Database backup {path} created: {size} bytes, {counts['users']} users")
+    return BackupInfo(path, now, size)
+
+
+def expired_backups(backups, now=None, keep_last=None, keep_days=None):
+    # Остаются keep_last последних копий и самая поздняя копия каждого из последних keep_days дней
+    now = now or datetime.now()
+    keep_last = BACKUP_KEEP_LAST if keep_last is None else keep_last
+    keep_days = BACKUP_KEEP_DAYS if keep_days is None else keep_days
+    keep = {backup.path for backup in backups[:keep_last]}
+    days = set()
+    for backup in backups:
+        day = backup.created_at.date()
+        if now - backup.created_at <= timedelta(days=keep_days) and day not in days:
+            days.add(day)
+            keep.add(backup.path)
+    return [backup for backup in backups if backup.path not in keep]
+
+
+def rotate(directory=None, now=None):
+    removed = expired_backups(list_backups(directory), now)
+    for backup in removed:
+        os.unlink(backup.path)
+        logger.info(f"Database backup {backup.path} removed by retention policy")
+    return len(removed)
+
+
+def verify_backup(path):
+    # Распаковка во временный файл и полная проверка; {таблица: строк}
+    fd, snapshot = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        try:
+            _decompress(path, snapshot)
+        except (OSError, EOFError) as e:
+            raise BackupError(f"cannot decompress {path}: {e}")
+        return check_database(snapshot)
+    finally:
+        os.unlink(snapshot)
+
+
+def restore_backup(path, target_path=None):
+    # Копия проверяется, текущая база сохраняется отдельной копией, затем содержимое копии
+    # переносится в базу тем же API резервного копирования (с учётом WAL, без подмены файла)
+    target_path = target_path or storage.DB_PATH
+    fd, snapshot = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        try:
+            _decompress(path, snapshot)
+        except (OSError, EOFError) as e:
+            raise BackupError(f"cannot decompress {path}: {e}")
+        counts = check_database(snapshot)
+        safety = None
+        if os.path.exists(target_path):
+            safety = create_backup()
+        copy_database(snapshot, target_path, pages=-1, sleep=0)
+    finally:
+        os.unlink(snapshot)
+    logger.info(f"Database restored from {path}: {counts}" + (f", previous state saved to {safety.path}" if safety else ""))
+    return counts, safety
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args = sys.argv[1:]
+    action = args[0] if args else "list"
+    try:
+        if action == "create":
+            backup = create_backup()
+            rotate()
+            print(f"{backup.path}: {backup.size} bytes")
+        elif action == "list":
+            for backup in list_backups():
+                print(f"{backup.created_at:%Y-%m-%d %H:%M:%S}  {backup.size:>12}  {backup.path}")
+        elif action == "verify":
+            backups = [args[1]] if len(args) > 1 else [backup.path for backup in list_backups()]
+            failed = 0
+            for path in backups:
+                try:
+                    print(f"{path}: ok, {verify_backup(path)}")
+                except BackupError as e:
+                    failed += 1
+                    print(f"{path}: FAILED, {e}")
+            sys.exit(1 if failed else 0)
+        elif action == "restore" and len(args) == 2:
+            counts, safety = restore_backup(args[1])
+            print(f"Restored {args[1]}: {counts}")
+            if safety:
+                print(f"Previous database saved to {safety.path}")
+        else:
+            print("Usage: python backup.py create|list|verify [file]|restore file")
+            sys.exit(2)
+    except BackupError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
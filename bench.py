@@ -0,0 +1,266 @@
+# Микро-бенчмарки горячих путей бота.
+# Запуск: python bench.py [--sizes 1000,10000,100000,1000000] [--json out.json]
+#                          [--baseline bench_baseline.json] [--save-baseline]
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+BASELINE_FILE = "bench_baseline.json"
+LANGS = ["en", "ru", "uk", "tr", "es"]
+
+# Бенчмарк работает в отдельной временной директории, чтобы не трогать боевой users.db и bot.log
+_REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+_WORK_DIR = tempfile.mkdtemp(prefix="tango_bench_")
+
+
+def import_bot():
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    os.environ.setdefault("ADMIN_ID", "1")
+    os.environ.setdefault("OPERATORS", "2:Bench")
+    # Вывод логов в консоль мешает читать результаты; запись в bot.log (во временной директории) остаётся
+    os.environ.setdefault("LOG_STDERR", "0")
+    sys.path.insert(0, _REPO_DIR)
+    os.chdir(_WORK_DIR)
+    import tango
+    tango.create_application()
+    return tango
+
+
+def measure(func, number=None, repeat=7, min_time=0.05):
+    # Подбираем количество вызовов так, чтобы один прогон занимал не меньше min_time
+    if number is None:
+        number = 1
+        while True:
+            start = time.perf_counter_ns()
+            for _ in range(number):
+                func()
+            elapsed = time.perf_counter_ns() - start
+            if elapsed >= min_time * 1e9 or number >= 1_000_000:
+                break
+            number *= 10
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter_ns() - start) / number / 1000)
+    samples.sort()
+    return {
+        "number": number,
+        "repeat": repeat,
+        "mean_us": round(statistics.fmean(samples), 3),
+        "median_us": round(statistics.median(samples), 3),
+        "min_us": round(samples[0], 3),
+        "p95_us": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+    }
+
+
+def populate_users(size):
+    if os.path.exists("users.db"):
+        os.unlink("users.db")
+    tango.init_db()
+    conn = sqlite3.connect("users.db")
+    now = datetime.now()
+    rows = ((uid, f"user{uid}", now.strftime("%Y-%m-%d %H:%M:%S"), LANGS[uid % len(LANGS)],
+             "Yes" if uid % 50 == 0 else "No", (now - timedelta(minutes=uid % 10000)).strftime("%Y-%m-%d %H:%M:%S"))
+            for uid in range(1, size + 1))
+    conn.executemany(
+        "INSERT INTO users (user_id, username, first_start, language, is_blocked, last_interaction) VALUES (?, ?, ?, ?, ?, ?)",
+        rows)
+    conn.commit()
+    conn.close()
+
+
+def bench_db(results, sizes):
+    for size in sizes:
+        populate_users(size)
+        ids = iter(range(10**9))
+        existing = [1 + (i * 7919) % size for i in range(1024)]
+        pos = iter(range(10**9))
+        results[f"get_user_language[{size}]"] = measure(
+            lambda: tango.get_user_language(existing[next(pos) % 1024]))
+        results[f"save_user.update[{size}]"] = measure(
+            lambda: tango.save_user(existing[next(pos) % 1024], "bench", "ru"), repeat=5)
+        results[f"save_user.insert[{size}]"] = measure(
+            lambda: tango.save_user(size + 1 + next(ids), "bench", "en"), repeat=5)
+        results[f"get_all_users[{size}]"] = measure(tango.get_all_users, repeat=5, min_time=0.01)
+        results[f"get_users_by_language[{size}]"] = measure(
+            lambda: tango.get_users_by_language("ru"), repeat=5, min_time=0.01)
+
+
+def bench_keyboards(results):
+    results["build_menu.user"] = measure(lambda: tango.build_menu("ru", 100))
+    results["build_menu.admin"] = measure(lambda: tango.build_menu("ru", tango.ADMIN_ID))
+    results["build_lang_menu"] = measure(tango.build_lang_menu)
+    results["build_post_lang_menu"] = measure(tango.build_post_lang_menu)
+    results["build_recipient_menu"] = measure(tango.build_recipient_menu)
+    results["build_recipient_lang_menu"] = measure(tango.build_recipient_lang_menu)
+    results["build_settings_menu"] = measure(lambda: tango.build_settings_menu("en", tango.ADMIN_ID))
+    results["build_send_time_menu"] = measure(tango.build_send_time_menu)
+    results["build_confirm_menu"] = measure(tango.build_confirm_menu)
+    results["build_inline_keyboard_status"] = measure(
+        lambda: tango.build_inline_keyboard_status("0f0e0d0c", "uk", "accepted"))
+    results["build_back_menu"] = measure(lambda: tango.build_back_menu("tr"))
+
+
+def bench_startup(results):
+    # Холодный импорт в новом интерпретаторе: без настроек и сети, только загрузка модулей
+    env = {**os.environ, "PYTHONPATH": _REPO_DIR}
+    results["import_tango"] = measure(
+        lambda: subprocess.run([sys.executable, "-c", "import tango"], env=env, check=True), number=1, repeat=5)
+
+
+def bench_translations(results):
+    keys = list(tango.translations["en"].keys())
+
+    def lookup():
+        for lang in LANGS:
+            for key in keys:
+                tango.translations[lang][key]
+    results[f"translations.lookup[x{len(keys) * len(LANGS)}]"] = measure(lookup)
+
+
+def make_conversation(messages, language):
+    base = datetime.now().timestamp()
+    conv = tango.Conversation("bench", 100, "bench", language, base)
+    conv.operator_name = "Bench"
+    for i in range(messages):
+        conv.add_message('user' if i % 2 else 'operator', f"сообщение номер {i} " * 4, ts=base + i)
+    for i in range(messages // 20):
+        conv.add_media(tango.MediaRecord('Фото', f"file{i}", "caption", 'user', i, ts=base + messages + i))
+    return conv
+
+
+def bench_history(results):
+    # Перевод подменяется на тождественный, чтобы мерить форматирование, а не сеть
+    original_translate = tango.translate_text
+    async def identity(text, target_lang):
+        return text
+
+    tango.translate_text = identity
+    loop = asyncio.new_event_loop()
+    try:
+        for messages in (100, 1000, 10000):
+            for language in ("ru", "en"):
+                conv = make_conversation(messages, language)
+
+                def run():
+                    transcript = loop.run_until_complete(tango.build_transcript(conv))
+                    os.unlink(tango.create_chat_history_file(conv, transcript))
+                results[f"create_chat_history_file[{messages},{language}]"] = measure(run, repeat=5, min_time=0.02)
+                conv.close()
+    finally:
+        loop.close()
+        tango.translate_text = original_translate
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        self.sent += 1
+
+
+def bench_scheduled_posts(results, audience):
+    populate_users(audience)
+    context = SimpleNamespace(bot=FakeBot())
+    past = (datetime.now() - timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M:%S")
+
+    def run():
+        tango.save_scheduled_post("Бенчмарк", None, "Кнопка", "https://example.com", past, None, "all")
+        tango.save_scheduled_post("Бенчмарк", None, None, None, past, "ru", "by_lang")
+        asyncio.run(tango.check_scheduled_posts(context))
+    results[f"check_scheduled_posts[{audience}]"] = measure(run, number=1, repeat=5)
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, current in sorted(results.items()):
+        previous = baseline.get("results", {}).get(name)
+        if not previous:
+            continue
+        ratio = current["median_us"] / previous["median_us"] if previous["median_us"] else 1.0
+        current["baseline_median_us"] = previous["median_us"]
+        current["ratio"] = round(ratio, 3)
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки горячих путей tango.py")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="размеры таблицы users через запятую (например 1000,10000,100000,1000000)")
+    parser.add_argument("--audience", type=int, default=10000, help="размер аудитории для check_scheduled_posts")
+    parser.add_argument("--only", default="", help="запустить только группы: db,keyboards,translations,history,scheduled,startup")
+    parser.add_argument("--json", dest="json_path", help="куда сохранить результаты (по умолчанию stdout)")
+    parser.add_argument("--baseline", default=os.path.join(_REPO_DIR, BASELINE_FILE), help="файл базовой линии")
+    parser.add_argument("--save-baseline", action="store_true", help="перезаписать базовую линию текущими результатами")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимое замедление медианы (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    groups = set(filter(None, args.only.split(","))) or {"db", "keyboards", "translations", "history", "scheduled",
+                                                          "startup"}
+    results = {}
+    if "db" in groups:
+        bench_db(results, sizes)
+    if "keyboards" in groups:
+        bench_keyboards(results)
+    if "translations" in groups:
+        bench_translations(results)
+    if "history" in groups:
+        bench_history(results)
+    if "scheduled" in groups:
+        bench_scheduled_posts(results, args.audience)
+    if "startup" in groups:
+        bench_startup(results)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        report["regressions"] = regressions
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.json_path:
+        with open(os.path.join(_REPO_DIR, args.json_path) if not os.path.isabs(args.json_path) else args.json_path,
+                  "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    for name in regressions:
+        print(f"REGRESSION {name}: {results[name]['baseline_median_us']}us -> {results[name]['median_us']}us",
+              file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    tango = import_bot()
+    sys.exit(main())
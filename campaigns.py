@@ -0,0 +1,426 @@
+# Повторяющиеся рассылки (кампании). Расписание — задача APScheduler с триггером cron или interval
+# в собственном хранилище задач поверх SQLite (таблица campaign_jobs в users.db, без SQLAlchemy),
+# содержимое поста и получатели — в таблице campaigns. После простоя пропущенные запуски
+# схлопываются в один (coalesce), если с момента запуска прошло не больше CAMPAIGN_MISFIRE_GRACE,
+# иначе пропускаются. Задачи выполняет один процесс (владелец глобальных задач); в остальных
+# планировщик запущен на паузе и только записывает изменения в хранилище.
+# В режиме нескольких ботов (tenants.py) планировщик один на процесс, а у каждого бота своё
+# хранилище задач (alias — имя бота) в его базе; функции модуля принимают store — имя хранилища
+import logging
+import os
+import pickle
+import re
+import sqlite3
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_MISSED
+from apscheduler.job import Job
+from apscheduler.jobstores.base import BaseJobStore, ConflictingIdError, JobLookupError
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime
+from tzlocal import get_localzone
+
+import metrics
+import storage
+
+logger = logging.getLogger(__name__)
+
+CAMPAIGN_TIMEZONE = os.getenv("CAMPAIGN_TIMEZONE")
+CAMPAIGN_MISFIRE_GRACE = int(os.getenv("CAMPAIGN_MISFIRE_GRACE", 3600))
+# Рассылка чаще раза в CAMPAIGN_MIN_INTERVAL секунд — почти наверняка ошибка в расписании
+CAMPAIGN_MIN_INTERVAL = int(os.getenv("CAMPAIGN_MIN_INTERVAL", 3600))
+JOB_PREFIX = "campaign:"
+_DAYS = {"пн": "mon", "вт": "tue", "ср": "wed", "чт": "thu", "пт": "fri", "сб": "sat", "вс": "sun"}
+_UNITS = {"m": "minutes", "h": "hours", "d": "days", "w": "weeks", "м": "minutes", "ч": "hours", "д": "days",
+          "н": "weeks"}
+# Дни недели cron по номерам: 0 и 7 — воскресенье
+_CRON_DAYS = ("sun", "mon", "tue", "wed", "thu", "fri", "sat")
+_CRON_DAY_RE = re.compile(r"^(\*|[a-z0-9]+)(?:-([a-z0-9]+))?(?:/(\d+))?$")
+_INTERVAL_RE = re.compile(r"^(?:каждые|каждый|every)\s+(\d+)\s*([a-zа-я]+)$")
+_DAILY_RE = re.compile(r"^(?:ежедневно|daily)\s+(\d{1,2}):(\d{2})$")
+_WEEKLY_RE = re.compile(r"^(?:еженедельно|weekly)\s+([a-zа-я,\-]+)\s+(\d{1,2}):(\d{2})$")
+
+CAMPAIGN_RUNS = metrics.counter("tango_campaign_runs_total", "Recurring broadcast runs", ("result",))
+
+scheduler = None
+# Хранилище -> корутина запуска рассылки и путь к базе бота
+_runners = {}
+_paths = {}
+
+
+class CampaignError(ValueError):
+    pass
+
+
+class SQLiteJobStore(BaseJobStore):
+    # Хранилище задач APScheduler в SQLite: состояние задачи сериализуется pickle, как в SQLAlchemyJobStore.
+    # Кэша в памяти нет, поэтому изменения из других процессов видны при следующем пробуждении планировщика
+    def __init__(self, path=None, table="campaign_jobs", pickle_protocol=pickle.HIGHEST_PROTOCOL):
+        super().__init__()
+        self.path = path or storage.DB_PATH
+        self.table = table
+        self.pickle_protocol = pickle_protocol
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(f'''CREATE TABLE IF NOT EXISTS {self.table} (
+                                    id TEXT PRIMARY KEY,
+                                    next_run_time REAL,
+                                    job_state BLOB
+                                 )''')
+                conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table}_next_run ON {self.table} (next_run_time)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def lookup_job(self, job_id):
+        conn = self._connect()
+        try:
+            row = conn.execute(f"SELECT job_state FROM {self.table} WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return self._reconstitute_job(row[0]) if row else None
+
+    def get_due_jobs(self, now):
+        return self._get_jobs("next_run_time <= ?", (datetime_to_utc_timestamp(now),))
+
+    def get_next_run_time(self):
+        conn = self._connect()
+        try:
+            row = conn.execute(f"SELECT next_run_time FROM {self.table} WHERE next_run_time IS NOT NULL "
+                               f"ORDER BY next_run_time LIMIT 1").fetchone()
+        finally:
+            conn.close()
+        return utc_timestamp_to_datetime(row[0]) if row else None
+
+    def get_all_jobs(self):
+        jobs = self._get_jobs()
+        self._fix_paused_jobs_sorting(jobs)
+        return jobs
+
+    def add_job(self, job):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(f"INSERT INTO {self.table} (id, next_run_time, job_state) VALUES (?, ?, ?)",
+                             (job.id, datetime_to_utc_timestamp(job.next_run_time),
+                              pickle.dumps(job.__getstate__(), self.pickle_protocol)))
+        except sqlite3.IntegrityError:
+            raise ConflictingIdError(job.id)
+        finally:
+            conn.close()
+
+    def update_job(self, job):
+        conn = self._connect()
+        try:
+            with conn:
+                updated = conn.execute(f"UPDATE {self.table} SET next_run_time = ?, job_state = ? WHERE id = ?",
+                                       (datetime_to_utc_timestamp(job.next_run_time),
+                                        pickle.dumps(job.__getstate__(), self.pickle_protocol), job.id)).rowcount
+        finally:
+            conn.close()
+        if not updated:
+            raise JobLookupError(job.id)
+
+    def remove_job(self, job_id):
+        conn = self._connect()
+        try:
+            with conn:
+                removed = conn.execute(f"DELETE FROM {self.table} WHERE id = ?", (job_id,)).rowcount
+        finally:
+            conn.close()
+        if not removed:
+            raise JobLookupError(job_id)
+
+    def remove_all_jobs(self):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(f"DELETE FROM {self.table}")
+        finally:
+            conn.close()
+
+    def _reconstitute_job(self, job_state):
+        job_state = pickle.loads(job_state)
+        job_state["jobstore"] = self
+        job = Job.__new__(Job)
+        job.__setstate__(job_state)
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+        return job
+
+    def _get_jobs(self, condition="1", params=()):
+        conn = self._connect()
+        try:
+            rows = conn.execute(f"SELECT id, job_state FROM {self.table} WHERE {condition} ORDER BY next_run_time",
+                                params).fetchall()
+        finally:
+            conn.close()
+        jobs = []
+        failed = []
+        for job_id, job_state in rows:
+            try:
+                jobs.append(self._reconstitute_job(job_state))
+            except Exception as e:
+                logger.error(f"Cannot restore campaign job {job_id}, removing it: {e}")
+                failed.append(job_id)
+        for job_id in failed:
+            self.remove_job(job_id)
+        return jobs
+
+
+def timezone():
+    return ZoneInfo(CAMPAIGN_TIMEZONE) if CAMPAIGN_TIMEZONE else get_localzone()
+
+
+def _cron_day(value):
+    if value.isdigit() and int(value) <= 7:
+        return int(value) % 7
+    if value in _CRON_DAYS:
+        return _CRON_DAYS.index(value)
+    raise CampaignError(f"неверный день недели {value}")
+
+
+def cron_days(field):
+    # Поле дня недели cron -> список имён для APScheduler: в cron 0 — воскресенье, а в APScheduler
+    # 0 — понедельник, поэтому диапазоны и шаги раскрываются по номерам cron ("0-5" -> "sun,mon,...,fri")
+    days = set()
+    for item in field.split(","):
+        match = _CRON_DAY_RE.match(item)
+        if match is None:
+            raise CampaignError(f"неверный день недели {item}")
+        start, end, step = match.groups()
+        if start == "*":
+            if end is not None:
+                raise CampaignError(f"неверный день недели {item}")
+            first, last = 0, 6
+        else:
+            first = _cron_day(start)
+            if end is not None:
+                # "7" в конце диапазона — воскресенье после субботы: "5-7" — пт, сб, вс
+                last = 7 if end == "7" else _cron_day(end)
+            else:
+                # "1/2" в cron — с понедельника до конца недели через день
+                last = 6 if step else first
+        if last < first or (step is not None and int(step) == 0):
+            raise CampaignError(f"неверный день недели {item}")
+        days.update(day % 7 for day in range(first, last + 1, int(step or 1)))
+    if len(days) == 7:
+        return "*"
+    return ",".join(_CRON_DAYS[day] for day in sorted(days))
+
+
+def parse_recurrence(text, tz=None):
+    # Триггер APScheduler по описанию: "каждые 6h", "ежедневно 10:00", "еженедельно пн,чт 10:00"
+    # или выражение cron из пяти полей ("0 10 * * 1-5")
+    tz = tz or timezone()
+    value = " ".join(text.lower().split())
+    try:
+        match = _INTERVAL_RE.match(value)
+        if match:
+            unit = _UNITS.get(match.group(2)) or _UNITS.get(match.group(2)[:1])
+            if unit is None:
+                raise CampaignError(f"неизвестная единица {match.group(2)}")
+            trigger = IntervalTrigger(**{unit: int(match.group(1))}, timezone=tz)
+        elif _DAILY_RE.match(value):
+            hour, minute = _DAILY_RE.match(value).groups()
+            trigger = CronTrigger(hour=hour, minute=minute, timezone=tz)
+        elif _WEEKLY_RE.match(value):
+            days, hour, minute = _WEEKLY_RE.match(value).groups()
+            for name, english in _DAYS.items():
+                days = days.replace(name, english)
+            trigger = CronTrigger(day_of_week=days, hour=hour, minute=minute, timezone=tz)
+        elif len(value.split()) == 5:
+            fields = value.split()
+            fields[4] = cron_days(fields[4])
+            trigger = CronTrigger.from_crontab(" ".join(fields), timezone=tz)
+        else:
+            raise CampaignError("не удалось разобрать расписание")
+    except ValueError as e:
+        if isinstance(e, CampaignError):
+            raise
+        raise CampaignError(f"неверное расписание: {e}")
+    now = datetime.now(tz)
+    first = trigger.get_next_fire_time(None, now)
+    if first is None:
+        raise CampaignError("по этому расписанию рассылка не запустится ни разу")
+    second = trigger.get_next_fire_time(first, first + timedelta(microseconds=1))
+    if second is not None and (second - first).total_seconds() < CAMPAIGN_MIN_INTERVAL:
+        raise CampaignError(f"рассылка не чаще раза в {CAMPAIGN_MIN_INTERVAL // 60} мин")
+    return trigger
+
+
+def init_campaigns(path=None):
+    conn = sqlite3.connect(path or storage.DB_PATH)
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS campaigns (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    post_data TEXT,
+                    target_users TEXT,
+                    target_lang TEXT,
+                    recurrence TEXT,
+                    runs INTEGER DEFAULT 0,
+                    last_run TEXT,
+                    created_at TEXT
+                 )''')
+    conn.commit()
+    conn.close()
+
+
+def _job_id(campaign_id):
+    return f"{JOB_PREFIX}{campaign_id}"
+
+
+def _connect(store):
+    return sqlite3.connect(_paths.get(store, storage.DB_PATH))
+
+
+def _on_event(event):
+    if not event.job_id.startswith(JOB_PREFIX):
+        return
+    if event.code == EVENT_JOB_MISSED:
+        CAMPAIGN_RUNS.inc(result="missed")
+        logger.warning(f"Campaign {event.jobstore}/{event.job_id} missed its run at {event.scheduled_run_time}")
+    elif event.code == EVENT_JOB_ERROR:
+        CAMPAIGN_RUNS.inc(result="error")
+        logger.error(f"Campaign {event.jobstore}/{event.job_id} failed: {event.exception}")
+    else:
+        CAMPAIGN_RUNS.inc(result="ok")
+
+
+def start(loop, runner, paused=False, store="default", path=None):
+    # runner(campaign_id) — корутина, запускающая рассылку кампании. Первый вызов запускает планировщик,
+    # следующие (другие боты того же процесса) добавляют в него своё хранилище
+    global scheduler
+    path = path or storage.DB_PATH
+    _runners[store] = runner
+    _paths[store] = path
+    if scheduler is not None:
+        scheduler.add_jobstore(SQLiteJobStore(path), store)
+        return scheduler
+    scheduler = AsyncIOScheduler(event_loop=loop, timezone=timezone(),
+                                 jobstores={store: SQLiteJobStore(path)},
+                                 job_defaults={"coalesce": True, "misfire_grace_time": CAMPAIGN_MISFIRE_GRACE,
+                                               "max_instances": 1})
+    scheduler.add_listener(_on_event, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+    scheduler.start(paused=paused)
+    return scheduler
+
+
+def stop(store="default"):
+    # Хранилище бота отключается от планировщика; сам планировщик общий и останавливается в shutdown()
+    if _runners.pop(store, None) is not None and scheduler is not None:
+        scheduler.remove_jobstore(store)
+
+
+def shutdown():
+    # Вызывает владелец планировщика один раз: tango в однобот-режиме, tenants — после всех ботов
+    global scheduler
+    if scheduler is None:
+        return
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    scheduler = None
+
+
+def wakeup():
+    # Задачи, добавленные другим процессом, планировщик видит только при пробуждении
+    if scheduler is not None and scheduler.running:
+        scheduler.wakeup()
+
+
+async def fire(campaign_id, store="default"):
+    # Функция задачи: в хранилище сохраняется ссылка "campaigns:fire", а не на модуль бота
+    await _runners[store](campaign_id)
+
+
+def create(post_data, target_users, target_lang, recurrence, store="default"):
+    # (id кампании, время первой рассылки)
+    trigger = parse_recurrence(recurrence)
+    conn = _connect(store)
+    try:
+        with conn:
+            campaign_id = conn.execute(
+                "INSERT INTO campaigns (post_data, target_users, target_lang, recurrence, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (post_data, target_users, target_lang, recurrence, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            ).lastrowid
+    finally:
+        conn.close()
+    # Задачи хранилища по умолчанию создаются без kwargs, как до появления нескольких ботов
+    job = scheduler.add_job(fire, trigger, args=(campaign_id,), kwargs={"store": store} if store != "default" else None,
+                            id=_job_id(campaign_id), name=recurrence, jobstore=store)
+    logger.info(f"Campaign {store}/{campaign_id} created: {recurrence}, next run {job.next_run_time}")
+    return campaign_id, job.next_run_time
+
+
+def get(campaign_id, store="default"):
+    conn = _connect(store)
+    try:
+        return conn.execute("SELECT id, post_data, target_users, target_lang FROM campaigns WHERE id = ?",
+                            (campaign_id,)).fetchone()
+    finally:
+        conn.close()
+
+
+def record_run(campaign_id, store="default"):
+    conn = _connect(store)
+    try:
+        with conn:
+            conn.execute("UPDATE campaigns SET runs = runs + 1, last_run = ? WHERE id = ?",
+                         (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), campaign_id))
+    finally:
+        conn.close()
+
+
+def list_campaigns(store="default"):
+    # [(id, расписание, следующий запуск или None на паузе, запусков, последний запуск, post_data)]
+    conn = _connect(store)
+    try:
+        rows = conn.execute("SELECT id, recurrence, runs, last_run, post_data FROM campaigns ORDER BY id").fetchall()
+    finally:
+        conn.close()
+    result = []
+    for campaign_id, recurrence, runs, last_run, post_data in rows:
+        job = scheduler.get_job(_job_id(campaign_id), store) if scheduler is not None else None
+        result.append((campaign_id, recurrence, job.next_run_time if job else None, runs, last_run, post_data))
+    return result
+
+
+def remove(campaign_id, store="default"):
+    conn = _connect(store)
+    try:
+        with conn:
+            deleted = conn.execute("DELETE FROM campaigns WHERE id = ?", (campaign_id,)).rowcount
+    finally:
+        conn.close()
+    try:
+        scheduler.remove_job(_job_id(campaign_id), store)
+    except JobLookupError:
+        pass
+    return bool(deleted)
+
+
+def pause(campaign_id, store="default"):
+    try:
+        scheduler.pause_job(_job_id(campaign_id), store)
+    except JobLookupError:
+        return False
+    return True
+
+
+def resume(campaign_id, store="default"):
+    # Время следующей рассылки или None, если кампании нет
+    try:
+        job = scheduler.resume_job(_job_id(campaign_id), store)
+    except JobLookupError:
+        return None
+    return job.next_run_time if job else None
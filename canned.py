@@ -0,0 +1,199 @@
+# Готовые ответы операторов. Ответ пишется один раз на русском, при сохранении переводится на все
+# языки бота и хранится вместе с переводами в canned_replies; библиотека целиком держится в памяти,
+# поэтому готовый ответ уходит пользователю сразу на его языке, без обращения к переводчику.
+# Языки, на которые перевести не удалось, досылает fill_missing; до тех пор отправляется русский текст.
+# Библиотека неизменяемая и подменяется целиком при изменении (счётчик canned_version в таблице meta)
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from types import MappingProxyType
+
+import metrics
+import storage
+import translation
+from translations import translations
+
+logger = logging.getLogger(__name__)
+
+SOURCE_LANGUAGE = "ru"
+LANGUAGES = tuple(translations)
+# Ключ входит в callback_data кнопки ("canned_<ключ>"), поэтому он короткий
+_KEY_RE = re.compile(r"^[\w-]{1,32}$")
+
+CANNED_SENDS = metrics.counter("tango_canned_replies_sent_total", "Canned replies sent to users", ("translated",))
+CANNED_TRANSLATIONS = metrics.counter("tango_canned_translations_total", "Canned reply translations at save time",
+                                      ("status",))
+
+
+class CannedError(ValueError):
+    pass
+
+
+class CannedReply:
+    __slots__ = ("key", "text", "texts")
+
+    def __init__(self, key, text, texts):
+        self.key = key
+        self.text = text
+        self.texts = MappingProxyType({**texts, SOURCE_LANGUAGE: text})
+
+    def text_for(self, language):
+        return self.texts.get(language, self.text)
+
+    def missing(self):
+        return [language for language in LANGUAGES if language not in self.texts]
+
+
+class CannedLibrary:
+    __slots__ = ("version", "replies")
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.replies = MappingProxyType({key: CannedReply(key, text, json.loads(texts or "{}"))
+                                         for key, text, texts in rows})
+
+    def get(self, key):
+        return self.replies.get(key)
+
+    def __len__(self):
+        return len(self.replies)
+
+
+_library = None
+_reload_lock = threading.Lock()
+
+
+def init_canned():
+    conn = sqlite3.connect(storage.DB_PATH)
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS canned_replies (
+                    key TEXT PRIMARY KEY,
+                    text TEXT,
+                    translations TEXT,
+                    author_id INTEGER,
+                    updated_at TEXT
+                 )''')
+    c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('canned_version', 0)")
+    conn.commit()
+    conn.close()
+
+
+def read_version(conn):
+    row = conn.execute("SELECT value FROM meta WHERE key = 'canned_version'").fetchone()
+    return row[0] if row else 0
+
+
+def load():
+    global _library
+    with _reload_lock:
+        conn = sqlite3.connect(storage.DB_PATH)
+        try:
+            version = read_version(conn)
+            rows = conn.execute("SELECT key, text, translations FROM canned_replies ORDER BY key").fetchall()
+        finally:
+            conn.close()
+        _library = CannedLibrary(version, rows)
+    logger.info(f"Canned replies loaded: {len(rows)} replies, version {version}")
+    return _library
+
+
+def current():
+    return _library if _library is not None else load()
+
+
+def refresh_if_changed():
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        version = read_version(conn)
+    finally:
+        conn.close()
+    if _library is None or version != _library.version:
+        return load()
+    return _library
+
+
+def _write(key, text, texts, author_id=None):
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        with conn:
+            if author_id is None:
+                conn.execute("UPDATE canned_replies SET translations = ? WHERE key = ? AND text = ?",
+                             (json.dumps(texts, ensure_ascii=False), key, text))
+            else:
+                conn.execute("INSERT OR REPLACE INTO canned_replies (key, text, translations, author_id, updated_at) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             (key, text, json.dumps(texts, ensure_ascii=False), author_id,
+                              datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'canned_version'")
+    finally:
+        conn.close()
+
+
+async def translate_all(text, languages):
+    # {язык: перевод} только для успешных переводов; без translate_cached, чтобы не принять
+    # возвращённый при ошибке исходный текст за перевод
+    results = await asyncio.gather(*(translation.translate(text, language) for language in languages),
+                                   return_exceptions=True)
+    texts = {}
+    for language, result in zip(languages, results):
+        if isinstance(result, Exception):
+            CANNED_TRANSLATIONS.inc(status="error")
+            logger.warning(f"Canned reply translation to {language} failed: {result}")
+        else:
+            CANNED_TRANSLATIONS.inc(status="ok")
+            texts[language] = result
+    return texts
+
+
+async def save(key, text, author_id):
+    # Список языков, на которые перевести не удалось
+    text = text.strip()
+    if not _KEY_RE.match(key):
+        raise CannedError("ключ — до 32 букв, цифр, '_' или '-'")
+    if not text:
+        raise CannedError("пустой текст")
+    if len(text) > translation.MAX_CHARS:
+        raise CannedError(f"текст длиннее {translation.MAX_CHARS} символов")
+    targets = [language for language in LANGUAGES if language != SOURCE_LANGUAGE]
+    texts = await translate_all(text, targets)
+    await asyncio.to_thread(_write, key, text, texts, author_id)
+    await asyncio.to_thread(load)
+    return [language for language in targets if language not in texts]
+
+
+def drop(key):
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        with conn:
+            deleted = conn.execute("DELETE FROM canned_replies WHERE key = ?", (key,)).rowcount
+            if deleted:
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'canned_version'")
+    finally:
+        conn.close()
+    if deleted:
+        load()
+    return bool(deleted)
+
+
+async def fill_missing():
+    # Досылает переводы, не полученные при сохранении (переводчик был недоступен); число дополненных ответов
+    filled = 0
+    for reply in list(current().replies.values()):
+        missing = reply.missing()
+        if not missing:
+            continue
+        texts = await translate_all(reply.text, missing)
+        if texts:
+            await asyncio.to_thread(_write, reply.key, reply.text, {**reply.texts, **texts})
+            filled += 1
+    if filled:
+        await asyncio.to_thread(load)
+    return filled
+
+
+def record_send(reply, language):
+    CANNED_SENDS.inc(translated="yes" if language == SOURCE_LANGUAGE or language in reply.texts else "no")
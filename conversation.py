@@ -0,0 +1,266 @@
+# Компактная модель чата поддержки: объекты со __slots__, в памяти хранится только
+# последний хвост истории, более старые сообщения выгружаются в файл на диске (в потоке, не в цикле
+# событий); служебные сообщения и медиа чата ограничены числом последних записей
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+HISTORY_TAIL = int(os.getenv("CONVERSATION_HISTORY_TAIL", 50))
+MAX_CONVERSATION_BYTES = int(os.getenv("MAX_CONVERSATION_BYTES", 64 * 1024))
+SPILL_DIR = os.getenv("CONVERSATION_SPILL_DIR", os.path.join(tempfile.gettempdir(), "tango_spill"))
+# Сколько служебных сообщений (удаляются по завершении чата) и медиа (уходят в итог чата) хранится;
+# более старые забываются
+MAX_TRACKED_MESSAGES = int(os.getenv("CONVERSATION_MAX_TRACKED_MESSAGES", 500))
+MAX_MEDIA_FILES = int(os.getenv("CONVERSATION_MAX_MEDIA_FILES", 100))
+
+# Задачи записи в файлы выгрузки: ссылки держатся, пока запись не закончится
+_spill_tasks = set()
+
+
+class Message:
+    __slots__ = ("ts", "sender", "content")
+
+    def __init__(self, ts, sender, content):
+        self.ts = ts
+        self.sender = sender
+        self.content = content
+
+    def size(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.content)
+
+
+class MediaRecord:
+    # message_id — сообщение с медиа в чате оператора, forwarded_id — копия у пользователя (если отправил оператор)
+    __slots__ = ("ts", "kind", "file_id", "caption", "sender", "message_id", "forwarded_id")
+
+    def __init__(self, kind, file_id, caption, sender, message_id, forwarded_id=None, ts=None):
+        self.ts = ts if ts is not None else time.time()
+        self.kind = kind
+        self.file_id = file_id
+        self.caption = caption
+        self.sender = sender
+        self.message_id = message_id
+        self.forwarded_id = forwarded_id
+
+    def size(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.file_id) + sys.getsizeof(self.caption)
+
+    def operator_message_ids(self):
+        return [self.message_id]
+
+    def user_message_ids(self):
+        return [self.forwarded_id] if self.sender == 'operator' and self.forwarded_id else []
+
+    def to_state(self):
+        return [self.kind, self.file_id, self.caption, self.sender, self.message_id, self.forwarded_id, self.ts]
+
+
+class MediaAlbum:
+    # Альбом (media_group_id) как одна запись: items — [(вид, file_id, подпись)], message_ids — сообщения
+    # в чате оператора, forwarded_ids — копии у пользователя (если альбом отправил оператор)
+    __slots__ = ("ts", "items", "sender", "message_ids", "forwarded_ids")
+    kind = 'Альбом'
+
+    def __init__(self, items, sender, message_ids, forwarded_ids=(), ts=None):
+        self.ts = ts if ts is not None else time.time()
+        self.items = [tuple(item) for item in items]
+        self.sender = sender
+        self.message_ids = list(message_ids)
+        self.forwarded_ids = list(forwarded_ids)
+
+    @property
+    def caption(self):
+        captions = [caption for _, _, caption in self.items if caption]
+        return f"{len(self.items)} шт." + (f", {' / '.join(captions)}" if captions else "")
+
+    @property
+    def message_id(self):
+        return self.message_ids[0] if self.message_ids else None
+
+    def size(self):
+        return (sys.getsizeof(self) + sys.getsizeof(self.items) + sys.getsizeof(self.message_ids)
+                + sys.getsizeof(self.forwarded_ids)
+                + sum(sys.getsizeof(file_id) + sys.getsizeof(caption) for _, file_id, caption in self.items))
+
+    def operator_message_ids(self):
+        return list(self.message_ids)
+
+    def user_message_ids(self):
+        return list(self.forwarded_ids) if self.sender == 'operator' else []
+
+    def to_state(self):
+        return {"album": self.items, "sender": self.sender, "message_ids": self.message_ids,
+                "forwarded_ids": self.forwarded_ids, "ts": self.ts}
+
+
+def media_from_state(item):
+    if isinstance(item, dict):
+        return MediaAlbum(item["album"], item["sender"], item["message_ids"], item["forwarded_ids"], item["ts"])
+    return MediaRecord(*item)
+
+
+class Conversation:
+    __slots__ = ("request_id", "user_id", "username", "language", "assigned_operator", "operator_name",
+                 "operator_messages", "additional_operator_messages", "media_files", "dropped_media", "created_at",
+                 "last_activity", "notified_at", "first_response_at", "history", "history_bytes", "spilled_count",
+                 "spill_path", "spill_pending", "spill_lock", "closed")
+
+    def __init__(self, request_id, user_id, username, language, created_at):
+        self.request_id = request_id
+        self.user_id = user_id
+        self.username = username
+        self.language = language
+        self.assigned_operator = None
+        self.operator_name = None
+        # Уведомление о запросе у каждого оператора: не больше одного на оператора
+        self.operator_messages = {}
+        # (chat_id, message_id) служебных сообщений, которые удаляются по завершении чата
+        self.additional_operator_messages = []
+        self.media_files = []
+        self.dropped_media = 0
+        self.created_at = created_at
+        self.last_activity = created_at
+        # Время последнего напоминания операторам и первого ответа оператора (по часам цикла событий)
+        self.notified_at = created_at
+        self.first_response_at = None
+        self.history = []
+        self.history_bytes = 0
+        self.spilled_count = 0
+        self.spill_path = None
+        # Сообщения, вынутые из хвоста, но ещё не записанные в файл
+        self.spill_pending = []
+        self.spill_lock = threading.Lock()
+        self.closed = False
+
+    def track_message(self, chat_id, message_id):
+        self.additional_operator_messages.append((chat_id, message_id))
+        if len(self.additional_operator_messages) > MAX_TRACKED_MESSAGES:
+            del self.additional_operator_messages[:-MAX_TRACKED_MESSAGES]
+
+    def add_media(self, media):
+        self.media_files.append(media)
+        if len(self.media_files) > MAX_MEDIA_FILES:
+            self.dropped_media += len(self.media_files) - MAX_MEDIA_FILES
+            del self.media_files[:-MAX_MEDIA_FILES]
+
+    def add_message(self, sender, content, ts=None):
+        message = Message(ts if ts is not None else time.time(), sender, content)
+        self.history.append(message)
+        self.history_bytes += message.size()
+        if len(self.history) > HISTORY_TAIL or self.history_bytes > MAX_CONVERSATION_BYTES:
+            self.spill()
+        return message
+
+    def spill(self):
+        # Старая половина хвоста уходит в очередь записи; в памяти остаётся не больше HISTORY_TAIL // 2
+        # сообщений. Файл дописывается в потоке, чтобы диск не задерживал цикл событий
+        keep = max(1, min(HISTORY_TAIL // 2, len(self.history) - 1))
+        old, self.history = self.history[:-keep], self.history[-keep:]
+        if not old:
+            return
+        with self.spill_lock:
+            self.spill_pending.extend(old)
+        self.spilled_count += len(old)
+        self.history_bytes = sum(message.size() for message in self.history)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_spill()
+            return
+        task = loop.create_task(asyncio.to_thread(self.flush_spill))
+        _spill_tasks.add(task)
+        task.add_done_callback(_spill_tasks.discard)
+
+    def flush_spill(self):
+        # Запись под блокировкой: очередь забирается целиком, порядок сообщений в файле сохраняется
+        with self.spill_lock:
+            pending, self.spill_pending = self.spill_pending, []
+            if self.closed or not pending:
+                return
+            if self.spill_path is None:
+                os.makedirs(SPILL_DIR, exist_ok=True)
+                self.spill_path = os.path.join(SPILL_DIR, f"{self.request_id}.jsonl")
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for message in pending:
+                    f.write(json.dumps([message.ts, message.sender, message.content], ensure_ascii=False) + "\n")
+
+    def iter_history(self):
+        # Файл и ещё не записанная очередь читаются под одной блокировкой, чтобы запись в потоке
+        # не потеряла и не повторила сообщения
+        with self.spill_lock:
+            spilled = []
+            if self.spill_path and os.path.exists(self.spill_path):
+                with open(self.spill_path, encoding="utf-8") as f:
+                    for line in f:
+                        ts, sender, content = json.loads(line)
+                        spilled.append(Message(ts, sender, content))
+            spilled.extend(self.spill_pending)
+        yield from spilled
+        yield from self.history
+
+    def recent_text(self):
+        return "\n".join(message.content for message in self.history)
+
+    def message_count(self):
+        return self.spilled_count + len(self.history)
+
+    def memory_usage(self):
+        total = sys.getsizeof(self) + self.history_bytes + sys.getsizeof(self.history)
+        total += sum(message.size() for message in list(self.spill_pending))
+        total += sys.getsizeof(self.operator_messages) + sys.getsizeof(self.additional_operator_messages)
+        total += sum(sys.getsizeof(item) for item in self.additional_operator_messages)
+        total += sys.getsizeof(self.media_files) + sum(media.size() for media in self.media_files)
+        return total
+
+    def to_state(self, loop_now):
+        # Снимок для передачи следующему экземпляру бота. Времена created_at/last_activity идут по часам
+        # цикла событий, которые у нового процесса другие, поэтому сохраняется их возраст
+        return {
+            "request_id": self.request_id,
+            "user_id": self.user_id,
+            "username": self.username,
+            "language": self.language,
+            "assigned_operator": self.assigned_operator,
+            "operator_name": self.operator_name,
+            "operator_messages": list(self.operator_messages.items()),
+            "additional_operator_messages": self.additional_operator_messages,
+            "media_files": [media.to_state() for media in self.media_files],
+            "dropped_media": self.dropped_media,
+            "created_age": loop_now - self.created_at,
+            "activity_age": loop_now - self.last_activity,
+            "notified_age": loop_now - self.notified_at,
+            "first_response_age": None if self.first_response_at is None else loop_now - self.first_response_at,
+            "history": [[message.ts, message.sender, message.content] for message in self.iter_history()],
+        }
+
+    @classmethod
+    def from_state(cls, state, loop_now):
+        conv = cls(state["request_id"], state["user_id"], state["username"], state["language"],
+                   loop_now - state["created_age"])
+        conv.assigned_operator = state["assigned_operator"]
+        conv.operator_name = state["operator_name"]
+        conv.operator_messages = {op_id: msg_id for op_id, msg_id in state["operator_messages"]}
+        for chat_id, message_id in state["additional_operator_messages"]:
+            conv.track_message(chat_id, message_id)
+        for item in state["media_files"]:
+            conv.add_media(media_from_state(item))
+        conv.dropped_media += state.get("dropped_media", 0)
+        conv.last_activity = loop_now - state["activity_age"]
+        conv.notified_at = loop_now - state["notified_age"]
+        if state["first_response_age"] is not None:
+            conv.first_response_at = loop_now - state["first_response_age"]
+        for ts, sender, content in state["history"]:
+            conv.add_message(sender, content, ts=ts)
+        return conv
+
+    def close(self):
+        with self.spill_lock:
+            self.closed = True
+            self.spill_pending = []
+            if self.spill_path and os.path.exists(self.spill_path):
+                os.unlink(self.spill_path)
+            self.spill_path = None
@@ -0,0 +1,214 @@
+# Журнал действий пользователей: нажатия кнопок, этапы чата поддержки, доставка рассылок.
+# record() только кладёт событие в кольцевой буфер в памяти; фоновый поток пишет буфер в
+# таблицу events пачками, а периодическая свёртка собирает дневные агрегаты для /stats
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+import metrics
+import storage
+
+logger = logging.getLogger(__name__)
+
+EVENTS_BUFFER_SIZE = int(os.getenv("EVENTS_BUFFER_SIZE", 100000))
+EVENTS_FLUSH_BATCH = int(os.getenv("EVENTS_FLUSH_BATCH", 2000))
+EVENTS_FLUSH_INTERVAL = float(os.getenv("EVENTS_FLUSH_INTERVAL", 5))
+EVENTS_RETENTION_DAYS = int(os.getenv("EVENTS_RETENTION_DAYS", 30))
+ROLLUP_BATCH = 50000
+
+MENU_POSTS = ("about", "earn", "withdraw", "rules")
+FUNNEL_STEPS = ("start", "menu", "register")
+
+RECORDED = metrics.counter("tango_events_total", "Interaction events recorded", ("kind",))
+DROPPED = metrics.counter("tango_events_dropped_total", "Events lost because the buffer was full or a flush failed")
+FLUSH_LATENCY = metrics.histogram("tango_events_flush_seconds", "Event batch flush latency")
+
+_buffer = deque(maxlen=EVENTS_BUFFER_SIZE)
+_wake = threading.Event()
+_stopped = threading.Event()
+_flusher = None
+
+metrics.gauge("tango_events_buffered", "Events waiting to be flushed", (), lambda: {(): len(_buffer)})
+
+
+def init_events():
+    conn = sqlite3.connect(storage.DB_PATH)
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ts REAL,
+                    kind TEXT,
+                    user_id INTEGER,
+                    name TEXT,
+                    value REAL
+                 )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_events_ts ON events (ts)")
+    # Дневные агрегаты: число событий и сумма value (например, секунд ожидания) по виду и имени
+    c.execute('''CREATE TABLE IF NOT EXISTS event_daily (
+                    day TEXT,
+                    kind TEXT,
+                    name TEXT,
+                    n INTEGER,
+                    total REAL,
+                    PRIMARY KEY (day, kind, name)
+                 ) WITHOUT ROWID''')
+    # Уникальные пользователи по дням и шагам воронки; шаг "active" — любое действие пользователя
+    c.execute('''CREATE TABLE IF NOT EXISTS event_users (
+                    day TEXT,
+                    step TEXT,
+                    user_id INTEGER,
+                    PRIMARY KEY (day, step, user_id)
+                 ) WITHOUT ROWID''')
+    c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('events_rollup_id', 0)")
+    conn.commit()
+    conn.close()
+
+
+def record(kind, user_id=None, name="", value=None):
+    if len(_buffer) == _buffer.maxlen:
+        DROPPED.inc()
+    _buffer.append((time.time(), kind, user_id, name, value))
+    RECORDED.inc(kind=kind)
+    if len(_buffer) >= EVENTS_FLUSH_BATCH:
+        _wake.set()
+
+
+def flush():
+    batch = []
+    while len(batch) < ROLLUP_BATCH:
+        try:
+            batch.append(_buffer.popleft())
+        except IndexError:
+            break
+    if not batch:
+        return 0
+    with FLUSH_LATENCY.time():
+        try:
+            conn = sqlite3.connect(storage.DB_PATH)
+            try:
+                with conn:
+                    conn.executemany("INSERT INTO events (ts, kind, user_id, name, value) VALUES (?, ?, ?, ?, ?)", batch)
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.error(f"Failed to flush {len(batch)} events: {e}")
+            DROPPED.inc(len(batch))
+            return 0
+    return len(batch)
+
+
+def _flush_loop():
+    while not _stopped.is_set():
+        _wake.wait(EVENTS_FLUSH_INTERVAL)
+        _wake.clear()
+        while flush() >= ROLLUP_BATCH:
+            pass
+
+
+def start():
+    global _flusher
+    if _flusher is not None:
+        return
+    _flusher = threading.Thread(target=_flush_loop, name="events-flusher", daemon=True)
+    _flusher.start()
+    atexit.register(stop)
+
+
+def stop():
+    global _flusher
+    if _flusher is None:
+        return
+    _stopped.set()
+    _wake.set()
+    _flusher.join(timeout=10)
+    _flusher = None
+    while flush():
+        pass
+
+
+def rollup():
+    # Обрабатывает события, записанные после прошлой свёртки; повторный запуск ничего не удвоит,
+    # потому что граница (events_rollup_id) сдвигается в той же транзакции
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        with conn:
+            last_id = conn.execute("SELECT value FROM meta WHERE key = 'events_rollup_id'").fetchone()[0]
+            upper = conn.execute("SELECT MAX(id) FROM events WHERE id <= ?", (last_id + ROLLUP_BATCH,)).fetchone()[0]
+            if upper is None or upper <= last_id:
+                return 0
+            bounds = (last_id, upper)
+            conn.execute('''INSERT INTO event_daily (day, kind, name, n, total)
+                            SELECT date(ts, 'unixepoch', 'localtime'), kind, name, COUNT(*), TOTAL(value)
+                            FROM events WHERE id > ? AND id <= ? GROUP BY 1, 2, 3
+                            ON CONFLICT (day, kind, name) DO UPDATE SET n = n + excluded.n, total = total + excluded.total''',
+                         bounds)
+            conn.execute('''INSERT OR IGNORE INTO event_users (day, step, user_id)
+                            SELECT DISTINCT date(ts, 'unixepoch', 'localtime'), 'active', user_id
+                            FROM events WHERE id > ? AND id <= ? AND user_id IS NOT NULL AND kind != 'broadcast' ''',
+                         bounds)
+            conn.execute(f'''INSERT OR IGNORE INTO event_users (day, step, user_id)
+                             SELECT DISTINCT day, step, user_id FROM (
+                                 SELECT date(ts, 'unixepoch', 'localtime') AS day, user_id, CASE
+                                     WHEN kind = 'start' THEN 'start'
+                                     WHEN kind = 'button' AND name IN ({",".join("?" * len(MENU_POSTS))}) THEN 'menu'
+                                     WHEN kind = 'register' THEN 'register'
+                                     WHEN kind = 'support' AND name = 'requested' THEN 'support'
+                                 END AS step
+                                 FROM events WHERE id > ? AND id <= ? AND user_id IS NOT NULL
+                             ) WHERE step IS NOT NULL''',
+                         (*MENU_POSTS, *bounds))
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'events_rollup_id'", (upper,))
+            # Сырые события нужны только до свёртки; храним их ограниченное время для разборов
+            cutoff = time.time() - EVENTS_RETENTION_DAYS * 86400
+            conn.execute("DELETE FROM events WHERE ts < ? AND id <= ?", (cutoff, upper))
+        return upper - last_id
+    finally:
+        conn.close()
+
+
+def _since(days):
+    return (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+
+
+def daily_active(days=7):
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        return conn.execute("SELECT day, COUNT(*) FROM event_users WHERE step = 'active' AND day >= ? "
+                            "GROUP BY day ORDER BY day", (_since(days),)).fetchall()
+    finally:
+        conn.close()
+
+
+def funnel(days=7, steps=FUNNEL_STEPS):
+    # Для каждого шага — число пользователей, прошедших его и все предыдущие шаги за период
+    since = _since(days)
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        result = []
+        for i, step in enumerate(steps):
+            prefix = steps[:i + 1]
+            count = conn.execute(f'''SELECT COUNT(*) FROM (
+                                         SELECT user_id FROM event_users
+                                         WHERE day >= ? AND step IN ({",".join("?" * len(prefix))})
+                                         GROUP BY user_id HAVING COUNT(DISTINCT step) = ?)''',
+                                 (since, *prefix, len(prefix))).fetchone()[0]
+            result.append((step, count))
+        return result
+    finally:
+        conn.close()
+
+
+def totals(kind, days=7):
+    # {name: (число событий, сумма value)} за период
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        rows = conn.execute("SELECT name, SUM(n), SUM(total) FROM event_daily WHERE kind = ? AND day >= ? GROUP BY name",
+                            (kind, _since(days))).fetchall()
+    finally:
+        conn.close()
+    return {name: (n, total) for name, n, total in rows}
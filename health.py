@@ -0,0 +1,126 @@
+# Проверки здоровья для /healthz (процесс жив и цикл бота работает) и /readyz (можно
+# принимать трафик: кроме живости — база, очереди, переводчик). Каждая проверка возвращает
+# (статус, подробности); статус "fail" у любой проверки даёт ответ 503
+import logging
+import os
+import sqlite3
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+HEALTH_MAX_LOOP_LAG = float(os.getenv("HEALTH_MAX_LOOP_LAG", 2.0))
+HEALTH_JOB_GRACE = float(os.getenv("HEALTH_JOB_GRACE", 3))
+HEALTH_MAX_DB_LATENCY = float(os.getenv("HEALTH_MAX_DB_LATENCY", 0.5))
+HEALTH_MAX_QUEUE_DEPTH = int(os.getenv("HEALTH_MAX_QUEUE_DEPTH", 1000))
+HEALTH_MAX_INFLIGHT = int(os.getenv("HEALTH_MAX_INFLIGHT", 200))
+
+CHECK_FAILURES = metrics.counter("tango_health_check_failures_total", "Failed health checks", ("check",))
+
+# Имя задачи -> (интервал, время последнего запуска, начало текущего выполнения или None) по time.monotonic()
+_jobs = {}
+_liveness = {}
+_readiness = {}
+
+
+def liveness_check(name):
+    def decorator(func):
+        _liveness[name] = func
+        return func
+    return decorator
+
+
+def readiness_check(name):
+    def decorator(func):
+        _readiness[name] = func
+        return func
+    return decorator
+
+
+def expect_job(name, interval):
+    _jobs[name] = (interval, time.monotonic(), None)
+
+
+def job_started(name):
+    # Отметка ставится в начале выполнения: долгое выполнение само по себе не делает задачу зависшей,
+    # а пропущенные из-за него запуски (у задачи не больше одного выполнения сразу) — делают
+    if name in _jobs:
+        now = time.monotonic()
+        _jobs[name] = (_jobs[name][0], now, now)
+
+
+def job_finished(name):
+    if name in _jobs:
+        interval, last_run, _ = _jobs[name]
+        _jobs[name] = (interval, last_run, None)
+
+
+def check_jobs():
+    # Задача считается зависшей, если не запускалась дольше HEALTH_JOB_GRACE интервалов
+    now = time.monotonic()
+    details = {}
+    status = "ok"
+    for name, (interval, last_run, running_since) in list(_jobs.items()):
+        age = now - last_run
+        stale = age > interval * HEALTH_JOB_GRACE
+        details[name] = {"seconds_since_run": round(age, 1), "interval": interval, "stale": stale}
+        if running_since is not None:
+            details[name]["running_seconds"] = round(now - running_since, 1)
+        if stale:
+            status = "fail"
+    return status, details
+
+
+def check_loop(monitor):
+    lag = monitor.current_lag()
+    if lag is None:
+        return "fail", {"error": "event loop monitor is not running"}
+    return ("fail" if lag > HEALTH_MAX_LOOP_LAG else "ok"), {"lag_seconds": round(lag, 3),
+                                                             "threshold": HEALTH_MAX_LOOP_LAG}
+
+
+def check_db(path="users.db"):
+    start = time.perf_counter()
+    try:
+        conn = sqlite3.connect(path, timeout=HEALTH_MAX_DB_LATENCY)
+        try:
+            conn.execute("SELECT 1 FROM users LIMIT 1").fetchall()
+        finally:
+            conn.close()
+    except Exception as e:
+        return "fail", {"error": str(e)}
+    latency = time.perf_counter() - start
+    return ("fail" if latency > HEALTH_MAX_DB_LATENCY else "ok"), {"latency_seconds": round(latency, 4),
+                                                                   "threshold": HEALTH_MAX_DB_LATENCY}
+
+
+def check_queues(update_queue_depth):
+    inflight = metrics.BOT_API_INFLIGHT.value()
+    degraded = update_queue_depth > HEALTH_MAX_QUEUE_DEPTH or inflight > HEALTH_MAX_INFLIGHT
+    return ("fail" if degraded else "ok"), {"update_queue": update_queue_depth, "bot_api_inflight": inflight,
+                                            "max_update_queue": HEALTH_MAX_QUEUE_DEPTH,
+                                            "max_inflight": HEALTH_MAX_INFLIGHT}
+
+
+def run(checks):
+    results = {}
+    healthy = True
+    for name, check in checks.items():
+        try:
+            status, details = check()
+        except Exception as e:
+            status, details = "fail", {"error": str(e)}
+        if status == "fail":
+            healthy = False
+            CHECK_FAILURES.inc(check=name)
+        results[name] = {"status": status, **details}
+    return healthy, {"status": "ok" if healthy else "fail", "checks": results}
+
+
+def liveness():
+    return run(_liveness)
+
+
+def readiness():
+    return run({**_liveness, **_readiness})
@@ -0,0 +1,226 @@
+# Общий асинхронный HTTP-клиент для исходящих запросов: Bot API и загрузка картинок постов.
+# Исключение — переводчик: deep_translator работает через requests в потоках asyncio.to_thread
+# со своими соединениями, мимо этих пулов.
+# На каждый хост — свой пул соединений с keep-alive, лимитами и таймаутами; HTTP/2, если установлен h2;
+# адреса хостов кэшируются, чтобы не резолвить DNS на каждое новое соединение
+import asyncio
+import importlib.util
+import logging
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpcore
+import httpx
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+HTTP2 = os.getenv("HTTP2", "1") == "1" and HTTP2_AVAILABLE
+DNS_CACHE_TTL = float(os.getenv("DNS_CACHE_TTL", 300))
+
+
+class HostSettings:
+    __slots__ = ("max_connections", "max_keepalive", "timeout")
+
+    def __init__(self, max_connections, max_keepalive, timeout):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.timeout = timeout
+
+
+DEFAULT_SETTINGS = HostSettings(10, 5, 10.0)
+HOST_SETTINGS = {
+    "api.telegram.org": HostSettings(256, 64, 30.0),
+}
+
+
+def parse_host_settings(value):
+    # HTTP_HOST_LIMITS="api.telegram.org=256/30,i.postimg.cc=20/15": хост=соединений/таймаут
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        try:
+            host, spec = item.split("=")
+            connections, timeout = spec.split("/")
+            HOST_SETTINGS[host] = HostSettings(int(connections), max(1, int(connections) // 4), float(timeout))
+        except ValueError:
+            logger.warning(f"Cannot parse HTTP_HOST_LIMITS entry: {item}")
+
+
+parse_host_settings(os.getenv("HTTP_HOST_LIMITS", ""))
+
+REQUESTS = metrics.counter("tango_http_requests_total", "Outbound HTTP requests", ("host", "status"))
+LATENCY = metrics.histogram("tango_http_request_seconds", "Outbound HTTP request latency", ("host",))
+DNS_LOOKUPS = metrics.counter("tango_dns_lookups_total", "Host name resolutions", ("result",))
+
+
+class DNSCache:
+    def __init__(self, ttl=DNS_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    async def resolve(self, host, port):
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            DNS_LOOKUPS.inc(result="hit")
+            return entry[1]
+        DNS_LOOKUPS.inc(result="miss")
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        with self._lock:
+            self._entries[key] = (now + self.ttl, addresses)
+        return addresses
+
+    def invalidate(self, host, port):
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+
+dns_cache = DNSCache()
+
+
+class CachingBackend(httpcore.AsyncNetworkBackend):
+    # Подключается к закэшированному адресу; SNI и заголовок Host httpcore берёт из URL, а не из адреса
+    def __init__(self, cache):
+        self.cache = cache
+        self.backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        try:
+            addresses = await self.cache.resolve(host, port)
+        except OSError as e:
+            raise httpcore.ConnectError(str(e))
+        error = None
+        for address in addresses:
+            try:
+                return await self.backend.connect_tcp(address, port, timeout=timeout, local_address=local_address,
+                                                      socket_options=socket_options)
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                error = e
+        self.cache.invalidate(host, port)
+        raise error or httpcore.ConnectError(f"No addresses for {host}")
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self.backend.connect_unix_socket(path, timeout=timeout, socket_options=socket_options)
+
+    async def sleep(self, seconds):
+        await self.backend.sleep(seconds)
+
+
+class PooledTransport(httpx.AsyncHTTPTransport):
+    # Транспорт httpx с пулом httpcore, который использует кэш DNS
+    def __init__(self, host, settings):
+        super().__init__(http2=HTTP2, limits=httpx.Limits(max_connections=settings.max_connections,
+                                                          max_keepalive_connections=settings.max_keepalive,
+                                                          keepalive_expiry=30.0))
+        self.host = host
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=self._pool._ssl_context,
+            max_connections=settings.max_connections,
+            max_keepalive_connections=settings.max_keepalive,
+            keepalive_expiry=30.0,
+            http1=True,
+            http2=HTTP2,
+            network_backend=CachingBackend(dns_cache),
+        )
+
+    async def handle_async_request(self, request):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = await super().handle_async_request(request)
+            status = str(response.status_code)
+            return response
+        finally:
+            LATENCY.observe(time.perf_counter() - start, host=self.host)
+            REQUESTS.inc(host=self.host, status=status)
+
+    async def aclose(self):
+        # Пул хоста общий для всех его клиентов, в том числе клиентов Bot API каждого бота, поэтому
+        # закрытие клиента (application.shutdown()) пул не закрывает; его закрывает только aclose() модуля
+        pass
+
+    async def close_pool(self):
+        await super().aclose()
+
+    def pool_stats(self):
+        connections = list(self._pool.connections)
+        idle = sum(1 for connection in connections if connection.is_idle())
+        return len(connections) - idle, idle
+
+
+_transports = {}
+_clients = {}
+_lock = threading.Lock()
+
+
+def settings_for(host):
+    return HOST_SETTINGS.get(host, DEFAULT_SETTINGS)
+
+
+def transport_for(host):
+    with _lock:
+        transport = _transports.get(host)
+        if transport is None:
+            transport = _transports[host] = PooledTransport(host, settings_for(host))
+        return transport
+
+
+def client_for(host):
+    with _lock:
+        client = _clients.get(host)
+        if client is not None and not client.is_closed:
+            return client
+    settings = settings_for(host)
+    client = httpx.AsyncClient(transport=transport_for(host), timeout=settings.timeout, follow_redirects=True)
+    with _lock:
+        _clients[host] = client
+    return client
+
+
+async def request(method, url, **kwargs):
+    return await client_for(urlsplit(url).hostname).request(method, url, **kwargs)
+
+
+async def get(url, **kwargs):
+    return await request("GET", url, **kwargs)
+
+
+# Ответ читается по частям: async with stream("GET", url) as response: async for chunk in response.aiter_bytes()
+def stream(method, url, **kwargs):
+    return client_for(urlsplit(url).hostname).stream(method, url, **kwargs)
+
+
+async def aclose():
+    # Вызывает владелец пулов один раз при остановке: tango в однобот-режиме, tenants — после всех ботов
+    with _lock:
+        clients = list(_clients.values())
+        transports = list(_transports.values())
+        _clients.clear()
+        _transports.clear()
+    for client in clients:
+        await client.aclose()
+    for transport in transports:
+        await transport.close_pool()
+
+
+def _pool_usage():
+    with _lock:
+        transports = list(_transports.items())
+    values = {}
+    for host, transport in transports:
+        active, idle = transport.pool_stats()
+        values[(host, "active")] = active
+        values[(host, "idle")] = idle
+        values[(host, "limit")] = settings_for(host).max_connections
+    return values
+
+
+metrics.gauge("tango_http_pool_connections", "Outbound connection pool usage per host", ("host", "state"), _pool_usage)
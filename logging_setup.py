@@ -0,0 +1,218 @@
+# Неблокирующее логирование: запись на диск идёт в фоновом потоке через очередь,
+# файл ротируется по размеру и по времени со сжатием, записи можно писать в JSON
+import atexit
+import contextvars
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import shutil
+from contextlib import contextmanager
+from datetime import datetime
+
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json или text
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "midnight")
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 7))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+LOG_STDERR = os.getenv("LOG_STDERR", "1") == "1"
+# Доля сохраняемых записей уровня INFO и ниже для шумных логгеров: "tango.updates=0.1,httpx=0.01"
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "tango.updates=0.1,httpx=0.01")
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Контекст текущего апдейта, который подмешивается во все записи
+_update_id = contextvars.ContextVar("update_id", default=None)
+_user_id = contextvars.ContextVar("user_id", default=None)
+_handler = contextvars.ContextVar("handler", default=None)
+
+_listener = None
+_queue_handler = None
+# (имя логгера, фильтр) — чтобы stop_logging() мог снять фильтры
+_sampling_filters = []
+
+
+@contextmanager
+def log_context(handler=None, update=None):
+    update_id = getattr(update, "update_id", None)
+    user = getattr(update, "effective_user", None)
+    tokens = [(_handler, _handler.set(handler)), (_update_id, _update_id.set(update_id)),
+              (_user_id, _user_id.set(user.id if user else None))]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.update_id = _update_id.get()
+        record.user_id = _user_id.get()
+        record.handler = _handler.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    # Оставляет долю rate записей уровня INFO и ниже; предупреждения и ошибки не отбрасываются
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or random.random() < self.rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # При переполненной очереди запись отбрасывается, а не блокирует поток обработчика
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in ("update_id", "user_id", "handler"):
+            value = getattr(record, key, None)
+            if value is not None:
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False)
+
+
+class CompressingRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    # Ротация и по времени (when), и по размеру (max_bytes); старые файлы сжимаются в .gz
+    def __init__(self, filename, max_bytes=0, when="midnight", backup_count=0, encoding="utf-8"):
+        super().__init__(filename, when=when, backupCount=backup_count, encoding=encoding)
+        self.max_bytes = max_bytes
+        self.namer = self._gz_name
+        self.rotator = self._gz_rotate
+
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes > 0 and self.stream is not None:
+            self.stream.seek(0, 2)
+            return self.stream.tell() >= self.max_bytes
+        return False
+
+    def rotation_filename(self, default_name):
+        # При ротации по размеру в течение одного интервала имя должно быть уникальным
+        name = super().rotation_filename(default_name)
+        counter = 1
+        candidate = name
+        while os.path.exists(candidate):
+            candidate = name.replace(".gz", f".{counter}.gz")
+            counter += 1
+        return candidate
+
+    def getFilesToDelete(self):
+        base = os.path.basename(self.baseFilename)
+        directory = os.path.dirname(self.baseFilename)
+        rotated = sorted(
+            (os.path.join(directory, name) for name in os.listdir(directory)
+             if name.startswith(base + ".") and name.endswith(".gz")),
+            key=os.path.getmtime)
+        if len(rotated) <= self.backupCount:
+            return []
+        return rotated[:len(rotated) - self.backupCount]
+
+    @staticmethod
+    def _gz_name(name):
+        return name + ".gz"
+
+    @staticmethod
+    def _gz_rotate(source, dest):
+        with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+
+def parse_sampling(spec):
+    rates = {}
+    for pair in spec.split(","):
+        name, _, rate = pair.strip().partition("=")
+        if not name or not rate:
+            continue
+        try:
+            rates[name] = max(0.0, min(1.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+def setup_logging():
+    global _listener, _queue_handler
+    if _listener is not None:
+        return _listener
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT)
+    file_handler = CompressingRotatingFileHandler(LOG_FILE, max_bytes=LOG_MAX_BYTES, when=LOG_ROTATE_WHEN,
+                                                  backup_count=LOG_BACKUP_COUNT)
+    file_handler.setFormatter(formatter)
+    handlers = [file_handler]
+    if LOG_STDERR:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+        handlers.append(stream_handler)
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    _queue_handler = DroppingQueueHandler(log_queue)
+    _queue_handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(_queue_handler)
+
+    for name, rate in parse_sampling(LOG_SAMPLING).items():
+        sampling_filter = SamplingFilter(rate)
+        logging.getLogger(name).addFilter(sampling_filter)
+        _sampling_filters.append((name, sampling_filter))
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    # Обработчики и фильтры снимаются, чтобы повторный setup_logging() не добавил их второй раз
+    global _listener, _queue_handler, _sampling_filters
+    if _listener is None:
+        return
+    logging.getLogger().removeHandler(_queue_handler)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    for name, sampling_filter in _sampling_filters:
+        logging.getLogger(name).removeFilter(sampling_filter)
+    _listener = None
+    _queue_handler = None
+    _sampling_filters = []
+
+
+def dropped_counts():
+    return {
+        ("queue_full",): _queue_handler.dropped if _queue_handler else 0,
+        ("sampled",): sum(f.dropped for _, f in _sampling_filters),
+    }
@@ -0,0 +1,107 @@
+# Сторож цикла событий: постоянно меряет задержку цикла и, если какой-то колбэк
+# блокирует цикл дольше порога, снимает стек потока цикла из отдельного потока
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LAG_PROBE_INTERVAL = float(os.getenv("LAG_PROBE_INTERVAL", 0.1))
+LAG_STALL_THRESHOLD = float(os.getenv("LAG_STALL_THRESHOLD", 0.5))
+LAG_REPORT_INTERVAL = float(os.getenv("LAG_REPORT_INTERVAL", 60))
+
+LAG_SECONDS = metrics.histogram("tango_event_loop_lag_seconds", "Event loop scheduling lag",
+                                buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+STALLS = metrics.counter("tango_event_loop_stalls_total", "Callbacks that blocked the event loop beyond the threshold")
+
+
+class LoopMonitor:
+    def __init__(self, interval=LAG_PROBE_INTERVAL, threshold=LAG_STALL_THRESHOLD, window=3000, keep_stalls=20):
+        self.interval = interval
+        self.threshold = threshold
+        self.samples = deque(maxlen=window)
+        self.stalls = deque(maxlen=keep_stalls)
+        self.heartbeat = None
+        self.loop = None
+        self._loop_thread_id = None
+        self._stall_reported = False
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+    def start(self, loop=None):
+        self.loop = loop or asyncio.get_running_loop()
+        self._task = self.loop.create_task(self._probe())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _probe(self):
+        self._loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        last_report = self.heartbeat
+        while not self._stopped.is_set():
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - before - self.interval)
+            self.heartbeat = now
+            self._stall_reported = False
+            self.samples.append(lag)
+            LAG_SECONDS.observe(lag)
+            if now - last_report >= LAG_REPORT_INTERVAL:
+                last_report = now
+                logger.info(f"Event loop lag: {self.format_percentiles()}")
+
+    def _watch(self):
+        # Поток-сторож не зависит от цикла, поэтому видит цикл, застрявший в блокирующем вызове
+        while not self._stopped.wait(self.interval / 2):
+            if self.heartbeat is None or self._stall_reported:
+                continue
+            blocked_for = time.monotonic() - self.heartbeat
+            if blocked_for < self.threshold:
+                continue
+            self._stall_reported = True
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "<no frame>"
+            self.stalls.append((time.time(), blocked_for, stack))
+            STALLS.inc()
+            logger.warning(f"Event loop blocked for {blocked_for:.3f}s, stack of the loop thread:\n{stack}")
+
+    def percentiles(self):
+        if not self.samples:
+            return {}
+        ordered = sorted(self.samples)
+        last = len(ordered) - 1
+        return {
+            "p50": ordered[int(last * 0.5)],
+            "p90": ordered[int(last * 0.9)],
+            "p99": ordered[int(last * 0.99)],
+            "max": ordered[last],
+        }
+
+    def format_percentiles(self):
+        values = self.percentiles()
+        if not values:
+            return "no samples"
+        return ", ".join(f"{name}={value * 1000:.1f}ms" for name, value in values.items())
+
+    def current_lag(self):
+        # Сколько цикл не отвечал на момент вызова (имеет смысл вызывать из другого потока)
+        if self.heartbeat is None:
+            return None
+        return max(0.0, time.monotonic() - self.heartbeat - self.interval)
+
+
+loop_monitor = LoopMonitor()
@@ -0,0 +1,340 @@
+# Хранилище картинок постов с адресацией по содержимому. Картинка (URL, локальный файл или фото,
+# присланное админу) загружается один раз, дубликаты определяются по SHA-256, результат
+# пережимается в JPEG под размеры фото Telegram и лежит в MEDIA_DIR. Посты хранят ссылку
+# "media:<id>" вместо URL; после первой отправки запоминается file_id, и дальше картинка
+# отправляется по нему, без загрузки файла и без обращения к исходному хосту.
+# Pillow необязателен: без него картинки хранятся как есть (дедупликация и file_id работают)
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from io import BytesIO
+from urllib.parse import urlsplit
+
+import http_client
+import metrics
+import storage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+MEDIA_DIR = os.getenv("MEDIA_DIR", "media")
+# Telegram хранит фото со стороной до 1280 px (2560 для HD), большее разрешение только увеличивает загрузку
+MEDIA_MAX_SIDE = int(os.getenv("MEDIA_MAX_SIDE", 1280))
+MEDIA_JPEG_QUALITY = int(os.getenv("MEDIA_JPEG_QUALITY", 87))
+MAX_SOURCE_BYTES = 20 * 1024 * 1024
+# Локальные картинки постов читаются только из этого каталога
+MEDIA_SOURCE_DIR = os.getenv("MEDIA_SOURCE_DIR", "images")
+# Ограничения Bot API для фото: не больше 10 МБ, сумма сторон до 10000, соотношение сторон до 20
+MAX_PHOTO_BYTES = 10 * 1024 * 1024
+MAX_PHOTO_DIMENSIONS = 10000
+MAX_ASPECT_RATIO = 20
+REF_PREFIX = "media:"
+
+INGESTED = metrics.counter("tango_media_ingested_total", "Images added to the media store", ("result",))
+MEDIA_BYTES = metrics.counter("tango_media_bytes_total", "Image bytes before and after preprocessing", ("stage",))
+PHOTO_SENDS = metrics.counter("tango_media_sends_total", "Post photos sent", ("via",))
+
+# Кэш file_id в памяти: (media_id, bot_id) -> file_id
+_file_ids = {}
+_lock = threading.Lock()
+
+
+class MediaError(ValueError):
+    pass
+
+
+class StoredMedia:
+    __slots__ = ("media_id", "path", "width", "height", "size")
+
+    def __init__(self, media_id, path, width, height, size):
+        self.media_id = media_id
+        self.path = path
+        self.width = width
+        self.height = height
+        self.size = size
+
+
+def configure(env):
+    # Каталоги бота из его настроек (см. storage.configure)
+    global MEDIA_DIR, MEDIA_SOURCE_DIR
+    MEDIA_DIR = env.get("MEDIA_DIR", "media")
+    MEDIA_SOURCE_DIR = env.get("MEDIA_SOURCE_DIR", "images")
+
+
+def init_media():
+    os.makedirs(MEDIA_DIR, exist_ok=True)
+    conn = sqlite3.connect(storage.DB_PATH)
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS media (
+                    media_id TEXT PRIMARY KEY,
+                    path TEXT,
+                    width INTEGER,
+                    height INTEGER,
+                    size INTEGER,
+                    original_size INTEGER,
+                    created_at TEXT
+                 )''')
+    # Откуда картинка уже загружалась (URL, путь, tg:<file_unique_id>), чтобы не скачивать её повторно
+    c.execute('''CREATE TABLE IF NOT EXISTS media_sources (
+                    source TEXT PRIMARY KEY,
+                    media_id TEXT
+                 )''')
+    # file_id привязан к боту, поэтому хранится отдельно для каждого
+    c.execute('''CREATE TABLE IF NOT EXISTS media_file_ids (
+                    media_id TEXT,
+                    bot_id INTEGER,
+                    file_id TEXT,
+                    PRIMARY KEY (media_id, bot_id)
+                 ) WITHOUT ROWID''')
+    conn.commit()
+    conn.close()
+
+
+def is_ref(image_path):
+    return bool(image_path) and image_path.startswith(REF_PREFIX)
+
+
+def ref(media_id):
+    return REF_PREFIX + media_id
+
+
+def media_id_of(image_path):
+    return image_path[len(REF_PREFIX):] if is_ref(image_path) else None
+
+
+def preprocess(data):
+    # (байты, ширина, высота): JPEG со стороной до MEDIA_MAX_SIDE; без Pillow — исходные байты
+    if Image is None:
+        if len(data) > MAX_PHOTO_BYTES:
+            raise MediaError(f"image is {len(data)} bytes, Telegram accepts up to {MAX_PHOTO_BYTES}")
+        return data, None, None
+    try:
+        image = Image.open(BytesIO(data))
+        image.load()
+    except Exception as e:
+        raise MediaError(f"not an image: {e}")
+    image = ImageOps.exif_transpose(image)
+    width, height = image.size
+    if max(width, height) > MAX_ASPECT_RATIO * min(width, height):
+        raise MediaError(f"aspect ratio {width}x{height} exceeds 1:{MAX_ASPECT_RATIO}")
+    if image.mode != "RGB":
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        rgba = image.convert("RGBA")
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        image = background
+    image.thumbnail((MEDIA_MAX_SIDE, MEDIA_MAX_SIDE), Image.LANCZOS)
+    buffer = BytesIO()
+    image.save(buffer, "JPEG", quality=MEDIA_JPEG_QUALITY, optimize=True, progressive=True)
+    encoded = buffer.getvalue()
+    # Уже сжатый JPEG нужного размера может оказаться меньше перекодированного
+    if (len(data) <= len(encoded) and data[:3] == b"\xff\xd8\xff" and image.size == (width, height)
+            and width + height <= MAX_PHOTO_DIMENSIONS):
+        return data, width, height
+    return encoded, image.width, image.height
+
+
+def _path_for(media_id):
+    return os.path.join(MEDIA_DIR, media_id[:2], media_id)
+
+
+def _row_to_media(row):
+    return StoredMedia(*row) if row else None
+
+
+def get(media_id):
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        row = conn.execute("SELECT media_id, path, width, height, size FROM media WHERE media_id = ?",
+                           (media_id,)).fetchone()
+    finally:
+        conn.close()
+    return _row_to_media(row)
+
+
+def lookup_source(source):
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        row = conn.execute("SELECT media_id FROM media_sources WHERE source = ?", (source,)).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+def ingest_bytes(data, source=None):
+    # Идентификатор — хэш исходных байтов: одна и та же картинка из разных источников хранится один раз
+    media_id = hashlib.sha256(data).hexdigest()
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        exists = conn.execute("SELECT 1 FROM media WHERE media_id = ?", (media_id,)).fetchone()
+        if exists is None:
+            stored, width, height = preprocess(data)
+            path = _path_for(media_id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(stored)
+            os.replace(tmp_path, path)
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO media (media_id, path, width, height, size, original_size, created_at) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (media_id, path, width, height, len(stored), len(data),
+                              datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            INGESTED.inc(result="new")
+            MEDIA_BYTES.inc(len(data), stage="original")
+            MEDIA_BYTES.inc(len(stored), stage="stored")
+            logger.info(f"Media {media_id[:12]} stored: {len(data)} -> {len(stored)} bytes")
+        else:
+            INGESTED.inc(result="duplicate")
+        if source:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO media_sources (source, media_id) VALUES (?, ?)", (source, media_id))
+    finally:
+        conn.close()
+    return media_id
+
+
+def read_local_source(source):
+    path = os.path.realpath(source)
+    root = os.path.realpath(MEDIA_SOURCE_DIR)
+    if os.path.commonpath([path, root]) != root:
+        raise MediaError(f"{source} is outside {MEDIA_SOURCE_DIR}")
+    if os.path.getsize(path) > MAX_SOURCE_BYTES:
+        raise MediaError(f"image at {source} is larger than {MAX_SOURCE_BYTES} bytes")
+    with open(path, "rb") as f:
+        data = f.read(MAX_SOURCE_BYTES + 1)
+    if len(data) > MAX_SOURCE_BYTES:
+        raise MediaError(f"image at {source} is larger than {MAX_SOURCE_BYTES} bytes")
+    return data
+
+
+async def fetch_source(source):
+    if urlsplit(source).scheme not in ("http", "https"):
+        return await asyncio.to_thread(read_local_source, source)
+    # Тело читается по частям и загрузка прерывается, как только превышен MAX_SOURCE_BYTES
+    async with http_client.stream("GET", source) as response:
+        response.raise_for_status()
+        length = response.headers.get("Content-Length", "")
+        if length.isdigit() and int(length) > MAX_SOURCE_BYTES:
+            raise MediaError(f"image at {source} is larger than {MAX_SOURCE_BYTES} bytes")
+        data = bytearray()
+        async for chunk in response.aiter_bytes():
+            data += chunk
+            if len(data) > MAX_SOURCE_BYTES:
+                raise MediaError(f"image at {source} is larger than {MAX_SOURCE_BYTES} bytes")
+    return bytes(data)
+
+
+async def resolve(image_path):
+    # media_id для ссылки "media:<id>", URL или пути; ранее загруженные источники не скачиваются повторно
+    media_id = media_id_of(image_path)
+    if media_id is not None:
+        return media_id
+    media_id = await asyncio.to_thread(lookup_source, image_path)
+    if media_id is not None:
+        return media_id
+    data = await fetch_source(image_path)
+    return await asyncio.to_thread(ingest_bytes, data, image_path)
+
+
+async def ingest_telegram_photo(bot, photo):
+    # Фото, присланное боту: file_id этого бота известен сразу, загружать картинку заново не нужно
+    source = f"tg:{photo.file_unique_id}"
+    media_id = await asyncio.to_thread(lookup_source, source)
+    if media_id is None:
+        telegram_file = await bot.get_file(photo.file_id)
+        data = bytes(await telegram_file.download_as_bytearray())
+        media_id = await asyncio.to_thread(ingest_bytes, data, source)
+    await asyncio.to_thread(remember_file_id, media_id, bot.id, photo.file_id)
+    return media_id
+
+
+def file_id(media_id, bot_id):
+    key = (media_id, bot_id)
+    with _lock:
+        if key in _file_ids:
+            return _file_ids[key]
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        row = conn.execute("SELECT file_id FROM media_file_ids WHERE media_id = ? AND bot_id = ?", key).fetchone()
+    finally:
+        conn.close()
+    with _lock:
+        _file_ids[key] = row[0] if row else None
+    return row[0] if row else None
+
+
+def remember_file_id(media_id, bot_id, value):
+    with _lock:
+        _file_ids[(media_id, bot_id)] = value
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO media_file_ids (media_id, bot_id, file_id) VALUES (?, ?, ?)",
+                         (media_id, bot_id, value))
+    finally:
+        conn.close()
+
+
+def forget_file_id(media_id, bot_id):
+    with _lock:
+        _file_ids.pop((media_id, bot_id), None)
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        with conn:
+            conn.execute("DELETE FROM media_file_ids WHERE media_id = ? AND bot_id = ?", (media_id, bot_id))
+    finally:
+        conn.close()
+
+
+def read(media_id):
+    stored = get(media_id)
+    if stored is None:
+        raise MediaError(f"media {media_id} not found")
+    with open(stored.path, "rb") as f:
+        return f.read()
+
+
+def photo_input(media_id, bot_id):
+    # file_id, если картинка уже загружалась этим ботом, иначе байты из хранилища
+    cached = file_id(media_id, bot_id)
+    if cached is not None:
+        PHOTO_SENDS.inc(via="file_id")
+        return cached
+    PHOTO_SENDS.inc(via="upload")
+    return read(media_id)
+
+
+def migrate_image_paths():
+    # Источники, уже известные хранилищу, заменяются ссылками в posts и scheduled_posts
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        with conn:
+            changed = 0
+            for table in ("posts", "scheduled_posts"):
+                changed += conn.execute(
+                    f"UPDATE {table} SET image_path = '{REF_PREFIX}' || "
+                    f"(SELECT media_id FROM media_sources s WHERE s.source = {table}.image_path) "
+                    f"WHERE image_path IN (SELECT source FROM media_sources)").rowcount
+        return changed
+    finally:
+        conn.close()
+
+
+def legacy_image_paths():
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        rows = conn.execute(f"SELECT image_path FROM posts WHERE image_path IS NOT NULL AND image_path != '' "
+                            f"AND image_path NOT LIKE '{REF_PREFIX}%' UNION "
+                            f"SELECT image_path FROM scheduled_posts WHERE image_path IS NOT NULL AND image_path != '' "
+                            f"AND image_path NOT LIKE '{REF_PREFIX}%'").fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows]
@@ -0,0 +1,268 @@
+# Метрики бота в формате Prometheus (без внешних зависимостей)
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from telegram.request import HTTPXRequest
+
+from logging_setup import log_context
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(name, "") for name in self.labelnames), 0)
+
+    def collect(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in sorted(items)]
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), function=None):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        # function() возвращает число или словарь {кортеж меток: число} и вызывается при сборе
+        self._function = function
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(name, "") for name in self.labelnames), 0)
+
+    def set_function(self, function):
+        self._function = function
+
+    def collect(self):
+        with self._lock:
+            items = dict(self._values)
+        if self._function is not None:
+            try:
+                result = self._function()
+            except Exception:
+                result = None
+            if isinstance(result, dict):
+                items.update(result)
+            elif result is not None:
+                items[()] = result
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in sorted(items.items())]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self):
+        with self._lock:
+            items = [(key, (list(s[0]), s[1], s[2])) for key, s in self._series.items()]
+        lines = []
+        for key, (bucket_counts, total, count) in sorted(items):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def counter(name, help_text, labelnames=()):
+    return REGISTRY.register(Counter(name, help_text, labelnames))
+
+
+def gauge(name, help_text, labelnames=(), function=None):
+    return REGISTRY.register(Gauge(name, help_text, labelnames, function))
+
+
+def histogram(name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help_text, labelnames, buckets))
+
+
+def render():
+    return REGISTRY.render()
+
+
+# Метрики обработчиков, БД, переводов и Bot API
+HANDLER_CALLS = counter("tango_handler_calls_total", "Handler invocations", ("handler", "route", "status"))
+HANDLER_LATENCY = histogram("tango_handler_latency_seconds", "Handler latency", ("handler", "route"))
+DB_CALLS = counter("tango_db_calls_total", "SQLite calls", ("query", "status"))
+DB_LATENCY = histogram("tango_db_latency_seconds", "SQLite call latency", ("query",))
+TRANSLATION_CALLS = counter("tango_translation_calls_total", "Translation calls", ("target", "status"))
+TRANSLATION_LATENCY = histogram("tango_translation_latency_seconds", "Translation call latency", ("target",))
+BOT_API_CALLS = counter("tango_bot_api_calls_total", "Outbound Bot API calls", ("method", "status"))
+BOT_API_LATENCY = histogram("tango_bot_api_latency_seconds", "Outbound Bot API call latency", ("method",))
+BOT_API_INFLIGHT = gauge("tango_bot_api_inflight", "Outbound Bot API calls in flight")
+
+
+def instrument_handler(handler_name, route=None):
+    # route(*args) -> метка маршрута (например, для callback_data в button)
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            route_label = ""
+            if route is not None:
+                try:
+                    route_label = route(*args)
+                except Exception:
+                    route_label = "unknown"
+            start = time.perf_counter()
+            status = "ok"
+            try:
+                with log_context(handler_name, args[0] if args else None):
+                    return await func(*args, **kwargs)
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                HANDLER_LATENCY.observe(time.perf_counter() - start, handler=handler_name, route=route_label)
+                HANDLER_CALLS.inc(handler=handler_name, route=route_label, status=status)
+        return wrapper
+    return decorator
+
+
+def timed_db(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - start, query=func.__name__)
+            DB_CALLS.inc(query=func.__name__, status=status)
+    return wrapper
+
+
+def bot_api_method(url):
+    # Метка вызова Bot API: имя метода из /bot<токен>/<метод>; скачивание файлов (/file/bot<токен>/<путь>)
+    # и прочие адреса получают общую метку, чтобы пути файлов не попадали в метрики
+    parts = urlsplit(url).path.strip("/").split("/")
+    if parts[0] == "file":
+        return "file"
+    if len(parts) >= 2 and parts[-2].startswith("bot"):
+        return parts[-1]
+    return "other"
+
+
+class InstrumentedRequest(HTTPXRequest):
+    # HTTPXRequest, который считает вызовы Bot API и их задержку по имени метода
+    # и ходит через общий пул соединений http_client (транспорт передаётся через публичный httpx_kwargs)
+    def __init__(self, *args, **kwargs):
+        import http_client
+        httpx_kwargs = kwargs.pop("httpx_kwargs", None) or {}
+        httpx_kwargs.setdefault("transport", http_client.transport_for("api.telegram.org"))
+        super().__init__(*args, httpx_kwargs=httpx_kwargs, **kwargs)
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = bot_api_method(url)
+        BOT_API_INFLIGHT.inc()
+        start = time.perf_counter()
+        status = "error"
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        finally:
+            BOT_API_INFLIGHT.dec()
+            BOT_API_LATENCY.observe(time.perf_counter() - start, method=api_method)
+            BOT_API_CALLS.inc(method=api_method, status=status)
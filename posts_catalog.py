@@ -0,0 +1,76 @@
+# Каталог постов меню (about/earn/withdraw/rules) в памяти. Каталог неизменяемый и
+# подменяется целиком: при правке через админку или при изменении таблицы posts на диске
+# (счётчик posts_version в таблице meta увеличивают триггеры)
+import logging
+import sqlite3
+import threading
+from types import MappingProxyType
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+FALLBACK_LANGUAGES = ("en", "ru")
+NOT_FOUND = ("Post not found.", None)
+
+
+class PostsCatalog:
+    __slots__ = ("version", "posts", "by_type")
+
+    def __init__(self, version, rows):
+        self.version = version
+        posts = {}
+        by_type = {}
+        for post_type, language, text, image_path in rows:
+            posts[(post_type, language)] = (text, image_path)
+            by_type.setdefault(post_type, (text, image_path))
+        self.posts = MappingProxyType(posts)
+        self.by_type = MappingProxyType(by_type)
+
+    def get(self, post_type, language):
+        post = self.posts.get((post_type, language))
+        if post is not None:
+            return post
+        for fallback in FALLBACK_LANGUAGES:
+            post = self.posts.get((post_type, fallback))
+            if post is not None:
+                return post
+        return self.by_type.get(post_type, NOT_FOUND)
+
+
+_catalog = None
+_reload_lock = threading.Lock()
+
+
+def read_version(conn):
+    row = conn.execute("SELECT value FROM meta WHERE key = 'posts_version'").fetchone()
+    return row[0] if row else 0
+
+
+def load():
+    global _catalog
+    with _reload_lock:
+        conn = sqlite3.connect(storage.DB_PATH)
+        try:
+            version = read_version(conn)
+            rows = conn.execute("SELECT post_type, language, text, image_path FROM posts ORDER BY id").fetchall()
+        finally:
+            conn.close()
+        _catalog = PostsCatalog(version, rows)
+    logger.info(f"Posts catalog loaded: {len(rows)} posts, version {version}")
+    return _catalog
+
+
+def current():
+    return _catalog if _catalog is not None else load()
+
+
+def refresh_if_changed():
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        version = read_version(conn)
+    finally:
+        conn.close()
+    if _catalog is None or version != _catalog.version:
+        return load()
+    return _catalog
@@ -0,0 +1,106 @@
+# Декларативный маршрутизатор callback_data: точные совпадения ищутся в словаре,
+# префиксы ("reply_*") — в префиксном дереве, поэтому поиск не зависит от числа маршрутов
+import logging
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_CALLS = metrics.counter("tango_callback_calls_total", "Callback query routes", ("route", "status"))
+CALLBACK_LATENCY = metrics.histogram("tango_callback_latency_seconds", "Callback query route latency", ("route",))
+
+
+class Route:
+    __slots__ = ("name", "handler", "needs")
+
+    def __init__(self, name, handler, needs):
+        self.name = name
+        self.handler = handler
+        self.needs = needs
+
+
+class CallbackRequest:
+    # То, что получает обработчик маршрута: query, аргумент после префикса и загруженный профиль
+    __slots__ = ("query", "data", "arg", "user_id", "profile")
+
+    def __init__(self, query, arg):
+        self.query = query
+        self.data = query.data
+        self.arg = arg
+        self.user_id = query.from_user.id
+        self.profile = {}
+
+    @property
+    def lang(self):
+        return self.profile.get("lang")
+
+
+class CallbackRouter:
+    def __init__(self, observer=None):
+        self._exact = {}
+        self._trie = {}
+        self._loaders = {}
+        # observer(route_name, user_id, status) вызывается после каждого обработанного нажатия
+        self.observer = observer
+
+    def loader(self, need):
+        # loader(request) заполняет request.profile; маршрут указывает нужные данные в needs
+        def decorator(func):
+            self._loaders[need] = func
+            return func
+        return decorator
+
+    def route(self, *patterns, needs=()):
+        def decorator(func):
+            for need in needs:
+                if need not in self._loaders:
+                    raise ValueError(f"Unknown profile requirement: {need}")
+            for pattern in patterns:
+                if pattern.endswith("*"):
+                    node = self._trie
+                    for char in pattern[:-1]:
+                        node = node.setdefault(char, {})
+                    node[None] = Route(pattern, func, tuple(needs))
+                else:
+                    self._exact[pattern] = Route(pattern, func, tuple(needs))
+            return func
+        return decorator
+
+    def resolve(self, data):
+        route = self._exact.get(data)
+        if route is not None:
+            return route, ""
+        # Самый длинный подходящий префикс
+        node = self._trie
+        found = None
+        for i, char in enumerate(data):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                found = (node[None], data[i + 1:])
+        return found if found else (None, "")
+
+    async def dispatch(self, update, context):
+        query = update.callback_query
+        route, arg = self.resolve(query.data or "")
+        if route is None:
+            logger.warning(f"No route for callback data: {query.data}")
+            await query.answer()
+            return
+        request = CallbackRequest(query, arg)
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            for need in route.needs:
+                self._loaders[need](request)
+            await route.handler(request, context)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            CALLBACK_LATENCY.observe(time.perf_counter() - start, route=route.name)
+            CALLBACK_CALLS.inc(route=route.name, status=status)
+            if self.observer is not None:
+                self.observer(route.name, request.user_id, status)
@@ -0,0 +1,337 @@
+# Сегменты аудитории для рассылок. Определение — строка вида
+#   lang:ru,uk active<7d -blocked:yes (event:register or joined<30d)
+# Термины через пробел объединяются по И, "or" — ИЛИ, "-" — отрицание, скобки группируют:
+#   lang:ru,uk          язык пользователя
+#   active<7d, active>30d   последнее взаимодействие не старше / старше срока (h, d, w)
+#   joined<30d, joined>30d  первый запуск не старше / старше срока
+#   cohort:2024-05      первый запуск в указанный месяц (или день: 2024-05-17)
+#   blocked:yes|no      заблокировал ли бота (по умолчанию в сегмент попадают только незаблокированные)
+#   event:register, event:menu<7d   шаг воронки из events (по умолчанию за 30 дней)
+#   id:1,2,3            конкретные пользователи
+# Определение компилируется в WHERE по индексированным колонкам users. Сохранённые сегменты
+# материализуются в segment_members и обновляются по мере действий пользователей. Сегменты со сроками
+# и событиями (active, joined, event) меняются и без действий, поэтому count и audience считают их по запросу
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+import metrics
+import storage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EVENT_WINDOW = timedelta(days=30)
+EVENT_STEPS = ("active", "start", "menu", "register", "support")
+_UNITS = {"h": "hours", "d": "days", "w": "weeks"}
+_TOKEN_RE = re.compile(r"\(|\)|[^\s()]+")
+_TERM_RE = re.compile(r"^(\w+)(:|<|>)(.+)$")
+_DURATION_RE = re.compile(r"^(\d+)([hdw])$")
+_NAME_RE = re.compile(r"^[\w-]{1,32}$")
+
+MEMBERS = metrics.gauge("tango_segment_members", "Members of materialized segments", ("segment",))
+REFRESH_LATENCY = metrics.histogram("tango_segment_refresh_seconds", "Segment maintenance latency", ("mode",))
+
+_dirty = set()
+_dirty_lock = threading.Lock()
+
+
+class SegmentError(ValueError):
+    pass
+
+
+class Segment:
+    __slots__ = ("definition", "where", "params", "live")
+
+    def __init__(self, definition, where, params, live=False):
+        self.definition = definition
+        self.where = where
+        self.params = params
+        # Условие зависит от текущего времени или event_users: segment_members может отставать
+        self.live = live
+
+
+def init_segments():
+    conn = sqlite3.connect(storage.DB_PATH)
+    c = conn.cursor()
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_language ON users (language, is_blocked)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_last_interaction ON users (last_interaction)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_first_start ON users (first_start)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_event_users_user ON event_users (user_id, step, day)")
+    c.execute('''CREATE TABLE IF NOT EXISTS segments (
+                    name TEXT PRIMARY KEY,
+                    definition TEXT,
+                    member_count INTEGER DEFAULT 0,
+                    refreshed_at TEXT
+                 )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS segment_members (
+                    segment TEXT,
+                    user_id INTEGER,
+                    language TEXT,
+                    PRIMARY KEY (segment, user_id)
+                 ) WITHOUT ROWID''')
+    conn.commit()
+    conn.close()
+
+
+def _timestamp(delta):
+    return (datetime.now() - delta).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _duration(value):
+    match = _DURATION_RE.match(value)
+    if not match:
+        raise SegmentError(f"Неверный срок: {value} (пример: 12h, 7d, 2w)")
+    return timedelta(**{_UNITS[match.group(2)]: int(match.group(1))})
+
+
+def _compile_term(token, state):
+    match = _TERM_RE.match(token)
+    if not match:
+        raise SegmentError(f"Непонятный термин: {token}")
+    key, op, value = match.groups()
+    if key == "lang" and op == ":":
+        languages = [lang for lang in value.split(",") if lang]
+        return f"u.language IN ({','.join('?' * len(languages))})", languages
+    if key in ("active", "joined") and op in "<>":
+        column = "u.last_interaction" if key == "active" else "u.first_start"
+        state["live"] = True
+        return f"{column} {'>=' if op == '<' else '<'} ?", [_timestamp(_duration(value))]
+    if key == "cohort" and op == ":":
+        if not re.match(r"^\d{4}(-\d{2}){0,2}$", value):
+            raise SegmentError(f"Неверная когорта: {value} (пример: 2024-05)")
+        return "u.first_start >= ? AND u.first_start < ?", [value, value + "~"]
+    if key == "blocked" and op == ":" and value in ("yes", "no"):
+        state["blocked"] = True
+        return "u.is_blocked = ?", ["Yes" if value == "yes" else "No"]
+    if key == "event" and op == ":":
+        step, _, window = value.partition("<")
+        if step not in EVENT_STEPS:
+            raise SegmentError(f"Неизвестный шаг {step}, доступны: {', '.join(EVENT_STEPS)}")
+        state["live"] = True
+        since = (datetime.now() - (_duration(window) if window else DEFAULT_EVENT_WINDOW)).strftime("%Y-%m-%d")
+        return ("EXISTS (SELECT 1 FROM event_users e WHERE e.user_id = u.user_id AND e.step = ? AND e.day >= ?)",
+                [step, since])
+    if key == "id" and op == ":":
+        try:
+            ids = [int(item) for item in value.split(",") if item]
+        except ValueError:
+            raise SegmentError(f"Неверный список ID: {value}")
+        return f"u.user_id IN ({','.join('?' * len(ids))})", ids
+    raise SegmentError(f"Непонятный термин: {token}")
+
+
+def compile_segment(definition):
+    tokens = _TOKEN_RE.findall(definition)
+    state = {"pos": 0, "blocked": False, "live": False}
+
+    def peek():
+        return tokens[state["pos"]] if state["pos"] < len(tokens) else None
+
+    def take():
+        token = peek()
+        state["pos"] += 1
+        return token
+
+    def parse_or():
+        parts = [parse_and()]
+        while peek() == "or":
+            take()
+            parts.append(parse_and())
+        if len(parts) == 1:
+            return parts[0]
+        return "(" + " OR ".join(part[0] for part in parts) + ")", [p for part in parts for p in part[1]]
+
+    def parse_and():
+        parts = []
+        while peek() not in (None, ")", "or"):
+            parts.append(parse_term())
+        if not parts:
+            raise SegmentError("Пустое условие")
+        return " AND ".join(f"({part[0]})" for part in parts), [p for part in parts for p in part[1]]
+
+    def parse_term():
+        token = take()
+        if token == "(":
+            inner = parse_or()
+            if take() != ")":
+                raise SegmentError("Не хватает закрывающей скобки")
+            return inner
+        if token.startswith("-") and len(token) > 1:
+            sql, params = _compile_term(token[1:], state)
+            return f"NOT ({sql})", params
+        return _compile_term(token, state)
+
+    if not tokens:
+        where, params = "1", []
+    else:
+        where, params = parse_or()
+        if peek() is not None:
+            raise SegmentError(f"Лишний символ: {peek()}")
+    if not state["blocked"]:
+        where, params = f"({where}) AND u.is_blocked = 'No'", params
+    return Segment(definition, where, params, state["live"])
+
+
+def _connect():
+    return sqlite3.connect(storage.DB_PATH)
+
+
+def _saved(conn):
+    return conn.execute("SELECT name, definition FROM segments ORDER BY name").fetchall()
+
+
+def resolve(spec, conn):
+    # spec — определение или "@имя" сохранённого сегмента
+    if spec.startswith("@"):
+        row = conn.execute("SELECT definition FROM segments WHERE name = ?", (spec[1:],)).fetchone()
+        if row is None:
+            raise SegmentError(f"Сегмент {spec[1:]} не найден")
+        return spec[1:], compile_segment(row[0])
+    return None, compile_segment(spec)
+
+
+def count(spec):
+    apply_dirty()
+    conn = _connect()
+    try:
+        name, segment = resolve(spec, conn)
+        if name is not None and not segment.live:
+            return conn.execute("SELECT COUNT(*) FROM segment_members WHERE segment = ?", (name,)).fetchone()[0]
+        return conn.execute(f"SELECT COUNT(*) FROM users u WHERE {segment.where}", segment.params).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def audience(spec):
+    # Получатели по языкам: {язык: [user_id, ...]}, как get_audience
+    conn = _connect()
+    try:
+        name, segment = resolve(spec, conn)
+        if name is not None and not segment.live:
+            rows = conn.execute("SELECT user_id, language FROM segment_members WHERE segment = ?", (name,))
+        else:
+            rows = conn.execute(f"SELECT u.user_id, u.language FROM users u WHERE {segment.where}", segment.params)
+        result = {}
+        for user_id, language in rows:
+            result.setdefault(language or "en", []).append(user_id)
+        return result
+    finally:
+        conn.close()
+
+
+def _refresh(conn, name, segment, user_ids=None):
+    if user_ids is None:
+        conn.execute("DELETE FROM segment_members WHERE segment = ?", (name,))
+        conn.execute(f"INSERT INTO segment_members (segment, user_id, language) "
+                     f"SELECT ?, u.user_id, u.language FROM users u WHERE {segment.where}", [name, *segment.params])
+    else:
+        conn.execute("DELETE FROM segment_members WHERE segment = ? AND user_id IN (SELECT user_id FROM temp.dirty_users)",
+                     (name,))
+        conn.execute(f"INSERT INTO segment_members (segment, user_id, language) "
+                     f"SELECT ?, u.user_id, u.language FROM users u "
+                     f"WHERE u.user_id IN (SELECT user_id FROM temp.dirty_users) AND {segment.where}",
+                     [name, *segment.params])
+    member_count = conn.execute("SELECT COUNT(*) FROM segment_members WHERE segment = ?", (name,)).fetchone()[0]
+    conn.execute("UPDATE segments SET member_count = ?, refreshed_at = ? WHERE name = ?",
+                 (member_count, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), name))
+    MEMBERS.set(member_count, segment=name)
+
+
+def save(name, definition):
+    if not _NAME_RE.match(name):
+        raise SegmentError("Имя сегмента: буквы, цифры, _ и -, до 32 символов")
+    segment = compile_segment(definition)
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO segments (name, definition) VALUES (?, ?)", (name, definition))
+            _refresh(conn, name, segment)
+        return conn.execute("SELECT member_count FROM segments WHERE name = ?", (name,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def drop(name):
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("DELETE FROM segment_members WHERE segment = ?", (name,))
+            deleted = conn.execute("DELETE FROM segments WHERE name = ?", (name,)).rowcount
+        return bool(deleted)
+    finally:
+        conn.close()
+
+
+def list_segments():
+    conn = _connect()
+    try:
+        return conn.execute("SELECT name, definition, member_count, refreshed_at FROM segments ORDER BY name").fetchall()
+    finally:
+        conn.close()
+
+
+def button_key(name):
+    # Ключ сегмента для callback_data: имя из 32 букв кириллицы занимает 64 байта, а callback_data
+    # ограничен 64 байтами вместе с префиксом, поэтому в кнопку кладётся короткий хэш имени
+    return hashlib.blake2s(name.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def find_by_key(key):
+    # Имя сохранённого сегмента по button_key или None, если сегмент удалён
+    conn = _connect()
+    try:
+        names = [name for name, _ in _saved(conn)]
+    finally:
+        conn.close()
+    return next((name for name in names if button_key(name) == key), None)
+
+
+def touch(user_id):
+    # Вызывается при изменении пользователя; членство пересчитывается пачкой в apply_dirty
+    with _dirty_lock:
+        _dirty.add(user_id)
+
+
+def apply_dirty():
+    global _dirty
+    with _dirty_lock:
+        user_ids, _dirty = _dirty, set()
+    if not user_ids:
+        return 0
+    with REFRESH_LATENCY.time(mode="incremental"):
+        conn = _connect()
+        try:
+            saved = _saved(conn)
+            if saved:
+                conn.execute("CREATE TEMP TABLE IF NOT EXISTS dirty_users (user_id INTEGER PRIMARY KEY)")
+                with conn:
+                    conn.execute("DELETE FROM temp.dirty_users")
+                    conn.executemany("INSERT INTO temp.dirty_users (user_id) VALUES (?)", [(uid,) for uid in user_ids])
+                    for name, definition in saved:
+                        _refresh(conn, name, compile_segment(definition), user_ids)
+        except Exception as e:
+            logger.error(f"Incremental segment refresh failed for {len(user_ids)} users: {e}")
+            with _dirty_lock:
+                _dirty |= user_ids
+            return 0
+        finally:
+            conn.close()
+    return len(user_ids)
+
+
+def refresh_all():
+    # Полный пересчёт нужен условиям со сроками (active<7d и т.п.): пользователи выпадают из них без действий
+    start = time.perf_counter()
+    with REFRESH_LATENCY.time(mode="full"):
+        conn = _connect()
+        try:
+            for name, definition in _saved(conn):
+                with conn:
+                    _refresh(conn, name, compile_segment(definition))
+        finally:
+            conn.close()
+    logger.info(f"Segments refreshed in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,84 @@
+# Плавная остановка по SIGTERM: вебхук перестаёт принимать апдейты (Telegram повторит их
+# на новом экземпляре), рассылки сохраняют курсор, буферы и состояние поддержки пишутся в базу.
+# Шаги регистрируются через on_drain и выполняются по порядку в цикле бота с общим дедлайном
+import asyncio
+import logging
+import os
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DRAIN_DEADLINE = float(os.getenv("DRAIN_DEADLINE", 25))
+
+# draining — новые апдейты и шаги рассылок больше не принимаются; finished — остановка завершена
+draining = threading.Event()
+finished = threading.Event()
+_steps = []
+
+
+def on_drain(name):
+    def decorator(func):
+        _steps.append((name, func))
+        return func
+    return decorator
+
+
+async def drain():
+    draining.set()
+    deadline = time.monotonic() + DRAIN_DEADLINE
+    logger.info(f"Draining: {len(_steps)} steps, deadline {DRAIN_DEADLINE:.0f}s")
+    for name, step in _steps:
+        # Даже после дедлайна каждый шаг получает секунду: сохранение состояния важнее точного срока
+        timeout = max(1.0, deadline - time.monotonic())
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(step(), timeout)
+            logger.info(f"Drain step {name} done in {time.monotonic() - start:.2f}s")
+        except asyncio.TimeoutError:
+            logger.error(f"Drain step {name} did not finish in {timeout:.1f}s")
+        except Exception as e:
+            logger.error(f"Drain step {name} failed: {e}")
+    finished.set()
+
+
+def install(loop):
+    # Однопроцессный режим: сигнал приходит в главный поток (Flask), остановка идёт в цикле бота
+    def handle(signum, frame):
+        if draining.is_set():
+            return
+        logger.info(f"Received signal {signum}, shutting down")
+        future = asyncio.run_coroutine_threadsafe(drain(), loop)
+        try:
+            future.result(DRAIN_DEADLINE + 5)
+        except Exception as e:
+            logger.error(f"Drain did not complete: {e}")
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, handle)
+    signal.signal(signal.SIGINT, handle)
+
+
+def install_front_end(processes):
+    # Фронтенд многопроцессного режима: перестаёт принимать вебхук и передаёт SIGTERM воркерам,
+    # каждый воркер выполняет drain() у себя
+    def handle(signum, frame):
+        if draining.is_set():
+            return
+        draining.set()
+        logger.info(f"Received signal {signum}, stopping {len(processes)} workers")
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + DRAIN_DEADLINE + 5
+        for process in processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.error(f"Worker {process.name} did not stop in time, killing")
+                process.kill()
+        finished.set()
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, handle)
+    signal.signal(signal.SIGINT, handle)
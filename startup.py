@@ -0,0 +1,108 @@
+# Замер запуска: время импорта и фаз фабрики (настройки, база, Application, прогрев кэшей).
+# Итог сравнивается с бюджетом STARTUP_BUDGET и публикуется на /metrics. Модуль импортирует
+# только стандартную библиотеку, чтобы его можно было подключить первым и засечь весь импорт.
+# Отчёт о том, на что уходит время импорта: python startup.py [модуль] [--top N]
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", 15))
+
+_started = time.perf_counter()
+# (фаза, секунды) в порядке выполнения
+_phases = []
+_IMPORT_TIME_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)")
+
+
+def record(name, seconds):
+    _phases.append((name, seconds))
+
+
+def mark_imported(module):
+    # Вызывается в конце модуля: время от импорта startup до этого места
+    record(f"import {module}", time.perf_counter() - _started)
+
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def elapsed():
+    return time.perf_counter() - _started
+
+
+def phases():
+    return list(_phases)
+
+
+def report():
+    # Сводка по фазам в лог; при превышении бюджета — предупреждение с самой долгой фазой
+    import metrics
+    total = elapsed()
+    metrics.gauge("tango_startup_seconds", "Time spent in startup phases", ("phase",),
+                  lambda: {**{(name,): seconds for name, seconds in _phases}, ("total",): total})
+    summary = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in _phases)
+    if total > STARTUP_BUDGET:
+        slowest = max(_phases, key=lambda item: item[1], default=("-", 0.0))
+        logger.warning(f"Startup took {total:.2f}s, over the {STARTUP_BUDGET:.0f}s budget "
+                       f"(slowest: {slowest[0]} {slowest[1]:.2f}s): {summary}")
+    else:
+        logger.info(f"Startup took {total:.2f}s (budget {STARTUP_BUDGET:.0f}s): {summary}")
+    return total
+
+
+def import_report(module="tango", top=15):
+    # Импорт в отдельном процессе с -X importtime: [(пакет верхнего уровня, собственное, суммарное время в с)]
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, env={**os.environ, "PYTHONPATH": os.getcwd()})
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "import failed")
+    packages = {}
+    # Вложенные импорты печатаются раньше родителя, поэтому строки разбираются с конца; суммарное
+    # время пакета учитывается только там, где его импортирует другой пакет, чтобы не считать дважды
+    parents = []
+    for line in reversed(result.stderr.splitlines()):
+        match = _IMPORT_TIME_RE.match(line)
+        if not match:
+            continue
+        own, cumulative, indent, name = match.groups()
+        root = name.split(".")[0]
+        while parents and parents[-1][0] >= len(indent):
+            parents.pop()
+        entry = packages.setdefault(root, [0, 0])
+        entry[0] += int(own)
+        if not parents or parents[-1][1] != root:
+            entry[1] += int(cumulative)
+        parents.append((len(indent), root))
+    rows = sorted(((name, own / 1e6, cumulative / 1e6) for name, (own, cumulative) in packages.items()),
+                  key=lambda row: row[2], reverse=True)
+    return rows[:top]
+
+
+def main():
+    args = sys.argv[1:]
+    top = 15
+    if "--top" in args:
+        index = args.index("--top")
+        top = int(args[index + 1])
+        del args[index:index + 2]
+    module = args[0] if args else "tango"
+    rows = import_report(module, top)
+    print(f"{'package':<28}{'self, s':>10}{'cumulative, s':>16}")
+    for name, own, cumulative in rows:
+        print(f"{name:<28}{own:>10.3f}{cumulative:>16.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+# Путь к базе бота (users.db) в одном месте. Модули читают storage.DB_PATH при каждом подключении
+# и не копируют его при импорте, поэтому путь, заданный в configure(), видят все. configure()
+# вызывает tango.load_settings: с окружением процесса или с настройками бота из tenants.py
+import os
+
+DB_PATH = os.getenv("DB_PATH", "users.db")
+
+
+def configure(env):
+    global DB_PATH
+    DB_PATH = env.get("DB_PATH", "users.db")
@@ -1,4 +1,6 @@
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, BotCommand
+import startup
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputMediaDocument, InputMediaPhoto, Update, BotCommand
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ChatMemberHandler, MessageHandler, filters, ContextTypes
 from dotenv import load_dotenv
 import os
@@ -6,42 +8,97 @@ import sqlite3
 from datetime import datetime
 import logging
 import asyncio
-import uuid
+import functools
+import json
 import tempfile
-from deep_translator import GoogleTranslator
 from translations import translations
-import requests
-from io import BytesIO
-from flask import Flask, request, Response  # Добавляем Flask для Webhook
+import translation
+from translation import translate_text, translate_cached
+import httpx
+from flask import Blueprint, Flask, request, Response, redirect  # Добавляем Flask для Webhook
 import threading  # Для запуска Flask и job_queue параллельно
+import time
+import metrics
+import storage
+import logging_setup
+from metrics import InstrumentedRequest, instrument_handler, timed_db
+from router import CallbackRouter
+from loop_monitor import loop_monitor
+import workers
+import posts_catalog
+import canned
+import users_io
+import backup
+import campaigns
+import transcripts
+import events
+import throttle
+import health
+import shutdown
+import segments
+import http_client
+import media
+import albums
+import assignment
+from conversation import Conversation, MediaAlbum, MediaRecord
 
-# Инициализация переводчика для поддержки
-translator = GoogleTranslator(source='auto', target='ru')
-
-# Настраиваем логирование
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.FileHandler("bot.log"), logging.StreamHandler()]
-)
 logger = logging.getLogger(__name__)
-
-# Загружаем переменные из .env файла
-load_dotenv()
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-REGISTER_URL = os.getenv("REGISTER_URL", "https://example.com/register")
-ADMIN_ID = int(os.getenv("ADMIN_ID"))
-OPERATORS_STR = os.getenv("OPERATORS", "")
-
-# Устанавливаем ссылку на регистрацию для всех языков
-for lang in translations:
-    translations[lang]["register_url"] = REGISTER_URL
-
-# Парсим операторов из переменной окружения
+# Сообщения на каждый апдейт пишутся в отдельный логгер с выборкой (LOG_SAMPLING)
+update_logger = logging.getLogger(f"{__name__}.updates")
+
+# Настройки из окружения (и .env) читаются в load_settings() при создании приложения, а не при импорте
+BOT_TOKEN = None
+REGISTER_URL = None
+PUBLIC_URL = None
+# Кнопка регистрации ведёт через /go/register, чтобы учитывать переходы (URL-кнопки не присылают callback)
+TRACK_REGISTER_CLICKS = True
+FLOOD_PROTECTION = True
+BROADCAST_CHECKPOINT_EVERY = 25
+BROADCAST_CHECKPOINT_INTERVAL = 10
+BROADCAST_STALE_AFTER = 120
+SEGMENT_REFRESH_INTERVAL = 3600
+# Лимиты Bot API: бот скачивает файлы до 20 МБ и отправляет до 50 МБ
+IMPORT_MAX_BYTES = 20 * 1024 * 1024
+EXPORT_MAX_BYTES = 50 * 1024 * 1024
+IMPORT_PROGRESS_INTERVAL = 2
+ADMIN_ID = None
 operator_ids = []
 operator_names = {}
-if OPERATORS_STR:
-    for pair in OPERATORS_STR.split(","):
+# Режим нескольких ботов (tenants.py): имя бота (хранилище кампаний), префикс его адресов во Flask
+# и признак общих с другими ботами ресурсов: сторож цикла, HTTP-пулы и планировщик кампаний тогда
+# останавливает tenants, один раз после всех ботов
+TENANT = "default"
+URL_PREFIX = ""
+SHARED_RUNTIME = False
+
+def load_settings(env=None):
+    global BOT_TOKEN, REGISTER_URL, PUBLIC_URL, TRACK_REGISTER_CLICKS, FLOOD_PROTECTION
+    global BROADCAST_CHECKPOINT_EVERY, BROADCAST_STALE_AFTER, SEGMENT_REFRESH_INTERVAL, ADMIN_ID
+    # env — настройки бота (tenants.py передаёт свои); по умолчанию окружение процесса и .env файл
+    if env is None:
+        load_dotenv()
+        env = os.environ
+    BOT_TOKEN = env.get("BOT_TOKEN")
+    REGISTER_URL = env.get("REGISTER_URL", "https://example.com/register")
+    PUBLIC_URL = env.get("PUBLIC_URL", "https://tng33.onrender.com")
+    TRACK_REGISTER_CLICKS = env.get("TRACK_REGISTER_CLICKS", "1") == "1"
+    FLOOD_PROTECTION = env.get("FLOOD_PROTECTION", "1") == "1"
+    BROADCAST_CHECKPOINT_EVERY = int(env.get("BROADCAST_CHECKPOINT_EVERY", 25))
+    BROADCAST_STALE_AFTER = int(env.get("BROADCAST_STALE_AFTER", 120))
+    SEGMENT_REFRESH_INTERVAL = int(env.get("SEGMENT_REFRESH_INTERVAL", 3600))
+    ADMIN_ID = int(env.get("ADMIN_ID"))
+    # Настройки модулей бота (база, медиа, копии, архив, операторы) передаются им явно, из того же env
+    for module in (storage, media, backup, transcripts, assignment):
+        module.configure(env)
+
+    # Устанавливаем ссылку на регистрацию для всех языков
+    for lang in translations:
+        translations[lang]["register_url"] = REGISTER_URL
+
+    # Парсим операторов из переменной окружения (списки меняются на месте: на них ссылаются другие модули)
+    operator_ids.clear()
+    operator_names.clear()
+    for pair in env.get("OPERATORS", "").split(","):
         pair = pair.strip()
         if not pair:
             continue
@@ -65,14 +122,43 @@ waiting_for_question = {}
 waiting_for_language = {}
 user_languages = {}
 
-# Инициализация Flask и Application
-app = Flask(__name__)
-application = Application.builder().token(BOT_TOKEN).build()
+# Маршруты вебхука и служебных адресов; Flask-приложение собирается в create_app()
+web = Blueprint("tango", __name__)
+# Application создаётся в create_application(); до этого импорт модуля не делает сетевых и дисковых операций
+application = None
+flood_guard = None
+# Очередь назначения запросов операторам; создаётся вместе с Application, когда известен список операторов
+assignment_queue = None
+# Цикл событий, в котором работают обработчики и job_queue (запускается в run_jobs)
+bot_loop = None
+bot_ready = threading.Event()
+
+# Размеры словарей поддержки и очередей публикуются на /metrics
+metrics.gauge("tango_support_state_size", "Entries in support state dicts", ("dict",), lambda: {
+    ("active_requests",): len(active_requests),
+    ("active_conversations",): len(active_conversations),
+    ("operator_active",): len(operator_active),
+    ("waiting_for_question",): len(waiting_for_question),
+    ("waiting_for_language",): len(waiting_for_language),
+    ("user_languages",): len(user_languages),
+})
+metrics.gauge("tango_conversation_memory_bytes", "Memory held by open support chats", ("stat",), lambda: {
+    ("total",): sum(conv.memory_usage() for conv in list(active_requests.values())),
+    ("max",): max((conv.memory_usage() for conv in list(active_requests.values())), default=0),
+})
+metrics.gauge("tango_log_records_dropped", "Log records dropped by sampling or a full queue", ("reason",),
+              logging_setup.dropped_counts)
+metrics.gauge("tango_queue_depth", "Pending items in application queues", ("queue",), lambda: {
+    ("update_queue",): application.update_queue.qsize(),
+    ("job_queue",): len(application.job_queue.jobs()) if application.job_queue else 0,
+} if application is not None else {})
 
 # Инициализация базы данных SQLite (без изменений)
 def init_db():
-    conn = sqlite3.connect("users.db")
+    conn = sqlite3.connect(storage.DB_PATH)
     c = conn.cursor()
+    # WAL позволяет нескольким процессам (режим WORKERS) читать во время записи
+    c.execute("PRAGMA journal_mode=WAL")
     c.execute('''CREATE TABLE IF NOT EXISTS users (
                     user_id INTEGER PRIMARY KEY,
                     username TEXT,
@@ -105,6 +191,37 @@ def init_db():
         c.execute("ALTER TABLE scheduled_posts ADD COLUMN target_lang TEXT")
     if 'target_users' not in columns:
         c.execute("ALTER TABLE scheduled_posts ADD COLUMN target_users TEXT")
+    if 'variants' not in columns:
+        c.execute("ALTER TABLE scheduled_posts ADD COLUMN variants TEXT")
+    # Версия таблицы posts: триггеры увеличивают её при любом изменении, каталог постов сверяется с ней
+    c.execute('''CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER
+                 )''')
+    c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('posts_version', 0)")
+    # Журнал рассылок: получатели и курсор (индекс следующего получателя), чтобы прерванную рассылку
+    # продолжил следующий экземпляр без повторов
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcasts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    post_data TEXT,
+                    parse_mode TEXT,
+                    audience TEXT,
+                    cursor INTEGER DEFAULT 0,
+                    sent INTEGER DEFAULT 0,
+                    status TEXT,
+                    heartbeat REAL,
+                    created_at TEXT
+                 )''')
+    # Состояние поддержки (открытые чаты, ожидание вопроса), сохранённое при остановке
+    c.execute('''CREATE TABLE IF NOT EXISTS support_state (
+                    key TEXT PRIMARY KEY,
+                    shard INTEGER,
+                    kind TEXT,
+                    state TEXT
+                 )''')
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS posts_version_{event.lower()} AFTER {event} ON posts
+                      BEGIN UPDATE meta SET value = value + 1 WHERE key = 'posts_version'; END''')
     c.execute("SELECT COUNT(*) FROM posts")
     if c.fetchone()[0] == 0:
         posts_data = [
@@ -116,16 +233,25 @@ def init_db():
     conn.close()
 
 # Функции базы данных и утилиты (без изменений)
+# Посты меню читаются из каталога в памяти, SQLite при нажатии не используется
 def get_post(post_type, language):
-    conn = sqlite3.connect("users.db")
+    return posts_catalog.current().get(post_type, language)
+
+@timed_db
+def upsert_post(post_type, language, text, image_path):
+    conn = sqlite3.connect(storage.DB_PATH)
     c = conn.cursor()
-    c.execute("SELECT text, image_path FROM posts WHERE post_type = ? AND language = ?", (post_type, language))
-    result = c.fetchone()
+    c.execute("UPDATE posts SET text = ?, image_path = ? WHERE post_type = ? AND language = ?",
+              (text, image_path, post_type, language))
+    if c.rowcount == 0:
+        c.execute("INSERT INTO posts (post_type, language, text, image_path) VALUES (?, ?, ?, ?)",
+                  (post_type, language, text, image_path))
+    conn.commit()
     conn.close()
-    return result if result else ("Post not found.", None)
 
+@timed_db
 def save_user(user_id, username=None, language="en", is_blocked="No", last_interaction=None):
-    conn = sqlite3.connect("users.db")
+    conn = sqlite3.connect(storage.DB_PATH)
     c = conn.cursor()
     c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
     if c.fetchone() is None:
@@ -138,68 +264,201 @@ def save_user(user_id, username=None, language="en", is_blocked="No", last_inter
                   (username, language, is_blocked, last_interaction or datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_id))
     conn.commit()
     conn.close()
+    segments.touch(user_id)
 
+@timed_db
 def get_user_language(user_id):
-    conn = sqlite3.connect("users.db")
+    conn = sqlite3.connect(storage.DB_PATH)
     c = conn.cursor()
     c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
     result = c.fetchone()
     conn.close()
     return result[0] if result else "en"
 
+@timed_db
+def user_exists(user_id):
+    conn = sqlite3.connect(storage.DB_PATH)
+    c = conn.cursor()
+    c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
+    result = c.fetchone()
+    conn.close()
+    return result is not None
+
+@timed_db
 def is_language_set(user_id):
-    conn = sqlite3.connect("users.db")
+    conn = sqlite3.connect(storage.DB_PATH)
     c = conn.cursor()
     c.execute("SELECT language, first_start FROM users WHERE user_id = ?", (user_id,))
     result = c.fetchone()
     conn.close()
     return result and result[0] != "en"
 
+@timed_db
 def get_user_stats():
-    conn = sqlite3.connect("users.db")
+    conn = sqlite3.connect(storage.DB_PATH)
     c = conn.cursor()
     c.execute("SELECT user_id, username, phone_number, first_start, language, is_blocked, last_interaction FROM users")
     users = c.fetchall()
     conn.close()
     return users
 
+@timed_db
 def get_all_users():
-    conn = sqlite3.connect("users.db")
+    conn = sqlite3.connect(storage.DB_PATH)
     c = conn.cursor()
     c.execute("SELECT user_id FROM users WHERE is_blocked = 'No'")
     users = c.fetchall()
     conn.close()
     return [user[0] for user in users]
 
+@timed_db
 def get_users_by_language(language):
-    conn = sqlite3.connect("users.db")
+    conn = sqlite3.connect(storage.DB_PATH)
     c = conn.cursor()
     c.execute("SELECT user_id FROM users WHERE language = ? AND is_blocked = 'No'", (language,))
     users = c.fetchall()
     conn.close()
     return [user[0] for user in users]
 
-def save_scheduled_post(text, image_path, button_text, button_url, send_time, target_lang=None, target_users=None):
-    conn = sqlite3.connect("users.db")
+@timed_db
+def save_scheduled_post(text, image_path, button_text, button_url, send_time, target_lang=None, target_users=None, variants=None):
+    conn = sqlite3.connect(storage.DB_PATH)
     c = conn.cursor()
     c.execute(
-        "INSERT INTO scheduled_posts (text, image_path, button_text, button_url, send_time, target_lang, target_users) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (text, image_path, button_text, button_url, send_time, target_lang, target_users))
+        "INSERT INTO scheduled_posts (text, image_path, button_text, button_url, send_time, target_lang, target_users, variants) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (text, image_path, button_text, button_url, send_time, target_lang, target_users,
+         json.dumps(variants, ensure_ascii=False) if variants else None))
     conn.commit()
     conn.close()
 
+@timed_db
 def get_scheduled_posts():
-    conn = sqlite3.connect("users.db")
+    conn = sqlite3.connect(storage.DB_PATH)
     c = conn.cursor()
     current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    c.execute("SELECT id, text, image_path, button_text, button_url, target_lang, target_users FROM scheduled_posts WHERE send_time <= ?", (current_time,))
+    # Пост удаляется из scheduled_posts в той же транзакции, где создаётся его рассылка (create_broadcast)
+    c.execute("SELECT id, text, image_path, button_text, button_url, target_lang, target_users, variants FROM scheduled_posts WHERE send_time <= ?", (current_time,))
     posts = c.fetchall()
-    c.execute("DELETE FROM scheduled_posts WHERE send_time <= ?", (current_time,))
-    conn.commit()
     conn.close()
     return posts
 
-# Функции построения меню (без изменений)
+BROADCAST_FIELDS = ("text", "image_path", "button_text", "button_url", "variants")
+
+@timed_db
+def create_broadcast(post_data, audience, parse_mode=None, scheduled_post_id=None):
+    conn = sqlite3.connect(storage.DB_PATH)
+    c = conn.cursor()
+    c.execute("INSERT INTO broadcasts (post_data, parse_mode, audience, status, heartbeat, created_at) VALUES (?, ?, ?, 'running', ?, ?)",
+              (json.dumps({key: post_data.get(key) for key in BROADCAST_FIELDS}, ensure_ascii=False), parse_mode,
+               json.dumps(audience), time.time(), datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    broadcast_id = c.lastrowid
+    if scheduled_post_id is not None:
+        c.execute("DELETE FROM scheduled_posts WHERE id = ?", (scheduled_post_id,))
+    conn.commit()
+    conn.close()
+    return broadcast_id
+
+@timed_db
+def save_broadcast_cursor(broadcast_id, cursor, sent, status="running"):
+    conn = sqlite3.connect(storage.DB_PATH)
+    c = conn.cursor()
+    c.execute("UPDATE broadcasts SET cursor = ?, sent = ?, status = ?, heartbeat = ? WHERE id = ?",
+              (cursor, sent, status, time.time(), broadcast_id))
+    conn.commit()
+    conn.close()
+
+@timed_db
+def finish_broadcast(broadcast_id):
+    conn = sqlite3.connect(storage.DB_PATH)
+    c = conn.cursor()
+    c.execute("DELETE FROM broadcasts WHERE id = ?", (broadcast_id,))
+    conn.commit()
+    conn.close()
+
+# Забирает прерванные рассылки: приостановленные при остановке или "running" без отметок дольше
+# BROADCAST_STALE_AFTER (процесс упал). UPDATE с условием не даст двум процессам взять одну рассылку
+@timed_db
+def claim_unfinished_broadcasts(exclude=()):
+    conn = sqlite3.connect(storage.DB_PATH)
+    c = conn.cursor()
+    now = time.time()
+    c.execute("SELECT id FROM broadcasts WHERE status = 'paused' OR heartbeat < ?", (now - BROADCAST_STALE_AFTER,))
+    claimed = []
+    for (broadcast_id,) in c.fetchall():
+        if broadcast_id in exclude:
+            continue
+        c.execute("UPDATE broadcasts SET status = 'running', heartbeat = ? WHERE id = ? AND (status = 'paused' OR heartbeat < ?)",
+                  (now, broadcast_id, now - BROADCAST_STALE_AFTER))
+        if c.rowcount:
+            c.execute("SELECT id, post_data, parse_mode, audience, cursor, sent FROM broadcasts WHERE id = ?", (broadcast_id,))
+            claimed.append(c.fetchone())
+        conn.commit()
+    conn.close()
+    return claimed
+
+@timed_db
+def save_support_state(shard, rows):
+    conn = sqlite3.connect(storage.DB_PATH)
+    c = conn.cursor()
+    c.executemany("INSERT OR REPLACE INTO support_state (key, shard, kind, state) VALUES (?, ?, ?, ?)",
+                  [(key, shard, kind, json.dumps(state, ensure_ascii=False)) for key, kind, state in rows])
+    conn.commit()
+    conn.close()
+
+# Забирает состояние своего шарда. Записи шардов, которых больше нет (WORKERS уменьшили), достаются
+# шарду, куда фронтенд теперь направляет пользователя. DELETE с условием не даст двум процессам взять одну запись
+@timed_db
+def take_support_state(shard, worker_count):
+    conn = sqlite3.connect(storage.DB_PATH)
+    c = conn.cursor()
+    c.execute("SELECT key, shard, kind, state FROM support_state")
+    claimed = []
+    for key, saved_shard, kind, state in c.fetchall():
+        state = json.loads(state)
+        owner = saved_shard if saved_shard < worker_count else state["user_id"] % worker_count
+        if owner != shard:
+            continue
+        c.execute("DELETE FROM support_state WHERE key = ?", (key,))
+        if c.rowcount:
+            claimed.append((key, kind, state))
+        conn.commit()
+    conn.close()
+    return claimed
+
+# Получатели рассылки, сгруппированные по языку: {язык: [user_id, ...]}
+@timed_db
+def get_audience(target_users, target_lang=None, specific_users=None, target_segment=None):
+    if target_users == "segment":
+        return segments.audience(target_segment)
+    conn = sqlite3.connect(storage.DB_PATH)
+    c = conn.cursor()
+    if target_users == "all":
+        c.execute("SELECT user_id, language FROM users WHERE is_blocked = 'No'")
+        rows = c.fetchall()
+    elif target_users == "by_lang":
+        c.execute("SELECT user_id, language FROM users WHERE language = ? AND is_blocked = 'No'", (target_lang,))
+        rows = c.fetchall()
+    else:
+        specific_users = list(specific_users or [])
+        rows = []
+        for i in range(0, len(specific_users), 500):
+            chunk = specific_users[i:i + 500]
+            c.execute(f"SELECT user_id, language FROM users WHERE user_id IN ({','.join('?' * len(chunk))})", chunk)
+            rows.extend(c.fetchall())
+        known = {user_id for user_id, _ in rows}
+        rows.extend((user_id, "en") for user_id in specific_users if user_id not in known)
+    conn.close()
+    audience = {}
+    for user_id, language in rows:
+        audience.setdefault(language or "en", []).append(user_id)
+    return audience
+
+# Функции построения меню. Меню без данных пользователя неизменяемы и строятся один раз
+def register_link(lang, user_id=None):
+    if not TRACK_REGISTER_CLICKS:
+        return translations[lang]["register_url"]
+    return f"{PUBLIC_URL}{URL_PREFIX}/go/register?lang={lang}&uid={user_id or ''}"
+
 def build_menu(lang, user_id=None):
     if user_id == ADMIN_ID:
         keyboard = [[InlineKeyboardButton(f" {translations[lang]['settings']}", callback_data="settings")]]
@@ -210,12 +469,13 @@ def build_menu(lang, user_id=None):
             [InlineKeyboardButton(f" {translations[lang]['withdraw']}", callback_data="withdraw"),
              InlineKeyboardButton(f" {translations[lang]['rules']}", callback_data="rules")],
             [InlineKeyboardButton(f" {translations[lang]['settings']}", callback_data="settings")],
-            [InlineKeyboardButton(f" {translations[lang]['register']}", url=translations[lang]["register_url"])]
+            [InlineKeyboardButton(f" {translations[lang]['register']}", url=register_link(lang, user_id))]
         ]
         keyboard[2].append(InlineKeyboardButton(f" {translations[lang]['support']}", callback_data="support"))
-    logger.info(f"Building menu for language {lang} and user {user_id}: {keyboard}")
+    update_logger.debug(f"Building menu for language {lang} and user {user_id}")
     return InlineKeyboardMarkup(keyboard)
 
+@functools.cache
 def build_lang_menu():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🇺🇦 Українська", callback_data="lang_uk")],
@@ -225,6 +485,7 @@ def build_lang_menu():
         [InlineKeyboardButton("🇪🇸 Español", callback_data="lang_es")]
     ])
 
+@functools.cache
 def build_post_lang_menu():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🇺🇦 Українська", callback_data="post_lang_uk")],
@@ -235,13 +496,23 @@ def build_post_lang_menu():
         [InlineKeyboardButton("На языке пользователя", callback_data="post_lang_user")]
     ])
 
+@functools.cache
 def build_recipient_menu():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("Всем пользователям", callback_data="recipients_all")],
         [InlineKeyboardButton("По языку", callback_data="recipients_by_lang")],
-        [InlineKeyboardButton("Конкретным пользователям", callback_data="recipients_specific")]
+        [InlineKeyboardButton("Конкретным пользователям", callback_data="recipients_specific")],
+        [InlineKeyboardButton("Сегмент", callback_data="recipients_segment")]
+    ])
+
+def build_recipient_segment_menu(saved):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"{name} ({member_count})",
+                              callback_data=f"recipient_segment_{segments.button_key(name)}")]
+        for name, definition, member_count, refreshed_at in saved
     ])
 
+@functools.cache
 def build_recipient_lang_menu():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🇺🇦 Українська", callback_data="recipient_lang_uk")],
@@ -258,14 +529,37 @@ def build_settings_menu(lang, user_id):
     ]
     if user_id == ADMIN_ID:
         keyboard.insert(1, [InlineKeyboardButton("📝 Создать пост", callback_data="create_post")])
+        keyboard.insert(2, [InlineKeyboardButton("✏️ Редактировать пост меню", callback_data="edit_post")])
     return InlineKeyboardMarkup(keyboard)
 
+@functools.cache
+def build_edit_post_type_menu():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("О проекте", callback_data="edit_post_type_about"),
+         InlineKeyboardButton("Как заработать", callback_data="edit_post_type_earn")],
+        [InlineKeyboardButton("Вывод средств", callback_data="edit_post_type_withdraw"),
+         InlineKeyboardButton("Правила", callback_data="edit_post_type_rules")]
+    ])
+
+@functools.cache
+def build_edit_post_lang_menu():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🇺🇦 Українська", callback_data="edit_post_lang_uk")],
+        [InlineKeyboardButton("🇬🇧 English", callback_data="edit_post_lang_en")],
+        [InlineKeyboardButton("🇹🇷 Türkçe", callback_data="edit_post_lang_tr")],
+        [InlineKeyboardButton("🇷🇺 Русский", callback_data="edit_post_lang_ru")],
+        [InlineKeyboardButton("🇪🇸 Español", callback_data="edit_post_lang_es")]
+    ])
+
+@functools.cache
 def build_send_time_menu():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("Отправить сейчас", callback_data="send_now")],
-        [InlineKeyboardButton("Запланировать", callback_data="schedule_post")]
+        [InlineKeyboardButton("Запланировать", callback_data="schedule_post")],
+        [InlineKeyboardButton("Повторять по расписанию", callback_data="recurring_post")]
     ])
 
+@functools.cache
 def build_confirm_menu():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("Да, отправить", callback_data="confirm_send")],
@@ -281,33 +575,125 @@ def build_inline_keyboard_status(request_id: str, lang: str, status: str = "init
     )
     return InlineKeyboardMarkup([[button]])
 
+# Кнопки готовых ответов для оператора, по две в ряд; None, если библиотека пуста
+def build_canned_menu():
+    library = canned.current()
+    if not len(library):
+        return None
+    buttons = [InlineKeyboardButton(key, callback_data=f"canned_{key}") for key in library.replies]
+    return InlineKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+
+@functools.cache
 def build_back_menu(lang):
     return InlineKeyboardMarkup([[InlineKeyboardButton(translations[lang]["back"], callback_data="back")]])
 
-def translate_text(text: str, target_lang: str) -> str:
-    try:
-        return GoogleTranslator(source='auto', target=target_lang).translate(text)
-    except Exception as e:
-        logger.error(f"Translation error: {e}")
-        return text
+async def render_variants(text: str) -> dict:
+    languages = list(translations)
+    results = await asyncio.gather(*(translate_cached(text, lang) for lang in languages))
+    return dict(zip(languages, results))
 
-def create_chat_history_file(conv: dict) -> str:
+# Картинка поста отправляется из хранилища media: по file_id, если этот бот её уже загружал, иначе файлом.
+# send — метод отправки фото (bot.send_photo с chat_id или message.reply_photo)
+async def send_post_photo(send, bot, media_id, **kwargs):
+    photo = await asyncio.to_thread(media.photo_input, media_id, bot.id)
+    try:
+        message = await send(photo=photo, **kwargs)
+    except BadRequest as e:
+        if not isinstance(photo, str):
+            raise
+        # file_id мог стать недействительным: загружаем файл заново
+        logger.warning(f"Cached file_id for media {media_id[:12]} rejected: {e}")
+        await asyncio.to_thread(media.forget_file_id, media_id, bot.id)
+        photo = await asyncio.to_thread(media.read, media_id)
+        message = await send(photo=photo, **kwargs)
+    if not isinstance(photo, str) and message.photo:
+        await asyncio.to_thread(media.remember_file_id, media_id, bot.id, message.photo[-1].file_id)
+    return message
+
+# Рассылка: получатели уже сгруппированы по языку, каждая группа получает готовый вариант текста.
+# Курсор сохраняется каждые BROADCAST_CHECKPOINT_EVERY получателей и при остановке
+active_broadcasts = set()
+
+async def send_broadcast(bot, post_data, audience, parse_mode=None, scheduled_post_id=None):
+    broadcast_id = create_broadcast(post_data, audience, parse_mode, scheduled_post_id)
+    return await run_broadcast(bot, broadcast_id, post_data, audience, parse_mode)
+
+async def run_broadcast(bot, broadcast_id, post_data, audience, parse_mode=None, cursor=0, sent=0):
+    reply_markup = None
+    if post_data.get("button_text") and post_data.get("button_url"):
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(post_data["button_text"], url=post_data["button_url"])]])
+    media_id = None
+    if post_data.get("image_path"):
+        try:
+            media_id = await media.resolve(post_data["image_path"])
+        except Exception as e:
+            logger.error(f"Failed to load post image {post_data['image_path']}: {e}")
+    variants = post_data.get("variants") or {}
+    recipients = [(user_lang, user_id) for user_lang, user_ids in audience.items() for user_id in user_ids]
+    active_broadcasts.add(broadcast_id)
+    last_checkpoint = time.monotonic()
+    try:
+        while cursor < len(recipients):
+            if shutdown.draining.is_set():
+                save_broadcast_cursor(broadcast_id, cursor, sent, status="paused")
+                logger.info(f"Broadcast {broadcast_id} paused at {cursor}/{len(recipients)}")
+                return sent
+            user_lang, user_id = recipients[cursor]
+            text = variants.get(user_lang, post_data["text"])
+            try:
+                if media_id:
+                    await send_post_photo(bot.send_photo, bot, media_id, chat_id=user_id, caption=text,
+                                          reply_markup=reply_markup, parse_mode=parse_mode)
+                else:
+                    await bot.send_message(chat_id=user_id, text=text, reply_markup=reply_markup, parse_mode=parse_mode)
+                sent += 1
+                events.record("broadcast", user_id, "delivered")
+            except Exception as e:
+                logger.error(f"Failed to send post to user {user_id}: {e}")
+                events.record("broadcast", user_id, "failed")
+            cursor += 1
+            if cursor % BROADCAST_CHECKPOINT_EVERY == 0 or time.monotonic() - last_checkpoint > BROADCAST_CHECKPOINT_INTERVAL:
+                save_broadcast_cursor(broadcast_id, cursor, sent)
+                last_checkpoint = time.monotonic()
+        finish_broadcast(broadcast_id)
+        logger.info(f"Broadcast {broadcast_id} finished: {sent}/{len(recipients)} delivered")
+    finally:
+        active_broadcasts.discard(broadcast_id)
+    return sent
+
+# Сообщения чата в хронологическом порядке: (время, отправитель, текст, перевод или None)
+# Переводы запрашиваются параллельно (число одновременных запросов ограничено в translation)
+async def build_transcript(conv: Conversation) -> list:
+    chat_history = await asyncio.to_thread(lambda: [(m.ts, m.sender, m.content) for m in conv.iter_history()])
+    for media in conv.media_files:
+        chat_history.append((media.ts, media.sender, f"{media.kind}: {media.caption} (ID: {media.message_id})"))
+    chat_history.sort(key=lambda x: x[0])
+    translations_needed = [translate_message(conv.language, sender, content) for _, sender, content in chat_history]
+    translated = await asyncio.gather(*translations_needed)
+    return [(timestamp, sender, content, translation)
+            for (timestamp, sender, content), translation in zip(chat_history, translated)]
+
+async def translate_message(language, sender, content):
+    if language == 'ru':
+        return None
+    if sender == 'user':
+        return await translate_text(content, 'ru')
+    if sender == 'operator':
+        return await translate_text(content, language)
+    return None
+
+def create_chat_history_file(conv: Conversation, messages: list) -> str:
+    return write_chat_history_file(conv.username, conv.user_id, conv.operator_name, messages)
+
+def write_chat_history_file(username, user_id, operator_name, messages: list) -> str:
     with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', suffix='.txt', delete=False) as temp_file:
-        temp_file.write(f"История чата с пользователем {conv['username']} (ID: {conv['user_id']}):\n\n")
-        chat_history = [(ts, s, c) for ts, s, c in conv.get('chat_history', [])]
-        for media_type, file_id, caption, sender, original_msg_id, *rest in conv.get('media_files', []):
-            chat_history.append((original_msg_id, sender, f"{media_type}: {caption} (ID: {original_msg_id})"))
-        chat_history.sort(key=lambda x: x[0])
+        temp_file.write(f"История чата с пользователем {username} (ID: {user_id}):\n\n")
         temp_file.write("Сообщения чата:\n")
-        for timestamp, sender, content in chat_history:
+        for timestamp, sender, content, translation in messages:
             time_str = datetime.fromtimestamp(timestamp).strftime('%d.%m.%Y %H:%M:%S')
-            sender_name = conv['username'] if sender == 'user' else f"Оператор {conv['operator_name']}"
-            if sender == 'user' and conv['language'] != 'ru':
-                translated_text = translate_text(content, 'ru')
-                temp_file.write(f"[{time_str}] {sender_name}: {content}\nПеревод: {translated_text}\n")
-            elif sender == 'operator' and conv['language'] != 'ru':
-                translated_text = translate_text(content, conv['language'])
-                temp_file.write(f"[{time_str}] {sender_name}: {content}\nПеревод: {translated_text}\n")
+            sender_name = username if sender == 'user' else f"Оператор {operator_name}"
+            if translation is not None:
+                temp_file.write(f"[{time_str}] {sender_name}: {content}\nПеревод: {translation}\n")
             else:
                 temp_file.write(f"[{time_str}] {sender_name}: {content}\n")
         temp_file_path = temp_file.name
@@ -323,7 +709,8 @@ async def error_handler(update: Update, context):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     username = update.message.from_user.username
-    logger.info(f"User {user_id} ({username}) triggered /start")
+    update_logger.info(f"User {user_id} ({username}) triggered /start")
+    events.record("start", user_id)
     lang = get_user_language(user_id)
 
     if lang == "en" and not is_language_set(user_id):
@@ -343,347 +730,458 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(f"{translations[lang]['hello']}\n{translations[lang]['choose_lang']}", reply_markup=build_menu(lang, user_id))
 
-async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    user_id = query.from_user.id
-    data = query.data
+# Маршрутизация нажатий на inline-кнопки. Каждый маршрут объявляет, какие данные профиля ему нужны:
+# "touch" — обновить last_interaction пользователя, "lang" — язык пользователя
+callback_router = CallbackRouter(observer=lambda route, user_id, status: events.record("button", user_id, route))
 
-    save_user(user_id, query.from_user.username, get_user_language(user_id))
-    logger.info(f"User {user_id} clicked button: {data}")
+@callback_router.loader("touch")
+def load_touch(req):
+    req.profile["lang"] = get_user_language(req.user_id)
+    save_user(req.user_id, req.query.from_user.username, req.profile["lang"])
 
-    if data.startswith("reply_"):
-        operator_id = query.from_user.id
-        request_id = data.split("reply_")[1]
-        logger.info(f"Operator {operator_id} processing reply for request_id: {request_id}")
+@callback_router.loader("lang")
+def load_lang(req):
+    if "lang" not in req.profile:
+        req.profile["lang"] = get_user_language(req.user_id)
 
-        if operator_id not in operator_ids:
-            await query.answer("Вы не оператор!", show_alert=True)
-            return
-
-        if request_id not in active_requests:
-            await query.answer("Запрос не найден.", show_alert=True)
-            return
+async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    update_logger.info(f"User {update.callback_query.from_user.id} clicked button: {update.callback_query.data}")
+    await callback_router.dispatch(update, context)
+
+async def support_request_text(conv):
+    display_text = f"Новый запрос в поддержку от {conv.username} (ID: {conv.user_id}):\n" + conv.recent_text()
+    if conv.language != 'ru':
+        translated_text = await translate_text(conv.recent_text(), 'ru')
+        display_text += f"\nПеревод: {translated_text}"
+    return display_text
+
+# Новый запрос предлагается одному оператору из очереди назначения (наименее загруженному);
+# если свободных нет, запрос ждёт в очереди. Без операторов запросы получает админ, без очереди
+# (WORKERS > 1) запрос рассылается всем операторам
+async def route_request(bot, conv):
+    if not operator_ids:
+        await notify_request(bot, conv, [ADMIN_ID])
+        return
+    if assignment_queue is None:
+        await notify_request(bot, conv, operator_ids)
+        return
+    operator_id = assignment_queue.submit(conv.request_id, conv.language, asyncio.get_running_loop().time())
+    if operator_id is not None:
+        await notify_request(bot, conv, [operator_id])
+    else:
+        logger.info(f"Request {conv.request_id} queued: all operators are at capacity")
 
-        conv = active_requests[request_id]
-        if conv.get('assigned_operator') is None:
-            conv['assigned_operator'] = operator_id
-            conv['operator_name'] = operator_names.get(operator_id, f"Оператор {operator_id}")
-            user_id = conv['user_id']
-            lang = conv['language']
-            active_conversations[user_id] = request_id
-            operator_active[operator_id] = request_id
-
-            display_text = f"Новый запрос в поддержку от {conv['username']} (ID: {conv['user_id']}):\n" + "\n".join(
-                [content for _, _, content in conv['chat_history']])
-            if lang != 'ru':
-                translated_text = translate_text("\n".join([content for _, _, content in conv['chat_history']]), 'ru')
-                display_text += f"\nПеревод: {translated_text}"
+async def notify_request(bot, conv, target_ids):
+    display_text = await support_request_text(conv)
+    inline_keyboard = build_inline_keyboard_status(conv.request_id, conv.language, status="initial")
+    for op_id in target_ids:
+        if op_id in conv.operator_messages:
+            continue
+        try:
+            msg = await bot.send_message(chat_id=op_id, text=display_text, reply_markup=inline_keyboard)
+            conv.operator_messages[op_id] = msg.message_id
+            logger.info(f"Запрос в техподдержку {conv.request_id} отправлен оператору {op_id}")
+        except Exception as e:
+            logger.error(f"Ошибка отправки оператору {op_id}: {e}")
 
-            for op_id, msg_id in conv['operator_messages'].items():
-                try:
-                    await context.bot.edit_message_text(chat_id=op_id, message_id=msg_id, text=display_text,
-                                                        reply_markup=build_inline_keyboard_status(request_id, lang,
-                                                                                                  status="accepted"))
-                    logger.info(f"Обновлено сообщение для оператора {op_id}")
-                except Exception as e:
-                    logger.error(f"Ошибка обновления сообщения для оператора {op_id}: {e}")
-
-            await context.bot.send_message(chat_id=user_id, text=translations[lang]["operator_joined"].format(
-                name=conv['operator_name']))
-            msg = await context.bot.send_message(chat_id=operator_id,
-                                                 text=translations["ru"]["operator_request_accepted"])
-            conv.setdefault("additional_operator_messages", []).append(
-                (operator_id, msg.message_id, translations["ru"]["operator_request_accepted"]))
-            await query.answer("Вы подключились к чату!")
-        else:
-            await query.answer(f"Этот запрос уже принял {conv['operator_name']}.", show_alert=True)
+# Запросы из очереди предлагаются освободившимся операторам
+async def offer_waiting(bot):
+    if assignment_queue is None:
         return
+    for request_id, operator_id in assignment_queue.dispatch(asyncio.get_running_loop().time()):
+        conv = active_requests.get(request_id)
+        if conv is None or conv.assigned_operator is not None:
+            assignment_queue.finish(request_id, None, 0)
+            continue
+        await notify_request(bot, conv, [operator_id])
 
-    elif data == "none":
-        await query.answer(translations[get_user_language(user_id)]["no_active_chat"])
+async def delete_query_message(query):
+    try:
+        await query.delete_message()
+    except Exception as e:
+        logger.warning(f"Failed to delete message: {e}")
+
+async def send_post_preview(message, lang, post_data, target_text):
+    preview_text = f"{translations[lang]['post_preview']}\n\n{post_data['text']}"
+    if post_data.get("button_text") and post_data.get("button_url"):
+        preview_text += f"\n\nКнопка: {post_data['button_text']} ({post_data['button_url']})"
+    if post_data["send_time"] == "now":
+        await message.reply_text(
+            f"{preview_text}\n\n{target_text}\n\n{translations[lang]['post_confirm_send_now']}",
+            reply_markup=build_confirm_menu())
+    else:
+        await message.reply_text(
+            f"{preview_text}\n\n{target_text}\n\n{translations[lang]['post_confirm_schedule'].format(time=post_data['send_time'])}",
+            reply_markup=build_confirm_menu())
+
+@callback_router.route("reply_*")
+async def cb_reply(req, context):
+    query = req.query
+    operator_id = req.user_id
+    request_id = req.arg
+    logger.info(f"Operator {operator_id} processing reply for request_id: {request_id}")
+
+    if operator_id not in operator_ids:
+        await query.answer("Вы не оператор!", show_alert=True)
         return
 
-    elif data == "end_chat":
-        await finish_conversation(user_id, context, initiator="operator", update=update)
+    if request_id not in active_requests:
+        await query.answer("Запрос не найден.", show_alert=True)
         return
 
-    if data.startswith("lang_"):
-        lang = data.split("_")[1]
-        user_languages[user_id] = lang
-        save_user(user_id, query.from_user.username, lang)
-        await query.edit_message_text(translations[lang]["hello"], reply_markup=build_menu(lang, user_id))
-        await query.answer()
-        return
+    conv = active_requests[request_id]
+    if conv.assigned_operator is None:
+        conv.assigned_operator = operator_id
+        conv.operator_name = operator_names.get(operator_id, f"Оператор {operator_id}")
+        user_id = conv.user_id
+        events.record("support", user_id, "accepted", asyncio.get_event_loop().time() - conv.created_at)
+        lang = conv.language
+        active_conversations[user_id] = request_id
+        operator_active[operator_id] = request_id
+        workers.bind_operator(operator_id)
 
-    lang = get_user_language(user_id)
+        wait = None
+        if assignment_queue is not None:
+            wait = assignment_queue.accept(request_id, operator_id, asyncio.get_event_loop().time())
+        if wait is not None:
+            logger.info(f"Request {request_id} accepted by operator {operator_id} after {wait:.0f}s")
+        display_text = await support_request_text(conv)
 
-    if data in ["about", "earn", "withdraw", "rules"]:
-        post_text, image_url = get_post(data, lang)
-        try:
-            if image_url:
-                response = requests.get(image_url, timeout=10)
-                response.raise_for_status()
-                image_data = BytesIO(response.content)
-
-                await query.message.reply_photo(
-                    photo=image_data,
-                    caption=post_text,
-                    reply_markup=build_back_menu(lang),
-                    parse_mode="HTML"
-                )
-            else:
-                await query.message.reply_text(
-                    f"{post_text}\n\n{translations[lang]['image_not_found']}",
-                    reply_markup=build_back_menu(lang),
-                    parse_mode="HTML"
-                )
+        for op_id, msg_id in conv.operator_messages.items():
             try:
-                await query.delete_message()
+                await context.bot.edit_message_text(chat_id=op_id, message_id=msg_id, text=display_text,
+                                                    reply_markup=build_inline_keyboard_status(request_id, lang,
+                                                                                              status="accepted"))
+                logger.info(f"Обновлено сообщение для оператора {op_id}")
             except Exception as e:
-                logger.warning(f"Failed to delete message: {e}")
-        except requests.RequestException as e:
-            logger.error(f"Failed to fetch image for post {data} ({lang}) from {image_url}: {e}")
-            await query.message.reply_text(
-                f"{post_text}\n\n{translations[lang]['image_not_found']}",
+                logger.error(f"Ошибка обновления сообщения для оператора {op_id}: {e}")
+
+        await context.bot.send_message(chat_id=user_id, text=translations[lang]["operator_joined"].format(
+            name=conv.operator_name))
+        msg = await context.bot.send_message(chat_id=operator_id,
+                                             text=translations["ru"]["operator_request_accepted"],
+                                             reply_markup=build_canned_menu())
+        conv.track_message(operator_id, msg.message_id)
+        await query.answer("Вы подключились к чату!")
+    else:
+        await query.answer(f"Этот запрос уже принял {conv.operator_name}.", show_alert=True)
+
+@callback_router.route("canned_*")
+async def cb_canned(req, context):
+    if req.user_id not in operator_ids:
+        await req.query.answer("Вы не оператор!", show_alert=True)
+        return
+    conv = active_requests.get(operator_active.get(req.user_id))
+    if conv is None:
+        await req.query.answer(translations["ru"]["operator_no_active_chat"], show_alert=True)
+        return
+    reply = canned.current().get(req.arg)
+    if reply is None:
+        await req.query.answer("Этого ответа больше нет в библиотеке.", show_alert=True)
+        return
+    # Перевод на язык пользователя готов заранее, переводчик не вызывается
+    canned.record_send(reply, conv.language)
+    await send_operator_reply(context.bot, conv, reply.text_for(conv.language))
+    await req.query.answer("Отправлено")
+    msg = await context.bot.send_message(chat_id=req.user_id, text=f"📋 {reply.text}")
+    conv.track_message(req.user_id, msg.message_id)
+
+@callback_router.route("none", needs=("lang",))
+async def cb_none(req, context):
+    await req.query.answer(translations[req.lang]["no_active_chat"])
+
+@callback_router.route("end_chat")
+async def cb_end_chat(req, context):
+    await finish_conversation(req.user_id, context, initiator="operator", update=None)
+
+@callback_router.route("lang_*")
+async def cb_lang(req, context):
+    lang = req.arg
+    user_languages[req.user_id] = lang
+    save_user(req.user_id, req.query.from_user.username, lang)
+    await req.query.edit_message_text(translations[lang]["hello"], reply_markup=build_menu(lang, req.user_id))
+    await req.query.answer()
+
+@callback_router.route("about", "earn", "withdraw", "rules", needs=("touch", "lang"))
+async def cb_post(req, context):
+    query, lang, data = req.query, req.lang, req.data
+    post_text, image_url = get_post(data, lang)
+    try:
+        if image_url:
+            media_id = await media.resolve(image_url)
+            await send_post_photo(
+                query.message.reply_photo,
+                context.bot,
+                media_id,
+                caption=post_text,
                 reply_markup=build_back_menu(lang),
                 parse_mode="HTML"
             )
-            try:
-                await query.delete_message()
-            except Exception as e:
-                logger.warning(f"Failed to delete message: {e}")
-        except Exception as e:
-            logger.error(f"Failed to send post {data} ({lang}): {e}")
+        else:
             await query.message.reply_text(
-                translations[lang]["error_message"],
-                reply_markup=build_back_menu(lang)
+                f"{post_text}\n\n{translations[lang]['image_not_found']}",
+                reply_markup=build_back_menu(lang),
+                parse_mode="HTML"
             )
-            try:
-                await query.delete_message()
-            except Exception as e:
-                logger.warning(f"Failed to delete message: {e}")
-        return
+        await delete_query_message(query)
+    except (httpx.HTTPError, media.MediaError, OSError) as e:
+        logger.error(f"Failed to fetch image for post {data} ({lang}) from {image_url}: {e}")
+        await query.message.reply_text(
+            f"{post_text}\n\n{translations[lang]['image_not_found']}",
+            reply_markup=build_back_menu(lang),
+            parse_mode="HTML"
+        )
+        await delete_query_message(query)
+    except Exception as e:
+        logger.error(f"Failed to send post {data} ({lang}): {e}")
+        await query.message.reply_text(
+            translations[lang]["error_message"],
+            reply_markup=build_back_menu(lang)
+        )
+        await delete_query_message(query)
 
-    elif data == "settings":
-        await query.edit_message_text(translations[lang]["settings"], reply_markup=build_settings_menu(lang, user_id))
-        await query.answer()
-        return
+@callback_router.route("settings", needs=("touch", "lang"))
+async def cb_settings(req, context):
+    await req.query.edit_message_text(translations[req.lang]["settings"], reply_markup=build_settings_menu(req.lang, req.user_id))
+    await req.query.answer()
 
-    elif data == "support":
-        if user_id in waiting_for_question:
-            await query.message.reply_text(translations[lang]["waiting_question"])
-            return
-        if user_id in active_conversations:
-            await query.message.reply_text(translations[lang]["already_active"])
-            return
-        waiting_for_question[user_id] = True
+@callback_router.route("support", needs=("touch", "lang"))
+async def cb_support(req, context):
+    query, lang, user_id = req.query, req.lang, req.user_id
+    if user_id in waiting_for_question:
         await query.message.reply_text(translations[lang]["waiting_question"])
-        try:
-            await query.delete_message()
-        except Exception as e:
-            logger.warning(f"Failed to delete message: {e}")
-        return
-
-    elif data == "change_language":
-        await query.edit_message_text(translations[lang]["choose_lang"], reply_markup=build_lang_menu())
-        await query.answer()
         return
-
-    elif data == "back":
-        await query.message.reply_text(translations[lang]["hello"], reply_markup=build_menu(lang, user_id))
-        try:
-            await query.delete_message()
-        except Exception as e:
-            logger.warning(f"Failed to delete message: {e}")
-        return
-
-    elif data == "create_post":
-        if user_id != ADMIN_ID:
-            await query.message.reply_text(translations[lang]["admin_only_message"])
-            return
-        context.user_data["create_post"] = {"step": "text"}
-        await query.message.reply_text(translations[lang]["post_media_prompt"])
-        try:
-            await query.delete_message()
-        except Exception as e:
-            logger.warning(f"Failed to delete message: {e}")
-        return
-
-    if data.startswith("post_lang_"):
-        lang_choice = data.split("_")[2]
-        context.user_data["create_post"]["post_lang"] = lang_choice if lang_choice != "user" else None
-        context.user_data["create_post"]["step"] = "media"
-        await query.message.reply_text(translations[lang]["post_media_prompt"], reply_markup=InlineKeyboardMarkup(
-            [[InlineKeyboardButton(translations[lang]["skip"], callback_data="skip_media")]]))
-        try:
-            await query.delete_message()
-        except Exception as e:
-            logger.warning(f"Failed to delete message: {e}")
+    if user_id in active_conversations:
+        await query.message.reply_text(translations[lang]["already_active"])
         return
-
-    elif data == "recipients_all":
-        context.user_data["create_post"]["target_users"] = "all"
-        context.user_data["create_post"]["target_lang"] = None
-        context.user_data["create_post"]["step"] = "confirm"
-        post_data = context.user_data["create_post"]
-        preview_text = f"{translations[lang]['post_preview']}\n\n{post_data['text']}"
-        if post_data.get("button_text") and post_data.get("button_url"):
-            preview_text += f"\n\nКнопка: {post_data['button_text']} ({post_data['button_url']})"
-        target_text = "Получатели: Все пользователи"
-        if post_data["send_time"] == "now":
-            await query.message.reply_text(
-                f"{preview_text}\n\n{target_text}\n\n{translations[lang]['post_confirm_send_now']}",
-                reply_markup=build_confirm_menu())
-        else:
-            await query.message.reply_text(
-                f"{preview_text}\n\n{target_text}\n\n{translations[lang]['post_confirm_schedule'].format(time=post_data['send_time'])}",
-                reply_markup=build_confirm_menu())
-        try:
-            await query.delete_message()
-        except Exception as e:
-            logger.warning(f"Failed to delete message: {e}")
+    waiting_for_question[user_id] = True
+    events.record("support", user_id, "requested")
+    await query.message.reply_text(translations[lang]["waiting_question"])
+    await delete_query_message(query)
+
+@callback_router.route("change_language", needs=("touch", "lang"))
+async def cb_change_language(req, context):
+    await req.query.edit_message_text(translations[req.lang]["choose_lang"], reply_markup=build_lang_menu())
+    await req.query.answer()
+
+@callback_router.route("back", needs=("touch", "lang"))
+async def cb_back(req, context):
+    await req.query.message.reply_text(translations[req.lang]["hello"], reply_markup=build_menu(req.lang, req.user_id))
+    await delete_query_message(req.query)
+
+# Мастер создания поста (только администратор)
+@callback_router.route("create_post", needs=("lang",))
+async def cb_create_post(req, context):
+    if req.user_id != ADMIN_ID:
+        await req.query.message.reply_text(translations[req.lang]["admin_only_message"])
         return
-
-    elif data == "recipients_by_lang":
-        context.user_data["create_post"]["step"] = "recipient_lang"
-        await query.message.reply_text(translations[lang]["post_recipients_prompt"],
+    context.user_data["create_post"] = {"step": "text"}
+    await req.query.message.reply_text(translations[req.lang]["post_media_prompt"])
+    await delete_query_message(req.query)
+
+@callback_router.route("post_lang_*", needs=("lang",))
+async def cb_post_lang(req, context):
+    lang_choice = req.arg
+    context.user_data["create_post"]["post_lang"] = lang_choice if lang_choice != "user" else None
+    context.user_data["create_post"]["step"] = "media"
+    await req.query.message.reply_text(translations[req.lang]["post_media_prompt"], reply_markup=InlineKeyboardMarkup(
+        [[InlineKeyboardButton(translations[req.lang]["skip"], callback_data="skip_media")]]))
+    await delete_query_message(req.query)
+
+@callback_router.route("recipients_all", needs=("lang",))
+async def cb_recipients_all(req, context):
+    context.user_data["create_post"]["target_users"] = "all"
+    context.user_data["create_post"]["target_lang"] = None
+    context.user_data["create_post"]["step"] = "confirm"
+    total = await asyncio.to_thread(segments.count, "")
+    await send_post_preview(req.query.message, req.lang, context.user_data["create_post"],
+                            f"Получатели: Все пользователи ({total})")
+    await delete_query_message(req.query)
+
+@callback_router.route("recipients_by_lang", needs=("lang",))
+async def cb_recipients_by_lang(req, context):
+    context.user_data["create_post"]["step"] = "recipient_lang"
+    await req.query.message.reply_text(translations[req.lang]["post_recipients_prompt"],
                                        reply_markup=build_recipient_lang_menu())
-        try:
-            await query.delete_message()
-        except Exception as e:
-            logger.warning(f"Failed to delete message: {e}")
-        return
-
-    elif data == "recipients_specific":
-        context.user_data["create_post"]["step"] = "recipient_ids"
-        await query.message.reply_text(translations[lang]["post_recipient_ids_prompt"])
-        try:
-            await query.delete_message()
-        except Exception as e:
-            logger.warning(f"Failed to delete message: {e}")
-        return
-
-    elif data.startswith("recipient_lang_"):
-        lang_choice = data.split("_")[2]
-        context.user_data["create_post"]["target_lang"] = lang_choice
-        context.user_data["create_post"]["target_users"] = "by_lang"
-        context.user_data["create_post"]["step"] = "confirm"
-        post_data = context.user_data["create_post"]
-        preview_text = f"{translations[lang]['post_preview']}\n\n{post_data['text']}"
-        if post_data.get("button_text") and post_data.get("button_url"):
-            preview_text += f"\n\nКнопка: {post_data['button_text']} ({post_data['button_url']})"
-        target_text = f"Получатели: Пользователи с языком {lang_choice}"
-        if post_data["send_time"] == "now":
-            await query.message.reply_text(
-                f"{preview_text}\n\n{target_text}\n\n{translations[lang]['post_confirm_send_now']}",
-                reply_markup=build_confirm_menu())
-        else:
-            await query.message.reply_text(
-                f"{preview_text}\n\n{target_text}\n\n{translations[lang]['post_confirm_schedule'].format(time=post_data['send_time'])}",
-                reply_markup=build_confirm_menu())
-        try:
-            await query.delete_message()
-        except Exception as e:
-            logger.warning(f"Failed to delete message: {e}")
+    await delete_query_message(req.query)
+
+@callback_router.route("recipients_specific", needs=("lang",))
+async def cb_recipients_specific(req, context):
+    context.user_data["create_post"]["step"] = "recipient_ids"
+    await req.query.message.reply_text(translations[req.lang]["post_recipient_ids_prompt"])
+    await delete_query_message(req.query)
+
+@callback_router.route("recipient_lang_*", needs=("lang",))
+async def cb_recipient_lang(req, context):
+    lang_choice = req.arg
+    context.user_data["create_post"]["target_lang"] = lang_choice
+    context.user_data["create_post"]["target_users"] = "by_lang"
+    context.user_data["create_post"]["step"] = "confirm"
+    total = await asyncio.to_thread(segments.count, f"lang:{lang_choice}")
+    await send_post_preview(req.query.message, req.lang, context.user_data["create_post"],
+                            f"Получатели: Пользователи с языком {lang_choice} ({total})")
+    await delete_query_message(req.query)
+
+# Сегмент: сохранённый (кнопка) или определение, присланное текстом (шаг recipient_segment)
+@callback_router.route("recipients_segment", needs=("lang",))
+async def cb_recipients_segment(req, context):
+    context.user_data["create_post"]["step"] = "recipient_segment"
+    saved = await asyncio.to_thread(segments.list_segments)
+    await req.query.message.reply_text(
+        "Выберите сохранённый сегмент или отправьте условие, например:\nlang:ru,uk active<7d -event:register",
+        reply_markup=build_recipient_segment_menu(saved) if saved else None)
+    await delete_query_message(req.query)
+
+@callback_router.route("recipient_segment_*", needs=("lang",))
+async def cb_recipient_segment(req, context):
+    name = await asyncio.to_thread(segments.find_by_key, req.arg)
+    if name is None:
+        await req.query.message.reply_text("Сегмент не найден, выберите другой или отправьте условие.")
         return
+    await choose_segment(req.query.message, req.lang, context, f"@{name}")
+    await delete_query_message(req.query)
 
-    elif data == "skip_media":
-        context.user_data["create_post"]["image_path"] = None
-        context.user_data["create_post"]["step"] = "button"
-        await query.message.reply_text(translations[lang]["post_button_prompt"])
-        try:
-            await query.delete_message()
-        except Exception as e:
-            logger.warning(f"Failed to delete message: {e}")
-        return
-
-    elif data == "skip_button":
-        context.user_data["create_post"]["button_text"] = None
-        context.user_data["create_post"]["button_url"] = None
-        context.user_data["create_post"]["step"] = "send_time"
-        await query.message.reply_text(translations[lang]["post_send_time_prompt"], reply_markup=build_send_time_menu())
-        try:
-            await query.delete_message()
-        except Exception as e:
-            logger.warning(f"Failed to delete message: {e}")
+async def choose_segment(message, lang, context, spec):
+    try:
+        total = await asyncio.to_thread(segments.count, spec)
+    except segments.SegmentError as e:
+        await message.reply_text(f"Ошибка в условии: {e}")
         return
-
-    elif data == "send_now":
-        context.user_data["create_post"]["send_time"] = "now"
-        context.user_data["create_post"]["step"] = "recipients"
-        await query.message.reply_text(translations[lang]["post_recipients_prompt"],
+    post_data = context.user_data["create_post"]
+    post_data.update(target_users="segment", target_segment=spec, target_lang=None, step="confirm")
+    await send_post_preview(message, lang, post_data, f"Получатели: сегмент {spec} ({total})")
+
+@callback_router.route("skip_media", needs=("lang",))
+async def cb_skip_media(req, context):
+    context.user_data["create_post"]["image_path"] = None
+    context.user_data["create_post"]["step"] = "button"
+    await req.query.message.reply_text(translations[req.lang]["post_button_prompt"])
+    await delete_query_message(req.query)
+
+@callback_router.route("skip_button", needs=("lang",))
+async def cb_skip_button(req, context):
+    context.user_data["create_post"]["button_text"] = None
+    context.user_data["create_post"]["button_url"] = None
+    context.user_data["create_post"]["step"] = "send_time"
+    await req.query.message.reply_text(translations[req.lang]["post_send_time_prompt"], reply_markup=build_send_time_menu())
+    await delete_query_message(req.query)
+
+@callback_router.route("send_now", needs=("lang",))
+async def cb_send_now(req, context):
+    context.user_data["create_post"]["send_time"] = "now"
+    context.user_data["create_post"]["step"] = "recipients"
+    await req.query.message.reply_text(translations[req.lang]["post_recipients_prompt"],
                                        reply_markup=build_recipient_menu())
+    await delete_query_message(req.query)
+
+@callback_router.route("schedule_post", needs=("lang",))
+async def cb_schedule_post(req, context):
+    context.user_data["create_post"]["step"] = "schedule_time"
+    await req.query.message.reply_text(translations[req.lang]["post_schedule_time_prompt"])
+    await delete_query_message(req.query)
+
+@callback_router.route("recurring_post", needs=("lang",))
+async def cb_recurring_post(req, context):
+    context.user_data["create_post"]["step"] = "recurrence"
+    await req.query.message.reply_text(
+        "Как часто отправлять пост? Например:\n"
+        "ежедневно 10:00\n"
+        "еженедельно пн,чт 18:30\n"
+        "каждые 12h (m — минуты, h — часы, d — дни, w — недели)\n"
+        "0 10 * * 1-5 (cron: минута, час, день, месяц, день недели)")
+    await delete_query_message(req.query)
+
+@callback_router.route("confirm_send", needs=("lang",))
+async def cb_confirm_send(req, context):
+    lang = req.lang
+    post_data = context.user_data["create_post"]
+    # "На языке пользователя": текст переводится один раз на каждый язык и хранится вместе с постом
+    if not post_data.get("post_lang"):
+        post_data["variants"] = await render_variants(post_data["text"])
+
+    if post_data["send_time"] == "now":
+        audience = get_audience(post_data["target_users"], post_data.get("target_lang"), post_data.get("specific_users"),
+                                post_data.get("target_segment"))
+        await send_broadcast(context.bot, post_data, audience)
+        await req.query.message.reply_text(translations[lang]["post_sent"])
+    elif post_data.get("recurrence"):
         try:
-            await query.delete_message()
-        except Exception as e:
-            logger.warning(f"Failed to delete message: {e}")
+            campaign_id, next_run = await asyncio.to_thread(
+                campaigns.create, json.dumps({key: post_data.get(key) for key in BROADCAST_FIELDS}, ensure_ascii=False),
+                encode_target_users(post_data), post_data.get("target_lang"), post_data["recurrence"], store=TENANT)
+        except campaigns.CampaignError as e:
+            await req.query.message.reply_text(f"Кампания не создана: {e}")
+            return
+        await req.query.message.reply_text(f"Кампания #{campaign_id} создана ({post_data['recurrence']}), первая рассылка "
+                                           f"{next_run:%Y-%m-%d %H:%M}. Управление: /campaigns")
+    else:
+        save_scheduled_post(post_data["text"], post_data.get("image_path"), post_data.get("button_text"),
+                            post_data.get("button_url"), post_data["send_time"], post_data.get("target_lang"),
+                            encode_target_users(post_data), post_data.get("variants"))
+        await req.query.message.reply_text(translations[lang]["post_scheduled"].format(time=post_data["send_time"]))
+    context.user_data.pop("create_post", None)
+    await delete_query_message(req.query)
+
+# Получатели запланированного поста в колонке target_users: "all", "by_lang", "segment:<условие>" или список ID
+def encode_target_users(post_data):
+    if post_data["target_users"] == "specific":
+        return ",".join(map(str, post_data["specific_users"]))
+    if post_data["target_users"] == "segment":
+        return f"segment:{post_data['target_segment']}"
+    return post_data["target_users"]
+
+def decode_target_users(target_users):
+    # (target_users, specific_users, target_segment) для get_audience
+    if target_users.startswith("segment:"):
+        return "segment", None, target_users[len("segment:"):]
+    if target_users not in ("all", "by_lang"):
+        return "specific", [int(uid) for uid in target_users.split(",")], None
+    return target_users, None, None
+
+# Редактирование постов меню (только администратор)
+@callback_router.route("edit_post", needs=("lang",))
+async def cb_edit_post(req, context):
+    if req.user_id != ADMIN_ID:
+        await req.query.message.reply_text(translations[req.lang]["admin_only_message"])
         return
+    context.user_data["edit_post"] = {"step": "type"}
+    await req.query.message.reply_text("Какой пост редактировать?", reply_markup=build_edit_post_type_menu())
+    await delete_query_message(req.query)
 
-    elif data == "schedule_post":
-        context.user_data["create_post"]["step"] = "schedule_time"
-        await query.message.reply_text(translations[lang]["post_schedule_time_prompt"])
-        try:
-            await query.delete_message()
-        except Exception as e:
-            logger.warning(f"Failed to delete message: {e}")
+@callback_router.route("edit_post_type_*", needs=("lang",))
+async def cb_edit_post_type(req, context):
+    if req.user_id != ADMIN_ID or "edit_post" not in context.user_data:
         return
+    context.user_data["edit_post"].update(post_type=req.arg, step="language")
+    await req.query.message.reply_text("Для какого языка?", reply_markup=build_edit_post_lang_menu())
+    await delete_query_message(req.query)
 
-    elif data == "confirm_send":
-        post_data = context.user_data["create_post"]
-        target_users = []
-        if post_data["target_users"] == "all":
-            target_users = get_all_users()
-        elif post_data["target_users"] == "by_lang":
-            target_users = get_users_by_language(post_data["target_lang"])
-        elif post_data["target_users"] == "specific":
-            target_users = post_data["specific_users"]
-
-        if post_data["send_time"] == "now":
-            for user_id in target_users:
-                try:
-                    user_lang = get_user_language(user_id) if not post_data.get("post_lang") else post_data["post_lang"]
-                    if post_data.get("image_path"):
-                        response = requests.get(post_data["image_path"], timeout=10)
-                        response.raise_for_status()
-                        image_data = BytesIO(response.content)
-                        if post_data.get("button_text") and post_data.get("button_url"):
-                            await context.bot.send_photo(chat_id=user_id, photo=image_data, caption=post_data["text"],
-                                                         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
-                                                             post_data["button_text"], url=post_data["button_url"])]]))
-                        else:
-                            await context.bot.send_photo(chat_id=user_id, photo=image_data, caption=post_data["text"])
-                    else:
-                        if post_data.get("button_text") and post_data.get("button_url"):
-                            await context.bot.send_message(chat_id=user_id, text=post_data["text"],
-                                                           reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
-                                                               post_data["button_text"],
-                                                               url=post_data["button_url"])]]))
-                        else:
-                            await context.bot.send_message(chat_id=user_id, text=post_data["text"])
-                except Exception as e:
-                    logger.error(f"Failed to send post to user {user_id}: {e}")
-            await query.message.reply_text(translations[lang]["post_sent"])
-        else:
-            save_scheduled_post(post_data["text"], post_data.get("image_path"), post_data.get("button_text"),
-                                post_data.get("button_url"), post_data["send_time"], post_data.get("target_lang"),
-                                ",".join(map(str, target_users)) if post_data["target_users"] == "specific" else
-                                post_data["target_users"])
-            await query.message.reply_text(translations[lang]["post_scheduled"].format(time=post_data["send_time"]))
-        context.user_data.pop("create_post", None)
-        try:
-            await query.delete_message()
-        except Exception as e:
-            logger.warning(f"Failed to delete message: {e}")
-        return
-
-    elif data == "cancel_send":
-        context.user_data.pop("create_post", None)
-        await query.message.reply_text(translations[lang]["post_canceled"])
-        try:
-            await query.delete_message()
-        except Exception as e:
-            logger.warning(f"Failed to delete message: {e}")
+@callback_router.route("edit_post_lang_*", needs=("lang",))
+async def cb_edit_post_lang(req, context):
+    if req.user_id != ADMIN_ID or "edit_post" not in context.user_data:
         return
+    edit = context.user_data["edit_post"]
+    edit.update(language=req.arg, step="text")
+    current_text, current_image = posts_catalog.current().posts.get((edit["post_type"], req.arg), (None, None))
+    edit["image_path"] = current_image
+    message = f"Текущий текст:\n\n{current_text}\n\n" if current_text else "Поста для этого языка пока нет.\n\n"
+    await req.query.message.reply_text(message + "Отправьте новый текст поста (HTML):")
+    await delete_query_message(req.query)
+
+@callback_router.route("cancel_send", needs=("lang",))
+async def cb_cancel_send(req, context):
+    context.user_data.pop("create_post", None)
+    await req.query.message.reply_text(translations[req.lang]["post_canceled"])
+    await delete_query_message(req.query)
+
+# Ответ оператора пользователю: сообщение попадает в историю чата, первый ответ учитывается в статистике
+async def send_operator_reply(bot, conv, text):
+    conv.last_activity = asyncio.get_event_loop().time()
+    if conv.first_response_at is None:
+        conv.first_response_at = conv.last_activity
+        events.record("support", conv.user_id, "first_response", conv.first_response_at - conv.created_at)
+    conv.add_message('operator', text)
+    await bot.send_message(chat_id=conv.user_id, text=text)
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
@@ -695,11 +1193,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             req_id = operator_active[user_id]
             conv = active_requests.get(req_id)
             if conv:
-                conv['last_activity'] = asyncio.get_event_loop().time()
-                user_id = conv.get('user_id')
-                conv.setdefault("chat_history", []).append((datetime.now().timestamp(), 'operator', text))
-                conv.setdefault("additional_operator_messages", []).append((user_id, update.message.message_id, text))
-                await context.bot.send_message(chat_id=user_id, text=text)
+                conv.track_message(conv.user_id, update.message.message_id)
+                await send_operator_reply(context.bot, conv, text)
             else:
                 await update.message.reply_text(translations["ru"]["operator_error_chat_not_found"], reply_markup=build_inline_keyboard_status("", "ru", "finished"))
         else:
@@ -718,19 +1213,36 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(translations["ru"]["choose_lang"], reply_markup=build_lang_menu())
         return
 
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-    result = c.fetchone()
-    conn.close()
-    if result is None:
+    if not user_exists(user_id):
         waiting_for_language[user_id] = True
         await update.message.reply_text(translations["ru"]["choose_lang"], reply_markup=build_lang_menu())
         return
 
+    if "edit_post" in context.user_data and user_id == ADMIN_ID:
+        edit = context.user_data["edit_post"]
+        if edit["step"] == "text":
+            edit["text"] = text
+            edit["step"] = "image"
+            await update.message.reply_text("Отправьте фото или ссылку на изображение, '-' чтобы оставить текущее или 'нет' чтобы убрать:")
+        elif edit["step"] == "image":
+            if text == "-":
+                image_path = edit.get("image_path")
+            elif text.lower() == "нет":
+                image_path = None
+            else:
+                image_path = await ingest_post_image(update.message, text)
+                if image_path is None:
+                    return
+            await save_edited_post(update.message, context, image_path)
+        return
+
     if "create_post" in context.user_data:
         step = context.user_data["create_post"]["step"]
-        if step == "text":
+        if step == "media":
+            image_path = await ingest_post_image(update.message, text)
+            if image_path is not None:
+                await set_post_image(update.message, context, lang, image_path)
+        elif step == "text":
             context.user_data["create_post"]["text"] = text
             context.user_data["create_post"]["step"] = "post_lang"
             await update.message.reply_text(translations[lang]["post_media_prompt"], reply_markup=build_post_lang_menu())
@@ -759,6 +1271,16 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text(translations[lang]["post_recipients_prompt"], reply_markup=build_recipient_menu())
             except ValueError:
                 await update.message.reply_text(translations[lang]["post_time_format_error"])
+        elif step == "recurrence":
+            try:
+                campaigns.parse_recurrence(text)
+            except campaigns.CampaignError as e:
+                await update.message.reply_text(f"{e}. Попробуйте ещё раз:")
+                return
+            context.user_data["create_post"]["recurrence"] = text
+            context.user_data["create_post"]["send_time"] = text
+            context.user_data["create_post"]["step"] = "recipients"
+            await update.message.reply_text(translations[lang]["post_recipients_prompt"], reply_markup=build_recipient_menu())
         elif step == "recipient_ids":
             try:
                 user_ids = [int(uid.strip()) for uid in text.split(",")]
@@ -766,71 +1288,38 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 context.user_data["create_post"]["target_users"] = "specific"
                 context.user_data["create_post"]["target_lang"] = None
                 context.user_data["create_post"]["step"] = "confirm"
-                post_data = context.user_data["create_post"]
-                preview_text = f"{translations[lang]['post_preview']}\n\n{post_data['text']}"
-                if post_data.get("button_text") and post_data.get("button_url"):
-                    preview_text += f"\n\nКнопка: {post_data['button_text']} ({post_data['button_url']})"
-                target_text = f"Получатели: {', '.join(map(str, user_ids))}"
-                if post_data["send_time"] == "now":
-                    await update.message.reply_text(f"{preview_text}\n\n{target_text}\n\n{translations[lang]['post_confirm_send_now']}", reply_markup=build_confirm_menu())
-                else:
-                    await update.message.reply_text(f"{preview_text}\n\n{target_text}\n\n{translations[lang]['post_confirm_schedule'].format(time=post_data['send_time'])}", reply_markup=build_confirm_menu())
+                await send_post_preview(update.message, lang, context.user_data["create_post"],
+                                        f"Получатели: {', '.join(map(str, user_ids))}")
             except ValueError:
                 await update.message.reply_text(translations[lang]["post_recipient_ids_error"])
+        elif step == "recipient_segment":
+            await choose_segment(update.message, lang, context, text)
         return
 
     if user_id in waiting_for_question:
-        request_id = str(uuid.uuid4())
-        active_requests[request_id] = {
-            'user_id': user_id,
-            'username': update.message.from_user.first_name,
-            'question': text,
-            'chat_history': [(datetime.now().timestamp(), 'user', text)],
-            'language': lang,
-            'assigned_operator': None,
-            'operator_name': None,
-            'operator_messages': {},
-            'additional_operator_messages': [],
-            'media_files': [],
-            'created_at': asyncio.get_event_loop().time(),
-            'last_activity': asyncio.get_event_loop().time()
-        }
+        request_id = workers.new_request_id()
+        conv = Conversation(request_id, user_id, update.message.from_user.first_name, lang, asyncio.get_event_loop().time())
+        conv.add_message('user', text)
+        active_requests[request_id] = conv
         active_conversations[user_id] = request_id
         waiting_for_question.pop(user_id, None)
+        events.record("support", user_id, "created")
 
         await update.message.reply_text(translations[lang]["request_sent"])
-
-        display_text = f"Новый запрос в поддержку от {update.message.from_user.first_name} (ID: {user_id}):\n{text}"
-        if lang != 'ru':
-            translated_text = translate_text(text, 'ru')
-            display_text += f"\nПеревод: {translated_text}"
-
-        inline_keyboard = build_inline_keyboard_status(request_id, lang, status="initial")
-        target_ids = operator_ids if operator_ids else [ADMIN_ID]
-        for op_id in target_ids:
-            try:
-                msg = await context.bot.send_message(chat_id=op_id, text=display_text, reply_markup=inline_keyboard)
-                active_requests[request_id]["operator_messages"][op_id] = msg.message_id
-                logger.info(f"Запрос в техподдержку {request_id} отправлен оператору {op_id}")
-            except Exception as e:
-                logger.error(f"Ошибка отправки оператору {op_id}: {e}")
+        await route_request(context.bot, conv)
         return
 
     if user_id in active_conversations:
         req_id = active_conversations[user_id]
         conv = active_requests.get(req_id)
         if conv:
-            conv['last_activity'] = asyncio.get_event_loop().time()
-            conv.setdefault('chat_history', []).append((datetime.now().timestamp(), 'user', text))
+            conv.last_activity = asyncio.get_event_loop().time()
+            conv.add_message('user', text)
 
-            if conv.get('assigned_operator') is None:
-                display_text = f"Новый запрос в поддержку от {update.message.from_user.first_name} (ID: {user_id}):\n" + "\n".join(
-                    [content for _, _, content in conv['chat_history']])
-                if lang != 'ru':
-                    translated_text = translate_text("\n".join([content for _, _, content in conv['chat_history']]), 'ru')
-                    display_text += f"\nПеревод: {translated_text}"
+            if conv.assigned_operator is None:
+                display_text = await support_request_text(conv)
 
-                for op_id, msg_id in conv['operator_messages'].items():
+                for op_id, msg_id in conv.operator_messages.items():
                     try:
                         await context.bot.edit_message_text(chat_id=op_id, message_id=msg_id, text=display_text, reply_markup=build_inline_keyboard_status(req_id, lang, status="initial"))
                         logger.info(f"Обновлено сообщение для оператора {op_id} с запросом {req_id}")
@@ -838,18 +1327,18 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         logger.error(f"Ошибка редактирования сообщения для оператора {op_id}: {e}")
                         try:
                             msg = await context.bot.send_message(chat_id=op_id, text=display_text, reply_markup=build_inline_keyboard_status(req_id, lang, status="initial"))
-                            conv['operator_messages'][op_id] = msg.message_id
+                            conv.operator_messages[op_id] = msg.message_id
                         except Exception as e:
                             logger.error(f"Ошибка отправки нового сообщения оператору {op_id}: {e}")
             else:
-                op_id = conv['assigned_operator']
+                op_id = conv.assigned_operator
                 display_text = text
                 if lang != 'ru':
-                    translated_text = translate_text(text, 'ru')
+                    translated_text = await translate_text(text, 'ru')
                     display_text = f"{text}\nПеревод: {translated_text}"
                 try:
                     msg = await context.bot.send_message(chat_id=op_id, text=display_text)
-                    conv.setdefault("additional_operator_messages", []).append((op_id, msg.message_id, display_text))
+                    conv.track_message(op_id, msg.message_id)
                 except Exception as e:
                     logger.error(f"Ошибка отправки дополнительного сообщения оператору {op_id}: {e}")
         else:
@@ -861,25 +1350,48 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     lang = get_user_language(user_id)
 
+    # Фото для поста от админа (мастер создания или правка поста меню) сразу попадает в хранилище media
+    if user_id == ADMIN_ID and update.message.photo and awaiting_post_image(context):
+        try:
+            image_path = media.ref(await media.ingest_telegram_photo(context.bot, update.message.photo[-1]))
+        except Exception as e:
+            logger.error(f"Failed to store post photo: {e}")
+            await update.message.reply_text(f"Не удалось сохранить фото: {e}")
+            return
+        if "edit_post" in context.user_data:
+            await save_edited_post(update.message, context, image_path)
+        else:
+            await set_post_image(update.message, context, lang, image_path)
+        return
+
+    # Файл пользователей для загрузки: после /import_users или с подписью /import_users
+    if user_id == ADMIN_ID and update.message.document and (
+            context.user_data.pop("import_users", False) or (update.message.caption or "").startswith("/import_users")):
+        await import_users_document(update.message, context)
+        return
+
     if user_id in operator_ids:
         if user_id in operator_active:
             req_id = operator_active[user_id]
             conv = active_requests[req_id]
-            conv['last_activity'] = asyncio.get_event_loop().time()
-            user_id = conv['user_id']
-            lang = conv['language']
+            conv.last_activity = asyncio.get_event_loop().time()
+            if update.message.media_group_id:
+                album_collector.add(update.message, context)
+                return
+            user_id = conv.user_id
+            lang = conv.language
             caption = update.message.caption or translations["ru"]["media_sent"]
             if lang != 'ru':
-                caption = translate_text(caption, lang)
+                caption = await translate_text(caption, lang)
             try:
                 if update.message.photo:
                     file_id = update.message.photo[-1].file_id
                     sent_msg = await context.bot.send_photo(chat_id=user_id, photo=file_id, caption=caption)
-                    conv.setdefault('media_files', []).append(('Фото', file_id, caption, 'operator', update.message.message_id, sent_msg.message_id))
+                    conv.add_media(MediaRecord('Фото', file_id, caption, 'operator', update.message.message_id, sent_msg.message_id))
                 elif update.message.document:
                     file_id = update.message.document.file_id
                     sent_msg = await context.bot.send_document(chat_id=user_id, document=file_id, caption=caption)
-                    conv.setdefault('media_files', []).append(('Документ', file_id, caption, 'operator', update.message.message_id, sent_msg.message_id))
+                    conv.add_media(MediaRecord('Документ', file_id, caption, 'operator', update.message.message_id, sent_msg.message_id))
                 await context.bot.send_message(chat_id=user_id, text=translations["ru"]["media_sent"])
             except Exception as e:
                 logger.error(f"Ошибка отправки медиа от оператора {user_id} юзеру {user_id}: {e}")
@@ -888,23 +1400,123 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(translations["ru"]["operator_wait_for_request"], reply_markup=build_inline_keyboard_status("", "ru", "finished"))
         return
 
-    if user_id in active_conversations and active_requests[active_conversations[user_id]].get('assigned_operator'):
+    if user_id in active_conversations and active_requests[active_conversations[user_id]].assigned_operator:
         req_id = active_conversations[user_id]
         conv = active_requests[req_id]
-        conv['last_activity'] = asyncio.get_event_loop().time()
-        op_id = conv['assigned_operator']
+        conv.last_activity = asyncio.get_event_loop().time()
+        if update.message.media_group_id:
+            album_collector.add(update.message, context)
+            return
+        op_id = conv.assigned_operator
         caption = update.message.caption or "От пользователя"
         if update.message.photo:
             file_id = update.message.photo[-1].file_id
             msg = await context.bot.send_photo(op_id, file_id, caption=caption)
-            conv.setdefault('media_files', []).append(('Фото', file_id, caption, 'user', msg.message_id))
+            conv.add_media(MediaRecord('Фото', file_id, caption, 'user', msg.message_id))
         elif update.message.document:
             file_id = update.message.document.file_id
             msg = await context.bot.send_document(op_id, file_id, caption=caption)
-            conv.setdefault('media_files', []).append(('Документ', file_id, caption, 'user', msg.message_id))
+            conv.add_media(MediaRecord('Документ', file_id, caption, 'user', msg.message_id))
     else:
         await update.message.reply_text("Пожалуйста, сначала нажмите кнопку '📞 Поддержка' в меню, чтобы начать чат.", reply_markup=build_menu(lang, user_id))
 
+# Альбом пересылается одним send_media_group и хранится в чате как одна запись MediaAlbum.
+# Чат проверяется заново: за время сбора частей он мог завершиться
+async def relay_album(messages, context):
+    sender_id = messages[0].from_user.id
+    items = [album_item(message) for message in messages]
+    if sender_id in operator_ids:
+        conv = active_requests.get(operator_active.get(sender_id))
+        if conv is None:
+            return
+        if conv.language != 'ru':
+            captions = await asyncio.gather(*(translate_text(caption, conv.language) if caption else asyncio.sleep(0)
+                                              for _, _, caption in items))
+            items = [(kind, file_id, caption) for (kind, file_id, _), caption in zip(items, captions)]
+        try:
+            sent = await context.bot.send_media_group(conv.user_id, [input_media(*item) for item in items])
+            conv.add_media(MediaAlbum(items, 'operator', [message.message_id for message in messages],
+                                      [message.message_id for message in sent]))
+            await context.bot.send_message(chat_id=conv.user_id, text=translations["ru"]["media_sent"])
+        except Exception as e:
+            logger.error(f"Ошибка отправки альбома от оператора {sender_id} юзеру {conv.user_id}: {e}")
+            await context.bot.send_message(chat_id=sender_id, text=translations["ru"]["send_media_error"],
+                                           reply_markup=build_inline_keyboard_status("", "ru", "finished"))
+        return
+    conv = active_requests.get(active_conversations.get(sender_id))
+    if conv is None or not conv.assigned_operator:
+        return
+    if not any(caption for _, _, caption in items):
+        items[0] = (items[0][0], items[0][1], "От пользователя")
+    try:
+        sent = await context.bot.send_media_group(conv.assigned_operator, [input_media(*item) for item in items])
+    except TelegramError as e:
+        logger.error(f"Ошибка отправки альбома от юзера {sender_id} оператору {conv.assigned_operator}: {e}")
+        await context.bot.send_message(chat_id=sender_id, text=translations[conv.language]["send_media_error"])
+        return
+    conv.add_media(MediaAlbum(items, 'user', [message.message_id for message in sent]))
+
+def album_item(message):
+    if message.photo:
+        return ('Фото', message.photo[-1].file_id, message.caption)
+    return ('Документ', message.document.file_id, message.caption)
+
+def input_media(kind, file_id, caption):
+    if kind == 'Фото':
+        return InputMediaPhoto(file_id, caption=caption)
+    return InputMediaDocument(file_id, caption=caption)
+
+album_collector = albums.AlbumCollector(relay_album)
+
+def awaiting_post_image(context):
+    edit = context.user_data.get("edit_post")
+    if edit is not None:
+        return edit.get("step") == "image"
+    create = context.user_data.get("create_post")
+    return create is not None and create.get("step") == "media"
+
+# Картинка по ссылке или пути загружается в хранилище один раз; в посте хранится ссылка media:<id>
+async def ingest_post_image(message, source):
+    try:
+        return media.ref(await media.resolve(source))
+    except (httpx.HTTPError, media.MediaError, OSError) as e:
+        logger.error(f"Failed to store post image {source}: {e}")
+        await message.reply_text(f"Не удалось загрузить изображение: {e}\nОтправьте другую ссылку или фото.")
+        return None
+
+async def set_post_image(message, context, lang, image_path):
+    context.user_data["create_post"]["image_path"] = image_path
+    context.user_data["create_post"]["step"] = "button"
+    await message.reply_text(translations[lang]["post_button_prompt"])
+
+async def save_edited_post(message, context, image_path):
+    edit = context.user_data.pop("edit_post")
+    await asyncio.to_thread(upsert_post, edit["post_type"], edit["language"], edit["text"], image_path)
+    posts_catalog.load()
+    await message.reply_text(f"✅ Пост {edit['post_type']} ({edit['language']}) обновлён.")
+
+# Bot API удаляет до 100 сообщений одного чата за вызов; ненайденные сообщения пропускаются
+async def delete_messages_batched(bot, deletions):
+    for chat_id, message_ids in deletions.items():
+        for start in range(0, len(message_ids), 100):
+            chunk = message_ids[start:start + 100]
+            try:
+                await bot.delete_messages(chat_id, chunk)
+            except Exception as e:
+                logger.error(f"Error deleting {len(chunk)} messages in chat {chat_id}: {e}")
+
+# У оператора с несколькими чатами после закрытия текущего текущим становится следующий открытый;
+# без открытых чатов оператор освобождается
+def unbind_operator(op_id, req_id):
+    if operator_active.get(op_id) == req_id:
+        operator_active.pop(op_id, None)
+        remaining = [other_id for other_id, other in active_requests.items()
+                     if other_id != req_id and other.assigned_operator == op_id]
+        if remaining:
+            operator_active[op_id] = remaining[-1]
+    if op_id not in operator_active:
+        workers.release_operator(op_id)
+
 async def finish_conversation(user_id: int, context: ContextTypes.DEFAULT_TYPE, initiator: str, update: Update = None):
     lang = user_languages.get(user_id, 'ru') if initiator == "user" else 'ru'
     if initiator == "operator":
@@ -921,60 +1533,57 @@ async def finish_conversation(user_id: int, context: ContextTypes.DEFAULT_TYPE,
         return
 
     conv = active_requests[req_id]
-    usr_id = conv['user_id']
-    op_id = conv.get('assigned_operator')
+    usr_id = conv.user_id
+    op_id = conv.assigned_operator
+    events.record("support", usr_id, f"finished_{initiator}", asyncio.get_event_loop().time() - conv.created_at)
     active_conversations.pop(usr_id, None)
+    if assignment_queue is not None:
+        assignment_queue.finish(req_id, op_id, asyncio.get_event_loop().time())
     if op_id:
-        operator_active.pop(op_id, None)
+        unbind_operator(op_id, req_id)
 
-    history_file_path = create_chat_history_file(conv)
-    for op_id_key, msg_id in conv.get("operator_messages", {}).items():
-        try:
-            await context.bot.delete_message(chat_id=op_id_key, message_id=msg_id)
-        except Exception as e:
-            logger.error(f"Error deleting operator message {msg_id} for operator {op_id_key}: {e}")
-
-    for item in conv.get("additional_operator_messages", []):
-        op_id_key, msg_id = item[0], item[1]
-        try:
-            await context.bot.delete_message(chat_id=op_id_key, message_id=msg_id)
-        except Exception as e:
-            logger.error(f"Error deleting additional message {msg_id} for operator {op_id_key}: {e}")
-
-    for media in conv.get("media_files", []):
-        if len(media) >= 5:
-            original_msg_id = media[4]
-            sender = media[3]
-            original_chat_id = op_id if sender == 'user' else op_id
-            try:
-                await context.bot.delete_message(chat_id=original_chat_id, message_id=original_msg_id)
-            except Exception as e:
-                logger.error(f"Error deleting media message {original_msg_id} for {original_chat_id}: {e}")
-            if len(media) == 6 and sender == 'operator':
-                forwarded_msg_id = media[5]
-                try:
-                    await context.bot.delete_message(chat_id=usr_id, message_id=forwarded_msg_id)
-                except Exception as e:
-                    logger.error(f"Error deleting forwarded media {forwarded_msg_id} for {usr_id}: {e}")
-
-    new_text = f"Завершённый чат с {conv['username']} (ID: {conv['user_id']})"
+    messages = await build_transcript(conv)
+    history_file_path = create_chat_history_file(conv, messages)
+    try:
+        await asyncio.to_thread(transcripts.archive_transcript, req_id, conv, messages)
+    except Exception as e:
+        logger.error(f"Failed to archive transcript {req_id}: {e}")
+    # Уведомления, дополнительные сообщения и медиа удаляются пачками: один вызов на чат
+    deletions = {}
+    for op_id_key, msg_id in conv.operator_messages.items():
+        deletions.setdefault(op_id_key, []).append(msg_id)
+    for op_id_key, msg_id in conv.additional_operator_messages:
+        deletions.setdefault(op_id_key, []).append(msg_id)
+    for media_file in conv.media_files:
+        if op_id:
+            deletions.setdefault(op_id, []).extend(media_file.operator_message_ids())
+        deletions.setdefault(usr_id, []).extend(media_file.user_message_ids())
+    await delete_messages_batched(context.bot, deletions)
+
+    new_text = f"Завершённый чат с {conv.username} (ID: {conv.user_id})"
+    if conv.dropped_media:
+        new_text += f"\nРанние медиа не сохранены: {conv.dropped_media}"
     for op_id_key in operator_ids:
         try:
             with open(history_file_path, 'rb') as file:
                 msg = await context.bot.send_document(
                     chat_id=op_id_key,
                     document=file,
-                    filename=f"chat_history_{conv['user_id']}_{conv.get('operator_name', 'no_operator')}.txt",
+                    filename=f"chat_history_{conv.user_id}_{conv.operator_name or 'no_operator'}.txt",
                     caption=new_text,
                     reply_markup=build_inline_keyboard_status(req_id, "ru", status="finished")
                 )
-            if 'media_files' in conv and conv['media_files']:
-                for media_type, file_id, caption, sender, original_msg_id, *rest in conv['media_files']:
-                    media_caption = f"{caption} (ID: {original_msg_id})"
-                    if media_type == 'Фото':
-                        await context.bot.send_photo(chat_id=op_id_key, photo=file_id, caption=media_caption, reply_to_message_id=msg.message_id)
-                    elif media_type == 'Документ':
-                        await context.bot.send_document(chat_id=op_id_key, document=file_id, caption=media_caption, reply_to_message_id=msg.message_id)
+            for media in conv.media_files:
+                media_caption = f"{media.caption} (ID: {media.message_id})"
+                if isinstance(media, MediaAlbum):
+                    items = [(kind, file_id, media_caption if index == 0 else caption)
+                             for index, (kind, file_id, caption) in enumerate(media.items)]
+                    await context.bot.send_media_group(chat_id=op_id_key, media=[input_media(*item) for item in items],
+                                                       reply_to_message_id=msg.message_id)
+                elif media.kind == 'Фото':
+                    await context.bot.send_photo(chat_id=op_id_key, photo=media.file_id, caption=media_caption, reply_to_message_id=msg.message_id)
+                elif media.kind == 'Документ':
+                    await context.bot.send_document(chat_id=op_id_key, document=media.file_id, caption=media_caption, reply_to_message_id=msg.message_id)
         except Exception as e:
             logger.error(f"Error sending final message to operator {op_id_key}: {e}")
 
@@ -986,7 +1595,7 @@ async def finish_conversation(user_id: int, context: ContextTypes.DEFAULT_TYPE,
     elif initiator == "operator" and op_id:
         await context.bot.send_message(
             usr_id,
-            translations[lang]["chat_ended_by_operator"].format(name=conv['operator_name']),
+            translations[lang]["chat_ended_by_operator"].format(name=conv.operator_name),
             reply_markup=build_menu(lang)
         )
 
@@ -994,69 +1603,127 @@ async def finish_conversation(user_id: int, context: ContextTypes.DEFAULT_TYPE,
         await update.message.reply_text(translations["ru"]["operator_chat_ended"])
     elif initiator == "user" and op_id:
         await context.bot.send_message(op_id, translations["ru"]["operator_chat_ended_by_user"])
+    conv.close()
     del active_requests[req_id]
+    # Освободившийся оператор сразу получает следующий запрос из очереди
+    await offer_waiting(context.bot)
 
 async def check_scheduled_posts(context: ContextTypes.DEFAULT_TYPE):
     posts = get_scheduled_posts()
     for post in posts:
-        post_id, text, image_path, button_text, button_url, target_lang, target_users = post
-        if target_users == "all":
-            users = get_all_users()
-        elif target_users == "by_lang":
-            users = get_users_by_language(target_lang)
-        else:
-            users = [int(uid) for uid in target_users.split(",")]
-        for user_id in users:
-            try:
-                user_lang = get_user_language(user_id) if not target_lang else target_lang
-                if image_path and os.path.exists(image_path):
-                    with open(image_path, 'rb') as photo:
-                        if button_text and button_url:
-                            await context.bot.send_photo(
-                                chat_id=user_id,
-                                photo=photo,
-                                caption=text,
-                                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(button_text, url=button_url)]]),
-                                parse_mode="HTML"
-                            )
-                        else:
-                            await context.bot.send_photo(
-                                chat_id=user_id,
-                                photo=photo,
-                                caption=text,
-                                parse_mode="HTML"
-                            )
-                else:
-                    if button_text and button_url:
-                        await context.bot.send_message(
-                            chat_id=user_id,
-                            text=text,
-                            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(button_text, url=button_url)]]),
-                            parse_mode="HTML"
-                        )
-                    else:
-                        await context.bot.send_message(
-                            chat_id=user_id,
-                            text=text,
-                            parse_mode="HTML"
-                        )
-            except Exception as e:
-                logger.error(f"Failed to send scheduled post to user {user_id}: {e}")
+        post_id, text, image_path, button_text, button_url, target_lang, target_users, variants = post
+        target_users, specific_users, target_segment = decode_target_users(target_users)
+        try:
+            audience = get_audience(target_users, target_lang, specific_users, target_segment)
+        except segments.SegmentError as e:
+            logger.error(f"Scheduled post {post_id} has an invalid segment {target_segment}: {e}")
+            continue
+        post_data = {"text": text, "image_path": image_path, "button_text": button_text, "button_url": button_url,
+                     "variants": json.loads(variants) if variants else None}
+        # Пост снимается с расписания сразу, а сама рассылка идёт отдельной задачей, как у кампаний:
+        # долгая рассылка не задерживает следующие проверки и отметки задачи для /healthz
+        broadcast_id = create_broadcast(post_data, audience, "HTML", post_id)
+        application.create_task(run_broadcast(context.bot, broadcast_id, post_data, audience, parse_mode="HTML"))
+    await resume_broadcasts(context.bot)
+
+# Запуск кампании планировщиком: рассылка идёт отдельной задачей через общий журнал broadcasts,
+# поэтому долгая рассылка не задерживает планировщик и переживает перезапуск
+async def run_campaign(campaign_id):
+    campaign = await asyncio.to_thread(campaigns.get, campaign_id, store=TENANT)
+    if campaign is None:
+        logger.warning(f"Campaign {campaign_id} has no post, removing its schedule")
+        await asyncio.to_thread(campaigns.remove, campaign_id, store=TENANT)
+        return
+    _, post_data, target_users, target_lang = campaign
+    target_users, specific_users, target_segment = decode_target_users(target_users)
+    try:
+        audience = await asyncio.to_thread(get_audience, target_users, target_lang, specific_users, target_segment)
+    except segments.SegmentError as e:
+        logger.error(f"Campaign {campaign_id} has an invalid segment {target_segment}: {e}")
+        return
+    await asyncio.to_thread(campaigns.record_run, campaign_id, store=TENANT)
+    logger.info(f"Campaign {campaign_id} started for {sum(map(len, audience.values()))} recipients")
+    application.create_task(send_broadcast(application.bot, json.loads(post_data), audience, parse_mode="HTML"))
+
+async def wakeup_campaigns(context: ContextTypes.DEFAULT_TYPE):
+    campaigns.wakeup()
+
+async def resume_broadcasts(bot):
+    for broadcast_id, post_data, parse_mode, audience, cursor, sent in claim_unfinished_broadcasts(active_broadcasts):
+        logger.info(f"Resuming broadcast {broadcast_id} from recipient {cursor}")
+        application.create_task(run_broadcast(bot, broadcast_id, json.loads(post_data), json.loads(audience),
+                                              parse_mode, cursor, sent))
+
+async def update_segments(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(segments.apply_dirty)
+
+async def refresh_segments(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(segments.refresh_all)
+
+async def rollup_events(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(events.rollup)
+
+# Старые посты со ссылками на картинки: каждая картинка загружается в хранилище, ссылки заменяются на media:<id>
+async def migrate_post_images(context: ContextTypes.DEFAULT_TYPE):
+    for image_path in await asyncio.to_thread(media.legacy_image_paths):
+        try:
+            await media.resolve(image_path)
+        except Exception as e:
+            logger.error(f"Failed to move post image {image_path} to the media store: {e}")
+    changed = await asyncio.to_thread(media.migrate_image_paths)
+    if changed:
+        logger.info(f"Post images moved to the media store: {changed} rows")
+        await asyncio.to_thread(posts_catalog.refresh_if_changed)
+
+async def refresh_posts_catalog(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(posts_catalog.refresh_if_changed)
+
+async def refresh_canned(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(canned.refresh_if_changed)
+
+# Резервная копия users.db копируется в потоке порциями страниц, запись в базу при этом не останавливается
+async def backup_db(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(backup.create_backup)
+    await asyncio.to_thread(backup.rotate)
+
+async def translate_canned(context: ContextTypes.DEFAULT_TYPE):
+    filled = await canned.fill_missing()
+    if filled:
+        logger.info(f"Missing translations added to {filled} canned replies")
 
 async def check_timeouts(context: ContextTypes.DEFAULT_TYPE):
     current_time = asyncio.get_event_loop().time()
     for req_id, req in list(active_requests.items()):
-        if current_time - req['last_activity'] > 1800:
-            user_id = req['user_id']
+        if current_time - req.last_activity > 1800:
+            user_id = req.user_id
             await finish_conversation(user_id, context, initiator="system")
 
+# Непринятые запросы: по истечении ASSIGN_TIMEOUT запрос рассылается всем операторам,
+# освободившимся операторам предлагаются запросы из очереди
+async def check_assignments(context: ContextTypes.DEFAULT_TYPE):
+    if assignment_queue is None:
+        return
+    for request_id in assignment_queue.expire(asyncio.get_running_loop().time()):
+        conv = active_requests.get(request_id)
+        if conv is not None and conv.assigned_operator is None:
+            logger.info(f"Request {request_id} was not accepted in {assignment.ASSIGN_TIMEOUT:.0f}s, notifying all operators")
+            await notify_request(context.bot, conv, operator_ids)
+    await offer_waiting(context.bot)
+
+# Напоминание о непринятых запросах: одно сообщение оператору со счётчиком, а не по сообщению на запрос
 async def notify_operators(context: ContextTypes.DEFAULT_TYPE):
     current_time = asyncio.get_event_loop().time()
-    for req_id, req in list(active_requests.items()):
-        if req.get('assigned_operator') is None and current_time - req['created_at'] > 300:
-            for op_id in operator_ids:
-                await context.bot.send_message(op_id, "Есть необработанный запрос! Проверьте уведомления.")
-            req['created_at'] = current_time
+    counts = {}
+    for req in list(active_requests.values()):
+        if req.assigned_operator is None and current_time - req.notified_at > 300:
+            for op_id in req.operator_messages:
+                counts[op_id] = counts.get(op_id, 0) + 1
+            req.notified_at = current_time
+    for op_id, count in counts.items():
+        try:
+            await context.bot.send_message(op_id, f"Есть необработанные запросы: {count}. Проверьте уведомления.")
+        except Exception as e:
+            logger.error(f"Ошибка напоминания оператору {op_id}: {e}")
 
 async def track_chat_member(update: Update, context):
     user_id = update.chat_member.from_user.id
@@ -1073,6 +1740,7 @@ async def stats(update: Update, context):
     if user_id != ADMIN_ID:
         await update.message.reply_text(translations[lang]["admin_only_message"])
         return
+    await update.message.reply_text(await asyncio.to_thread(build_analytics_report))
     users = get_user_stats()
     if not users:
         await update.message.reply_text("Пользователей не найдено.")
@@ -1090,6 +1758,30 @@ async def stats(update: Update, context):
         message += "------------------------\n"
     await update.message.reply_text(message)
 
+def format_avg(totals, name):
+    n, total = totals.get(name, (0, 0))
+    return f"{total / n:.0f} с (n={n})" if n else "нет данных"
+
+# Сводка для /stats по дневным агрегатам событий (без чтения сырых событий)
+def build_analytics_report(days=7):
+    message = f"Активность за {days} дн.\n\nDAU:\n"
+    for day, count in events.daily_active(days):
+        message += f"{day}: {count}\n"
+    message += "\nВоронка (уникальные пользователи):\n"
+    first = None
+    for step, count in events.funnel(days):
+        first = first or count
+        share = f" ({count * 100 / first:.1f}%)" if first else ""
+        message += f"{step}: {count}{share}\n"
+    support = events.totals("support", days)
+    message += "\nПоддержка:\n"
+    message += f"Запросов: {support.get('created', (0, 0))[0]}\n"
+    message += f"Ожидание оператора: {format_avg(support, 'accepted')}\n"
+    message += f"Первый ответ: {format_avg(support, 'first_response')}\n"
+    broadcast = events.totals("broadcast", days)
+    message += f"\nРассылки: доставлено {broadcast.get('delivered', (0, 0))[0]}, ошибок {broadcast.get('failed', (0, 0))[0]}"
+    return message
+
 async def endchat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     lang = get_user_language(user_id)
@@ -1103,91 +1795,633 @@ async def endchat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(translations[lang]["no_chat_to_end"], reply_markup=build_menu(lang, user_id))
 
+async def lag(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text(translations[get_user_language(user_id)]["admin_only_message"])
+        return
+    message = f"Задержка цикла событий: {loop_monitor.format_percentiles()}\n"
+    message += f"Порог блокировки: {loop_monitor.threshold * 1000:.0f} мс, зафиксировано блокировок: {len(loop_monitor.stalls)}"
+    for ts, blocked_for, stack in list(loop_monitor.stalls)[-3:]:
+        time_str = datetime.fromtimestamp(ts).strftime('%d.%m.%Y %H:%M:%S')
+        message += f"\n\n[{time_str}] {blocked_for:.2f} с:\n{stack[-1500:]}"
+    await update.message.reply_text(message[-4000:])
+
+# Поиск по архиву чатов: /search текст [user:ID] [op:ID] [since:ГГГГ-ММ-ДД] [until:ГГГГ-ММ-ДД]
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    if user_id not in operator_ids and user_id != ADMIN_ID:
+        await update.message.reply_text(translations[get_user_language(user_id)]["admin_only_message"])
+        return
+    query = " ".join(context.args)
+    if not query:
+        await update.message.reply_text("Использование: /search текст [user:ID] [op:ID] [since:ГГГГ-ММ-ДД] [until:ГГГГ-ММ-ДД]")
+        return
+    results = await asyncio.to_thread(transcripts.search, query)
+    if not results:
+        await update.message.reply_text("Ничего не найдено.")
+        return
+    message = "Найденные чаты (открыть: /transcript ID):\n"
+    for transcript_id, found_user_id, username, operator_name, ended_at, excerpt in results:
+        time_str = datetime.fromtimestamp(ended_at).strftime('%d.%m.%Y %H:%M')
+        message += f"\n#{transcript_id} [{time_str}] {username} (ID: {found_user_id}), оператор {operator_name or '—'}\n{excerpt[:200]}\n"
+    await update.message.reply_text(message[:4000])
+
+async def transcript(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    if user_id not in operator_ids and user_id != ADMIN_ID:
+        await update.message.reply_text(translations[get_user_language(user_id)]["admin_only_message"])
+        return
+    if not context.args or not context.args[0].lstrip("#").isdigit():
+        await update.message.reply_text("Использование: /transcript ID")
+        return
+    archived = await asyncio.to_thread(transcripts.get_transcript, int(context.args[0].lstrip("#")))
+    if archived is None:
+        await update.message.reply_text("Чат не найден.")
+        return
+    history_file_path = write_chat_history_file(archived["username"], archived["user_id"], archived["operator_name"], archived["messages"])
+    try:
+        with open(history_file_path, 'rb') as file:
+            await update.message.reply_document(document=file, filename=f"chat_history_{archived['user_id']}_{context.args[0].lstrip('#')}.txt")
+    finally:
+        os.unlink(history_file_path)
+
+# Готовые ответы: /canned — список с кнопками, /canned add ключ текст (на русском), /canned del ключ
+async def canned_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    if user_id not in operator_ids and user_id != ADMIN_ID:
+        await update.message.reply_text(translations[get_user_language(user_id)]["admin_only_message"])
+        return
+    # Текст ответа берётся из сообщения целиком, чтобы сохранить переносы строк
+    parts = update.message.text.split(maxsplit=3)
+    action = parts[1] if len(parts) > 1 else "list"
+    if action == "add" and len(parts) == 4:
+        try:
+            missing = await canned.save(parts[2], parts[3], user_id)
+        except canned.CannedError as e:
+            await update.message.reply_text(f"Ответ не сохранён: {e}")
+            return
+        message = f"Ответ {parts[2]} сохранён и переведён."
+        if missing:
+            message = (f"Ответ {parts[2]} сохранён, не удалось перевести на: {', '.join(missing)}. "
+                       f"Переводы будут досланы позже, до тех пор на этих языках отправляется русский текст.")
+        await update.message.reply_text(message)
+    elif action == "del" and len(parts) == 3:
+        dropped = await asyncio.to_thread(canned.drop, parts[2])
+        await update.message.reply_text("Ответ удалён." if dropped else "Ответ не найден.")
+    elif action == "list" and len(parts) <= 2:
+        library = canned.current()
+        if not len(library):
+            await update.message.reply_text("Готовых ответов нет. /canned add ключ текст")
+            return
+        lines = []
+        for reply in library.replies.values():
+            missing = reply.missing()
+            lines.append(f"{reply.key}: {reply.text[:200]}" + (f" (нет перевода: {', '.join(missing)})" if missing else ""))
+        await update.message.reply_text("\n".join(lines)[:4000], reply_markup=build_canned_menu())
+    else:
+        await update.message.reply_text("Использование: /canned [add ключ текст | del ключ]")
+
+# Выгрузка пользователей файлом: /export_users [csv|jsonl] [gz]
+async def export_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text(translations[get_user_language(user_id)]["admin_only_message"])
+        return
+    fmt = next((arg for arg in context.args if arg in users_io.FORMATS), "csv")
+    compress = "gz" in context.args
+    path, total = await asyncio.to_thread(users_io.export_to_tempfile, fmt, compress)
+    try:
+        if os.path.getsize(path) > EXPORT_MAX_BYTES:
+            await update.message.reply_text(f"Файл больше {EXPORT_MAX_BYTES // 2 ** 20} МБ: выгрузите его со сжатием "
+                                            f"(/export_users {fmt} gz) или на сервере: python users_io.py export users.{fmt}")
+            return
+        with open(path, 'rb') as file:
+            await update.message.reply_document(document=file, filename=f"users.{fmt}" + (".gz" if compress else ""),
+                                                caption=f"Пользователей: {total}")
+    finally:
+        os.unlink(path)
+
+async def import_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text(translations[get_user_language(user_id)]["admin_only_message"])
+        return
+    context.user_data["import_users"] = True
+    await update.message.reply_text("Отправьте файл CSV (с заголовком, колонка user_id обязательна) или JSONL, "
+                                    f"можно сжатый gzip. Колонки: {', '.join(users_io.COLUMNS)}.")
+
+async def import_users_document(message, context):
+    document = message.document
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await message.reply_text(f"Бот может скачать файл до {IMPORT_MAX_BYTES // 2 ** 20} МБ. Сожмите его gzip "
+                                 "или загрузите на сервере: python users_io.py import файл")
+        return
+    status = await message.reply_text("Загрузка пользователей...")
+    loop = asyncio.get_running_loop()
+    last_report = [time.monotonic()]
+
+    async def edit_status(text):
+        try:
+            await status.edit_text(text)
+        except Exception as e:
+            logger.warning(f"Failed to update import progress: {e}")
+
+    # Вызывается из потока загрузки после каждой порции; сообщение обновляется не чаще раза в IMPORT_PROGRESS_INTERVAL
+    def progress(result):
+        now = time.monotonic()
+        if now - last_report[0] >= IMPORT_PROGRESS_INTERVAL:
+            last_report[0] = now
+            asyncio.run_coroutine_threadsafe(edit_status(f"Загружено {result.upserted} строк..."), loop)
+
+    with tempfile.NamedTemporaryFile(suffix=f"_{document.file_name or 'users'}", delete=False) as temp_file:
+        path = temp_file.name
+    try:
+        telegram_file = await context.bot.get_file(document.file_id)
+        await telegram_file.download_to_drive(path)
+        result = await asyncio.to_thread(users_io.import_users, path, None, progress)
+    except (users_io.UserImportError, UnicodeDecodeError, OSError) as e:
+        await edit_status(f"Файл не загружен: {e}")
+        return
+    finally:
+        os.unlink(path)
+    await edit_status(result.summary())
+
+# Резервные копии базы: /backup — список, /backup now — снять копию, /backup verify [файл] — проверить.
+# Восстановление только при остановленном боте: python backup.py restore файл
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text(translations[get_user_language(user_id)]["admin_only_message"])
+        return
+    action = context.args[0] if context.args else "list"
+    if action == "now":
+        try:
+            created = await asyncio.to_thread(backup.create_backup)
+        except Exception as e:
+            logger.error(f"Database backup failed: {e}")
+            await update.message.reply_text(f"Копия не создана: {e}")
+            return
+        removed = await asyncio.to_thread(backup.rotate)
+        await update.message.reply_text(f"Копия {os.path.basename(created.path)} создана ({created.size // 1024} КБ)"
+                                        + (f", удалено старых: {removed}." if removed else "."))
+    elif action == "verify":
+        backups = await asyncio.to_thread(backup.list_backups)
+        if len(context.args) > 1:
+            backups = [item for item in backups if os.path.basename(item.path) == context.args[1]]
+        if not backups:
+            await update.message.reply_text("Копия не найдена.")
+            return
+        try:
+            counts = await asyncio.to_thread(backup.verify_backup, backups[0].path)
+            await update.message.reply_text(f"{os.path.basename(backups[0].path)}: копия цела, "
+                                            + ", ".join(f"{table}: {count}" for table, count in counts.items()))
+        except backup.BackupError as e:
+            await update.message.reply_text(f"{os.path.basename(backups[0].path)}: копия повреждена: {e}")
+    elif action == "list":
+        backups = await asyncio.to_thread(backup.list_backups)
+        if not backups:
+            await update.message.reply_text("Резервных копий нет. /backup now")
+            return
+        await update.message.reply_text("\n".join(f"{os.path.basename(item.path)} — {item.size // 1024} КБ"
+                                                  for item in backups[:20]))
+    else:
+        await update.message.reply_text("Использование: /backup [now | verify [файл]]")
+
+# Повторяющиеся рассылки: /campaigns — список, /campaigns del|pause|resume ID
+async def campaigns_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text(translations[get_user_language(user_id)]["admin_only_message"])
+        return
+    action = context.args[0] if context.args else "list"
+    if action in ("del", "pause", "resume") and len(context.args) == 2 and context.args[1].lstrip("#").isdigit():
+        campaign_id = int(context.args[1].lstrip("#"))
+        if action == "del":
+            done = await asyncio.to_thread(campaigns.remove, campaign_id, store=TENANT)
+            await update.message.reply_text("Кампания удалена." if done else "Кампания не найдена.")
+        elif action == "pause":
+            done = await asyncio.to_thread(campaigns.pause, campaign_id, store=TENANT)
+            await update.message.reply_text("Кампания приостановлена." if done else "Кампания не найдена.")
+        else:
+            next_run = await asyncio.to_thread(campaigns.resume, campaign_id, store=TENANT)
+            await update.message.reply_text(f"Кампания возобновлена, следующая рассылка {next_run:%Y-%m-%d %H:%M}."
+                                            if next_run else "Кампания не найдена.")
+    elif action == "list":
+        rows = await asyncio.to_thread(campaigns.list_campaigns, store=TENANT)
+        if not rows:
+            await update.message.reply_text("Кампаний нет. Создайте пост и выберите «Повторять по расписанию».")
+            return
+        message = ""
+        for campaign_id, recurrence, next_run, runs, last_run, post_data in rows:
+            state = f"следующая {next_run:%Y-%m-%d %H:%M}" if next_run else "на паузе"
+            message += (f"#{campaign_id} {recurrence} — {state}, рассылок: {runs}"
+                        f"{f', последняя {last_run}' if last_run else ''}\n{json.loads(post_data)['text'][:100]}\n\n")
+        await update.message.reply_text(message[:4000])
+    else:
+        await update.message.reply_text("Использование: /campaigns [del | pause | resume ID]")
+
+# Сохранённые сегменты: /segment, /segment save имя условие, /segment drop имя, /segment count условие
+async def segment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text(translations[get_user_language(user_id)]["admin_only_message"])
+        return
+    action = context.args[0] if context.args else "list"
+    try:
+        if action == "save" and len(context.args) >= 3:
+            total = await asyncio.to_thread(segments.save, context.args[1], " ".join(context.args[2:]))
+            await update.message.reply_text(f"Сегмент {context.args[1]} сохранён: {total} пользователей.")
+        elif action == "drop" and len(context.args) == 2:
+            dropped = await asyncio.to_thread(segments.drop, context.args[1])
+            await update.message.reply_text("Сегмент удалён." if dropped else "Сегмент не найден.")
+        elif action == "count" and len(context.args) >= 2:
+            total = await asyncio.to_thread(segments.count, " ".join(context.args[1:]))
+            await update.message.reply_text(f"В сегменте {total} пользователей.")
+        elif action == "list":
+            saved = await asyncio.to_thread(segments.list_segments)
+            if not saved:
+                await update.message.reply_text("Сохранённых сегментов нет. /segment save имя условие")
+                return
+            await update.message.reply_text("\n".join(
+                f"{name}: {definition} — {member_count} (обновлён {refreshed_at})"
+                for name, definition, member_count, refreshed_at in saved))
+        else:
+            await update.message.reply_text("Использование: /segment [save имя условие | drop имя | count условие]")
+    except segments.SegmentError as e:
+        await update.message.reply_text(f"Ошибка в условии: {e}")
+
 async def set_bot_commands(bot):
     commands = [
         BotCommand("start", "Запустить бота и показать главное меню"),
         BotCommand("stats", "Показать статистику пользователей (только для админа)"),
-        BotCommand("endchat", "Завершить текущий чат с поддержкой")
+        BotCommand("lag", "Задержки цикла событий (только для админа)"),
+        BotCommand("endchat", "Завершить текущий чат с поддержкой"),
+        BotCommand("canned", "Готовые ответы (для операторов)")
     ]
     await bot.set_my_commands(commands)
 
-@app.route('/webhook', methods=['POST'])
-def webhook():
-    update = Update.de_json(request.get_json(force=True), application.bot)
-    asyncio.ensure_future(application.process_update(update))  # Schedule on existing loop
-    return Response(status=200)
-
-# Эндпоинт для пинга (чтобы Render не засыпал)
-@app.route('/ping')
-def ping():
-    return "Bot is alive!"
-
-# Функция для запуска асинхронных задач (job_queue)
-async def run_jobs():
-    application.job_queue.run_repeating(check_scheduled_posts, interval=60)
-    application.job_queue.run_repeating(check_timeouts, interval=60)
-    application.job_queue.run_repeating(notify_operators, interval=60)
-    while True:
-        await asyncio.sleep(1)  # Держим цикл живым
+async def configure_bot(bot):
+    await set_bot_commands(bot)
+    # Настройка вебхука для Telegram
+    webhook_url = f"{PUBLIC_URL}{URL_PREFIX}/webhook"
+    await bot.setWebhook(webhook_url)
+    print(f"Webhook установлен: {webhook_url}")
 
-import os
-import asyncio
-import threading
-from flask import Flask, request, Response
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
-from telegram import Update, BotCommand
+# Апдейты из потока Flask передаются в очередь приложения в цикле бота
+def submit_update(update):
+    asyncio.run_coroutine_threadsafe(application.update_queue.put(update), bot_loop)
 
-app = Flask(__name__)
+# Периодическая задача с метриками и отметкой о запуске для /healthz
+def schedule_job(name, callback, interval):
+    health.expect_job(name, interval)
 
-# Ваши остальные импорты и функции остаются без изменений
-# ...
+    async def job(context: ContextTypes.DEFAULT_TYPE):
+        health.job_started(name)
+        try:
+            await callback(context)
+        finally:
+            health.job_finished(name)
+    application.job_queue.run_repeating(instrument_handler(name)(job), interval=interval)
+
+# Запуск бота в текущем цикле: приложение, job_queue и сторож цикла событий
+async def start_bot(configure=True):
+    global bot_loop
+    bot_loop = asyncio.get_running_loop()
+    if not SHARED_RUNTIME:
+        loop_monitor.start(bot_loop)
+    if flood_guard is not None:
+        flood_guard.start(bot_loop)
+
+    events.start()
+    restore_support_state(take_support_state(workers.shard_index or 0, workers.WORKERS))
+    # Кэши прогреваются в потоках, пока initialize() ждёт ответа getMe от Bot API
+    with startup.phase("initialize"):
+        await asyncio.gather(application.initialize(), warm_caches())
+    if configure:
+        with startup.phase("configure_bot"):
+            await configure_bot(application.bot)
+
+    if workers.owns_global_jobs():
+        schedule_job("check_scheduled_posts", check_scheduled_posts, 60)
+        schedule_job("rollup_events", rollup_events, 60)
+        schedule_job("refresh_segments", refresh_segments, SEGMENT_REFRESH_INTERVAL)
+        application.job_queue.run_once(instrument_handler("migrate_post_images")(migrate_post_images), 5)
+        schedule_job("translate_canned", translate_canned, 300)
+        schedule_job("backup_db", backup_db, backup.BACKUP_INTERVAL)
+        schedule_job("wakeup_campaigns", wakeup_campaigns, 60)
+    schedule_job("update_segments", update_segments, 30)
+    schedule_job("check_timeouts", check_timeouts, 60)
+    schedule_job("claim_support_state", claim_support_state, 30)
+    schedule_job("notify_operators", notify_operators, 60)
+    if assignment_queue is not None:
+        schedule_job("check_assignments", check_assignments, 10)
+    schedule_job("refresh_posts_catalog", refresh_posts_catalog, 30)
+    schedule_job("refresh_canned", refresh_canned, 30)
+    await application.start()
+    # Кампании выполняет только владелец глобальных задач, остальные процессы лишь меняют расписание
+    campaigns.start(bot_loop, run_campaign, paused=not workers.owns_global_jobs(), store=TENANT, path=storage.DB_PATH)
+    if workers.owns_global_jobs():
+        await resume_broadcasts(application.bot)
+    startup.report()
+    bot_ready.set()
+
+# Прогрев кэшей при запуске: каталог постов, готовые ответы, статичные меню, каталог переводов
+async def warm_caches():
+    await asyncio.gather(asyncio.to_thread(posts_catalog.load), asyncio.to_thread(canned.load),
+                         asyncio.to_thread(warm_menus), asyncio.to_thread(warm_translations))
+
+def warm_menus():
+    for builder in (build_lang_menu, build_post_lang_menu, build_recipient_menu, build_recipient_lang_menu,
+                    build_edit_post_type_menu, build_edit_post_lang_menu, build_send_time_menu, build_confirm_menu):
+        builder()
+    for lang in translations:
+        build_back_menu(lang)
+
+def warm_translations():
+    # Проверка каталога: недостающие ключи видны в логе при запуске, а не при первом обращении пользователя
+    keys = set(translations["en"])
+    for lang, catalog in translations.items():
+        missing = keys - set(catalog)
+        if missing:
+            logger.warning(f"Translations for {lang} miss keys: {', '.join(sorted(missing))}")
+
+# Передача работы между экземплярами: при остановке состояние поддержки сохраняется в support_state,
+# при запуске забирается обратно (в многопроцессном режиме — своим шардом). Старый экземпляр при
+# плавной замене останавливается уже после запуска нового, поэтому записи забираются и периодически
+def restore_support_state(rows):
+    loop_now = asyncio.get_running_loop().time()
+    restored = 0
+    for key, kind, state in rows:
+        if state["user_id"] in active_conversations:
+            # Пока состояние передавалось, пользователь открыл новый чат в этом экземпляре
+            logger.warning(f"Support state {key} skipped: user {state['user_id']} already has a chat")
+            continue
+        restored += 1
+        if kind == "waiting":
+            waiting_for_question[state["user_id"]] = True
+            continue
+        conv = Conversation.from_state(state, loop_now)
+        if conv.assigned_operator in operator_active:
+            # Оператор уже ведёт другой чат здесь: запрос возвращается в ожидание
+            logger.warning(f"Request {conv.request_id} restored unassigned: operator {conv.assigned_operator} is busy")
+            conv.assigned_operator = None
+            conv.operator_name = None
+        active_requests[conv.request_id] = conv
+        active_conversations[conv.user_id] = conv.request_id
+        if conv.assigned_operator:
+            operator_active[conv.assigned_operator] = conv.request_id
+            workers.bind_operator(conv.assigned_operator)
+            if assignment_queue is not None:
+                assignment_queue.restore_chat(conv.request_id, conv.assigned_operator)
+        elif assignment_queue is not None:
+            assignment_queue.enqueue(conv.request_id, conv.language, conv.created_at)
+    if restored:
+        logger.info(f"Restored {restored} support state entries")
+
+async def claim_support_state(context: ContextTypes.DEFAULT_TYPE):
+    rows = await asyncio.to_thread(take_support_state, workers.shard_index or 0, workers.WORKERS)
+    restore_support_state(rows)
+
+@shutdown.on_drain("campaigns")
+async def drain_campaigns():
+    # Новые запуски кампаний не начинаются; пропущенные за время простоя догонит следующий экземпляр
+    campaigns.stop(TENANT)
+    if not SHARED_RUNTIME:
+        campaigns.shutdown()
+
+@shutdown.on_drain("broadcasts")
+async def drain_broadcasts():
+    # Рассылки видят shutdown.draining перед следующим получателем и сохраняют курсор
+    while active_broadcasts:
+        await asyncio.sleep(0.1)
+
+@shutdown.on_drain("application")
+async def drain_application():
+    # Дорабатывает апдейты, уже стоящие в очереди, и останавливает job_queue
+    if application.running:
+        await application.stop()
+
+@shutdown.on_drain("albums")
+async def drain_albums():
+    await album_collector.release_all()
+
+@shutdown.on_drain("support_state")
+async def drain_support_state():
+    loop_now = asyncio.get_running_loop().time()
+    rows = [(request_id, "conversation", conv.to_state(loop_now)) for request_id, conv in active_requests.items()]
+    rows += [(f"waiting:{user_id}", "waiting", {"user_id": user_id}) for user_id in waiting_for_question]
+    await asyncio.to_thread(save_support_state, workers.shard_index or 0, rows)
+    for conv in active_requests.values():
+        conv.close()
+    logger.info(f"Saved {len(rows)} support state entries")
+
+@shutdown.on_drain("events")
+async def drain_events():
+    await asyncio.to_thread(events.stop)
+
+@shutdown.on_drain("shutdown")
+async def drain_shutdown():
+    # Application закрывает только свой клиент Bot API; общие пулы http_client закрывает их владелец
+    if SHARED_RUNTIME:
+        await application.shutdown()
+        return
+    loop_monitor.stop()
+    await application.shutdown()
+    await http_client.aclose()
 
-def main():
-    # Инициализация базы данных
-    init_db()
-
-    # Регистрация обработчиков
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(button))
-    application.add_handler(ChatMemberHandler(track_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
-    application.add_handler(CommandHandler("stats", stats))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-    application.add_handler(MessageHandler(filters.PHOTO | filters.Document.ALL, handle_media))
-    application.add_handler(CommandHandler("endchat", endchat))
+# Цикл бота в однопроцессном режиме
+async def run_jobs():
+    await start_bot()
+    while not shutdown.finished.is_set():
+        await asyncio.sleep(1)  # Держим цикл живым до завершения остановки
+
+# Регистрация обработчиков
+def register_handlers():
+    application.add_handler(CommandHandler("start", instrument_handler("start")(start)))
+    application.add_handler(CallbackQueryHandler(instrument_handler("button")(button)))
+    application.add_handler(ChatMemberHandler(instrument_handler("track_chat_member")(track_chat_member), ChatMemberHandler.MY_CHAT_MEMBER))
+    application.add_handler(CommandHandler("stats", instrument_handler("stats")(stats)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument_handler("handle_text")(handle_text)))
+    application.add_handler(MessageHandler(filters.PHOTO | filters.Document.ALL, instrument_handler("handle_media")(handle_media)))
+    application.add_handler(CommandHandler("endchat", instrument_handler("endchat")(endchat)))
+    application.add_handler(CommandHandler("lag", instrument_handler("lag")(lag)))
+    application.add_handler(CommandHandler("search", instrument_handler("search")(search)))
+    application.add_handler(CommandHandler("transcript", instrument_handler("transcript")(transcript)))
+    application.add_handler(CommandHandler("segment", instrument_handler("segment")(segment)))
+    application.add_handler(CommandHandler("canned", instrument_handler("canned")(canned_command)))
+    application.add_handler(CommandHandler("export_users", instrument_handler("export_users")(export_users)))
+    application.add_handler(CommandHandler("import_users", instrument_handler("import_users")(import_users)))
+    application.add_handler(CommandHandler("backup", instrument_handler("backup")(backup_command)))
+    application.add_handler(CommandHandler("campaigns", instrument_handler("campaigns")(campaigns_command)))
     application.add_error_handler(error_handler)
 
-    # Инициализация приложения
-    application.initialize()
+# Фабрика приложения бота: настройки, логирование, Application с обработчиками и защита от флуда.
+# Тяжёлые компоненты (HTTP-пулы, переводчик) создаются при первом обращении, кэши прогреваются в start_bot
+def create_application(settings=None):
+    global application, flood_guard, assignment_queue
+    with startup.phase("settings"):
+        logging_setup.setup_logging()
+        load_settings(settings)
+    with startup.phase("application"):
+        application = Application.builder().token(BOT_TOKEN).request(InstrumentedRequest()).build()
+        register_handlers()
+    # Загрузка операторов известна только своему процессу, поэтому с несколькими воркерами очередь
+    # назначения не включается и запросы рассылаются всем операторам
+    if workers.WORKERS > 1:
+        assignment_queue = None
+        logger.info("Assignment queue disabled: WORKERS > 1, support requests go to all operators")
+    else:
+        assignment_queue = assignment.AssignmentQueue(operator_ids)
+    # Ограничение частоты апдейтов от пользователей до передачи в Application; админ и операторы не ограничиваются
+    if FLOOD_PROTECTION:
+        flood_guard = throttle.FloodGuard(dispatch_payload, exempt=[ADMIN_ID, *operator_ids])
+    return application
+
+# Flask-приложение вебхука и служебных адресов
+def create_app():
+    app = Flask(__name__)
+    app.register_blueprint(web)
+    return app
+
+def init_storage():
+    with startup.phase("db"):
+        init_db()
+        events.init_events()
+        segments.init_segments()
+        transcripts.init_archive()
+        media.init_media()
+        canned.init_canned()
+        campaigns.init_campaigns(storage.DB_PATH)
+
+# Фронтенд многопроцессного режима: принимает вебхук и раскладывает апдейты по воркерам
+shard_router = None
+worker_inboxes = []
+worker_processes = []
+
+async def configure_front_end():
+    async with application.bot:
+        await configure_bot(application.bot)
+
+def run_front_end(app, worker_count, port):
+    global shard_router, worker_inboxes, worker_processes
+    shard_router = workers.ShardRouter(worker_count)
+    worker_inboxes, control, worker_processes = workers.start_workers(worker_count)
+    threading.Thread(target=workers.listen_control, args=(shard_router, control), daemon=True).start()
+    # Цикла бота во фронтенде нет, таймерам склейки нужен свой
+    if flood_guard is not None:
+        timer_loop = asyncio.new_event_loop()
+        threading.Thread(target=timer_loop.run_forever, name="flood-timers", daemon=True).start()
+        flood_guard.start(timer_loop)
+    # Переходы по /go/register учитываются во фронтенде
+    events.start()
+    shutdown.install_front_end(worker_processes)
+    asyncio.run(configure_front_end())
+    startup.report()
+    print(f"Запуск фронтенда с {worker_count} воркерами на порту {port}")
+    app.run(host="0.0.0.0", port=port)
 
-    # Установка команд бота
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(set_bot_commands(application.bot))
+def main():
+    create_application()
+    init_storage()
+    app = create_app()
+    port = int(os.getenv("PORT", 8080))
 
-    # Настройка вебхука для Telegram
-    webhook_url = "https://tng33.onrender.com/webhook"
-    loop.run_until_complete(application.bot.setWebhook(webhook_url))
-    print(f"Webhook установлен: {webhook_url}")
+    if workers.WORKERS > 1:
+        run_front_end(app, workers.WORKERS, port)
+        return
 
-    # Запуск job_queue в отдельном потоке
+    # Запуск цикла бота (приложение, вебхук, job_queue) в отдельном потоке
     job_thread = threading.Thread(target=lambda: asyncio.run(run_jobs()))
     job_thread.start()
+    bot_ready.wait()
+    shutdown.install(bot_loop)
 
     # Запуск Flask-сервера
-    port = int(os.getenv("PORT", 8080))
     print(f"Запуск Flask на порту {port}")
     app.run(host="0.0.0.0", port=port)
 
+# Передача апдейта в Application (или воркеру-владельцу в многопроцессном режиме)
+def dispatch_payload(payload):
+    if shard_router is not None:
+        worker_inboxes[shard_router.route(payload)].put(payload)
+        return
+    submit_update(Update.de_json(payload, application.bot))
+
 # Обработчик вебхуков
-@app.route('/webhook', methods=['POST'])
+@web.route('/webhook', methods=['POST'])
 def webhook():
-    update = Update.de_json(request.get_json(force=True), application.bot)
-    asyncio.ensure_future(application.process_update(update))  # Используем существующий цикл
+    # Во время остановки апдейт не принимается: Telegram повторит доставку, и его обработает новый экземпляр
+    if shutdown.draining.is_set():
+        return Response(status=503)
+    payload = request.get_json(force=True)
+    if flood_guard is not None:
+        flood_guard.submit(payload)
+    else:
+        dispatch_payload(payload)
     return Response(status=200)
 
-# Эндпоинт для пинга
-@app.route('/ping')
+# Проверки здоровья. Во фронтенде многопроцессного режима цикла бота нет — проверяются процессы воркеров
+@health.liveness_check("bot")
+def health_bot():
+    if shard_router is not None:
+        alive = sum(process.is_alive() for process in worker_processes)
+        return ("ok" if alive == len(worker_processes) else "fail"), {"workers_alive": alive,
+                                                                      "workers": len(worker_processes)}
+    if not bot_ready.is_set():
+        return "fail", {"error": "bot is starting"}
+    return health.check_loop(loop_monitor)
+
+@health.liveness_check("jobs")
+def health_jobs():
+    if shard_router is not None:
+        return "ok", {}
+    return health.check_jobs()
+
+@health.readiness_check("db")
+def health_db():
+    return health.check_db(storage.DB_PATH)
+
+@health.readiness_check("queues")
+def health_queues():
+    return health.check_queues(application.update_queue.qsize())
+
+@health.readiness_check("translation")
+def health_translation():
+    state = translation.breaker.state
+    return ("fail" if state == "open" else "ok"), {"breaker": state, "failures": translation.breaker.failures}
+
+def health_response(result):
+    healthy, body = result
+    return Response(json.dumps(body), status=200 if healthy else 503, mimetype="application/json")
+
+@web.route('/healthz')
+def healthz():
+    return health_response(health.liveness())
+
+@web.route('/readyz')
+def readyz():
+    return health_response(health.readiness())
+
+# Старый адрес пинга (Render) отвечает так же, как /healthz
+@web.route('/ping')
 def ping():
-    return "Bot is alive!"
+    return healthz()
+
+# Переход по кнопке регистрации: событие для воронки и редирект на REGISTER_URL
+@web.route('/go/register')
+def go_register():
+    lang = request.args.get("lang", "en")
+    uid = request.args.get("uid", "")
+    events.record("register", int(uid) if uid.isdigit() else None, lang)
+    return redirect(translations.get(lang, translations["en"])["register_url"], code=302)
+
+# Метрики в формате Prometheus
+@web.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+startup.mark_imported("tango")
 
 if __name__ == "__main__":
     main()
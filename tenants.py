@@ -0,0 +1,307 @@
+# Несколько ботов в одном процессе. TENANTS_FILE — JSON-список ботов: у каждого имя, свои настройки
+# из BOT_SETTINGS под именами переменных окружения (значения — строки, как в окружении; не указанные
+# берутся из окружения процесса) и необязательный DATA_DIR, по умолчанию TENANTS_DIR/<имя>:
+#   [{"name": "main", "BOT_TOKEN": "...", "ADMIN_ID": "1", "OPERATORS": "2:Анна"}, ...]
+# Каждый бот получает свои экземпляры модуля бота и модулей с состоянием (поддержка, посты, сегменты,
+# события, метрики, проверки здоровья): своя база users.db, медиа и резервные копии в DATA_DIR,
+# свой Application и адреса /<имя>/webhook, /<имя>/healthz, /<имя>/metrics. Настройки передаются
+# явно: tango.load_settings получает настройки бота поверх окружения и раздаёт их configure() модулей,
+# путь к базе модули читают из storage при каждом подключении. Окружение процесса и sys.modules
+# не меняются. Общие для всех ботов: цикл событий и его сторож, HTTP-пулы http_client, кэш и ограничитель
+# переводчика, планировщик кампаний (у каждого бота своё хранилище задач); их останавливает drain()
+# один раз, после всех ботов. Пула соединений с SQLite нет и здесь: соединение открывается на каждый
+# запрос к базе своего бота.
+# Запуск: TENANTS_FILE=tenants.json python tenants.py (многопроцессный режим WORKERS > 1 не поддерживается)
+import asyncio
+import builtins
+import copy
+import importlib.util
+import json
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+from collections import ChainMap
+
+from dotenv import load_dotenv
+from flask import Blueprint, Flask, Response
+
+import campaigns
+import http_client
+import logging_setup
+import metrics
+import shutdown
+import startup
+import translation
+import workers
+from loop_monitor import loop_monitor
+from translations import translations
+
+logger = logging.getLogger(__name__)
+
+TENANTS_FILE = os.getenv("TENANTS_FILE", "tenants.json")
+TENANTS_DIR = os.getenv("TENANTS_DIR", "tenants")
+# Модули с состоянием бота в порядке зависимостей; остальные модули (http_client, translation,
+# campaigns, loop_monitor, ...) остаются общими
+TENANT_MODULES = ("storage", "metrics", "health", "shutdown", "router", "throttle", "albums", "assignment",
+                  "segments", "posts_catalog", "canned", "users_io", "backup", "transcripts", "events", "media",
+                  "tango")
+# Настройки, которые читает tango.load_settings(): передаются ему вместе с окружением процесса
+BOT_SETTINGS = ("BOT_TOKEN", "ADMIN_ID", "OPERATORS", "REGISTER_URL", "PUBLIC_URL", "TRACK_REGISTER_CLICKS",
+                "FLOOD_PROTECTION", "BROADCAST_CHECKPOINT_EVERY", "BROADCAST_STALE_AFTER", "SEGMENT_REFRESH_INTERVAL")
+# Настройки модулей бота (их читают configure() модулей из того же env): настройка -> тип для проверки
+MODULE_SETTINGS = {
+    "DB_PATH": str,
+    "MEDIA_DIR": str,
+    "MEDIA_SOURCE_DIR": str,
+    "BACKUP_DIR": str,
+    "BACKUP_INTERVAL": int,
+    "BACKUP_KEEP_LAST": int,
+    "BACKUP_KEEP_DAYS": int,
+    "TRANSCRIPT_DB": str,
+    "OPERATOR_SKILLS": str,
+    "OPERATOR_CAPACITY": int,
+    "ASSIGN_TIMEOUT": float,
+}
+# Файлы бота в DATA_DIR, если в его настройках не указано иное
+DATA_SETTINGS = {"DB_PATH": "users.db", "MEDIA_DIR": "media", "MEDIA_SOURCE_DIR": "images",
+                 "BACKUP_DIR": "backups", "TRANSCRIPT_DB": "archive.db"}
+REQUIRED_SETTINGS = ("BOT_TOKEN", "ADMIN_ID")
+# Имя входит в адреса вебхука и служебных страниц
+_NAME_RE = re.compile(r"^[a-z0-9_-]{1,32}$")
+
+web = Blueprint("tenants", __name__)
+_tenants = []
+bot_loop = None
+ready = threading.Event()
+finished = threading.Event()
+
+
+class TenantError(ValueError):
+    pass
+
+
+class Tenant:
+    __slots__ = ("name", "settings", "data_dir", "modules")
+
+    def __init__(self, name, settings, data_dir):
+        self.name = name
+        self.settings = settings
+        self.data_dir = data_dir
+        # Имя модуля -> копия модуля этого бота
+        self.modules = {}
+
+    @property
+    def bot(self):
+        return self.modules["tango"]
+
+
+def parse_config(entries):
+    if not isinstance(entries, list) or not entries:
+        raise TenantError("ожидается непустой список ботов")
+    tenants = []
+    tokens = set()
+    for entry in entries:
+        if not isinstance(entry, dict):
+            raise TenantError(f"ожидается объект JSON, а не {entry!r}")
+        name = str(entry.get("name", ""))
+        if not _NAME_RE.match(name):
+            raise TenantError(f"неверное имя бота {name!r}: до 32 строчных латинских букв, цифр, '_' или '-'")
+        if any(tenant.name == name for tenant in tenants):
+            raise TenantError(f"бот {name} указан дважды")
+        settings = {key: str(value) for key, value in entry.items() if key != "name"}
+        for key in settings:
+            if key not in BOT_SETTINGS and key not in MODULE_SETTINGS and key != "DATA_DIR":
+                raise TenantError(f"у бота {name} задана настройка {key}: её нельзя задать отдельному боту, "
+                                  f"общие настройки задаются в окружении")
+        for key in REQUIRED_SETTINGS:
+            if not settings.get(key):
+                raise TenantError(f"у бота {name} не задан {key}")
+        if not settings["ADMIN_ID"].isdigit():
+            raise TenantError(f"у бота {name} ADMIN_ID должен быть числом")
+        for key, cast in MODULE_SETTINGS.items():
+            try:
+                if key in settings:
+                    cast(settings[key])
+            except ValueError:
+                raise TenantError(f"у бота {name} неверное значение {key}: {settings[key]!r}")
+        if settings["BOT_TOKEN"] in tokens:
+            raise TenantError(f"у бота {name} тот же BOT_TOKEN, что у другого бота")
+        tokens.add(settings["BOT_TOKEN"])
+        data_dir = settings.pop("DATA_DIR", os.path.join(TENANTS_DIR, name))
+        for key, file_name in DATA_SETTINGS.items():
+            settings.setdefault(key, os.path.join(data_dir, file_name))
+        tenants.append(Tenant(name, settings, data_dir))
+    return tenants
+
+
+def load_config(path=None):
+    path = path or TENANTS_FILE
+    try:
+        with open(path, encoding="utf-8") as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as e:
+        raise TenantError(f"не удалось прочитать {path}: {e}")
+    return parse_config(entries)
+
+
+def load_modules():
+    # Экземпляры TENANT_MODULES одного бота. Импорты внутри экземпляров (и при импорте, и отложенные
+    # в функциях) идут через их собственный __import__: модули бота получают экземпляры этого же бота,
+    # остальные импортируются как обычно. sys.modules не меняется, поэтому загрузка безопасна для
+    # потоков, которые в это время что-то импортируют. Настройки здесь не задаются: их получает
+    # tango.load_settings
+    modules = {}
+
+    def tenant_import(name, globals=None, locals=None, fromlist=(), level=0):
+        if level == 0 and name in modules:
+            return modules[name]
+        return builtins.__import__(name, globals, locals, fromlist, level)
+
+    module_builtins = dict(vars(builtins), __import__=tenant_import)
+    for name in TENANT_MODULES:
+        spec = importlib.util.find_spec(name)
+        module = importlib.util.module_from_spec(spec)
+        module.__builtins__ = module_builtins
+        spec.loader.exec_module(module)
+        modules[name] = module
+    return modules
+
+
+def load_tenant(tenant):
+    os.makedirs(tenant.data_dir, exist_ok=True)
+    with startup.phase(f"tenant {tenant.name}"):
+        tenant.modules = load_modules()
+        for name, module in tenant.modules.items():
+            # Записи экземпляров в общем логе различаются по имени бота: tango.alpha, events.alpha, ...
+            if hasattr(module, "logger"):
+                module.logger = logging.getLogger(f"{name}.{tenant.name}")
+        bot = tenant.bot
+        bot.TENANT = tenant.name
+        bot.URL_PREFIX = f"/{tenant.name}"
+        bot.SHARED_RUNTIME = True
+        # load_settings() записывает в каталог переводов ссылку на регистрацию, у каждого бота она своя
+        bot.translations = copy.deepcopy(translations)
+        bot.create_application(ChainMap(tenant.settings, os.environ))
+        bot.init_storage()
+    logger.info(f"Tenant {tenant.name} loaded: data in {tenant.data_dir}, admin {bot.ADMIN_ID}, "
+                f"{len(bot.operator_ids)} operators")
+    return tenant
+
+
+# Flask-приложение: адреса каждого бота под /<имя>, общие проверки здоровья и метрики — в корне
+def create_app(tenants):
+    app = Flask(__name__)
+    for tenant in tenants:
+        app.register_blueprint(tenant.bot.web, name=f"tango_{tenant.name}", url_prefix=f"/{tenant.name}")
+    app.register_blueprint(web)
+    return app
+
+
+async def run_bots():
+    global bot_loop
+    bot_loop = asyncio.get_running_loop()
+    loop_monitor.start(bot_loop)
+    try:
+        await asyncio.gather(*(tenant.bot.start_bot() for tenant in _tenants))
+    finally:
+        ready.set()
+    while not finished.is_set():
+        await asyncio.sleep(1)
+
+
+async def drain():
+    # Все боты сразу перестают принимать апдейты и останавливаются параллельно; общие планировщик
+    # кампаний, сторож цикла и HTTP-пулы принадлежат процессу и закрываются здесь один раз, после всех
+    for tenant in _tenants:
+        tenant.modules["shutdown"].draining.set()
+    await asyncio.gather(*(tenant.modules["shutdown"].drain() for tenant in _tenants))
+    campaigns.shutdown()
+    loop_monitor.stop()
+    await http_client.aclose()
+    finished.set()
+
+
+def install(loop):
+    def handle(signum, frame):
+        if shutdown.draining.is_set():
+            return
+        shutdown.draining.set()
+        logger.info(f"Received signal {signum}, shutting down {len(_tenants)} bots")
+        future = asyncio.run_coroutine_threadsafe(drain(), loop)
+        try:
+            future.result(shutdown.DRAIN_DEADLINE + 5)
+        except Exception as e:
+            logger.error(f"Drain did not complete: {e}")
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, handle)
+    signal.signal(signal.SIGINT, handle)
+
+
+def combined_health(check):
+    healthy = True
+    results = {}
+    for tenant in _tenants:
+        tenant_healthy, results[tenant.name] = check(tenant.modules["health"])
+        healthy = healthy and tenant_healthy
+    state = translation.breaker.state
+    body = {"status": "ok" if healthy else "fail", "tenants": results, "translation_breaker": state}
+    return Response(json.dumps(body), status=200 if healthy else 503, mimetype="application/json")
+
+
+@web.route('/healthz')
+def healthz():
+    return combined_health(lambda health: health.liveness())
+
+
+@web.route('/readyz')
+def readyz():
+    return combined_health(lambda health: health.readiness())
+
+
+@web.route('/ping')
+def ping():
+    return healthz()
+
+
+# Общие метрики процесса (HTTP-пулы, переводчик, цикл событий); метрики бота — на /<имя>/metrics
+@web.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+
+def main():
+    logging_setup.setup_logging()
+    # .env читается один раз до загрузки ботов; дальше окружение процесса только читается
+    load_dotenv()
+    try:
+        if workers.WORKERS > 1:
+            raise TenantError("несколько ботов работают в одном процессе, WORKERS > 1 не поддерживается")
+        tenants = load_config()
+        for tenant in tenants:
+            load_tenant(tenant)
+    except TenantError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    _tenants.extend(tenants)
+    app = create_app(tenants)
+    port = int(os.getenv("PORT", 8080))
+
+    bot_thread = threading.Thread(target=lambda: asyncio.run(run_bots()))
+    bot_thread.start()
+    ready.wait()
+    if not all(tenant.bot.bot_ready.is_set() for tenant in tenants):
+        logger.error("Not all bots started, exiting")
+        finished.set()
+        sys.exit(1)
+    install(bot_loop)
+
+    print(f"Запуск Flask на порту {port}: боты {', '.join(tenant.name for tenant in tenants)}")
+    app.run(host="0.0.0.0", port=port)
+
+
+if __name__ == "__main__":
+    main()
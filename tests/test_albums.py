@@ -0,0 +1,31 @@
+import asyncio
+from types import SimpleNamespace
+
+import albums
+
+
+def part(message_id, group="g1", chat_id=1):
+    return SimpleNamespace(chat_id=chat_id, media_group_id=group, message_id=message_id)
+
+
+def test_parts_are_flushed_once_in_order_and_tasks_are_released():
+    flushed = []
+
+    async def flush(messages, context):
+        flushed.append([message.message_id for message in messages])
+
+    async def scenario():
+        collector = albums.AlbumCollector(flush, window=0.01)
+        for message_id in (3, 1, 2):
+            collector.add(part(message_id), None)
+        await asyncio.sleep(0.05)
+        assert collector._tasks == set()
+        for message_id in range(albums.ALBUM_MAX_PARTS):
+            collector.add(part(message_id, group="g2"), None)
+        assert len(collector._tasks) == 1
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert collector._tasks == set()
+
+    asyncio.run(scenario())
+    assert flushed == [[1, 2, 3], list(range(albums.ALBUM_MAX_PARTS))]
@@ -0,0 +1,100 @@
+import pytest
+
+import assignment
+import tango
+import workers
+from conversation import Conversation
+
+
+def make_queue(skills=None):
+    return assignment.AssignmentQueue([1, 2, 3], skills=skills or {})
+
+
+def test_parse_skills():
+    skills = assignment.parse_skills("2:ru, uk:3; 5::1;bad;6:en:x")
+    assert skills == {2: ({"ru", "uk"}, 3), 5: (None, 1)}
+
+
+def test_requests_go_to_least_loaded_operator():
+    queue = make_queue({1: (None, 2), 2: (None, 2), 3: (None, 2)})
+    assert queue.submit("a", "ru", 0) == 1
+    assert queue.submit("b", "ru", 1) == 2
+    assert queue.submit("c", "ru", 2) == 3
+    queue.accept("a", 1, 5)
+    queue.accept("b", 2, 5)
+    queue.finish("b", 2, 10)
+    # Операторы 2 и 3 загружены одинаково, 2 получал запрос раньше
+    assert queue.submit("d", "ru", 11) == 2
+
+
+def test_operator_with_language_is_preferred():
+    queue = make_queue({3: ({"en"}, 1)})
+    assert queue.submit("a", "en", 0) == 3
+    assert queue.submit("b", "en", 1) == 1
+
+
+def test_request_waits_until_operator_frees_up():
+    queue = assignment.AssignmentQueue([1], skills={})
+    assert queue.submit("a", "ru", 0) == 1
+    assert queue.submit("b", "ru", 1) is None
+    assert queue.dispatch(2) == []
+    assert queue.accept("a", 1, 3) == 3
+    queue.finish("a", 1, 20)
+    assert queue.dispatch(21) == [("b", 1)]
+
+
+def test_unaccepted_request_is_broadcast_after_timeout():
+    queue = make_queue()
+    assert queue.submit("a", "ru", 0) == 1
+    assert queue.expire(30, timeout=60) == []
+    assert queue.expire(61, timeout=60) == ["a"]
+    assert queue.expire(120, timeout=60) == []
+    assert queue.operators[1].misses == 1
+    assert not queue.operators[1].offers
+    # Любой оператор может принять разосланный запрос
+    assert queue.accept("a", 2, 70) == 70
+
+
+def test_restored_chats_count_towards_load():
+    queue = make_queue()
+    queue.restore_chat("old", 1)
+    queue.enqueue("waiting", "ru", 0)
+    assert queue.dispatch(5) == [("waiting", 2)]
+
+
+@pytest.fixture
+def support_state(monkeypatch):
+    monkeypatch.setattr(tango, "active_requests", {})
+    monkeypatch.setattr(tango, "operator_active", {})
+    released = []
+    monkeypatch.setattr(workers, "release_operator", released.append)
+    return released
+
+
+def open_chat(request_id, operator_id, created_at):
+    conv = Conversation(request_id, 100 + created_at, "user", "ru", created_at)
+    conv.assigned_operator = operator_id
+    tango.active_requests[request_id] = conv
+    tango.operator_active[operator_id] = request_id
+    return conv
+
+
+def test_finishing_latest_of_two_chats_switches_to_the_other(support_state):
+    open_chat("first", 7, 1)
+    open_chat("second", 7, 2)
+    tango.unbind_operator(7, "second")
+    del tango.active_requests["second"]
+    assert tango.operator_active[7] == "first"
+    assert support_state == []
+    tango.unbind_operator(7, "first")
+    del tango.active_requests["first"]
+    assert 7 not in tango.operator_active
+    assert support_state == [7]
+
+
+def test_finishing_other_chat_keeps_current(support_state):
+    open_chat("first", 7, 1)
+    open_chat("second", 7, 2)
+    tango.unbind_operator(7, "first")
+    assert tango.operator_active[7] == "second"
+    assert support_state == []
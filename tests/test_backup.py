@@ -0,0 +1,100 @@
+import gzip
+import os
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+import backup
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    path = tmp_path / "users.db"
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY)")
+    conn.execute("CREATE TABLE posts (id INTEGER PRIMARY KEY)")
+    conn.execute("CREATE TABLE scheduled_posts (id INTEGER PRIMARY KEY)")
+    conn.executemany("INSERT INTO users (user_id) VALUES (?)", [(1,), (2,), (3,)])
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(backup.storage, "DB_PATH", str(path))
+    monkeypatch.setattr(backup, "BACKUP_DIR", str(tmp_path / "backups"))
+    return path
+
+
+def infos(*created):
+    # От новых к старым, как list_backups
+    return [backup.BackupInfo(f"users-{moment:%Y%m%d-%H%M%S}.db.gz", moment, 1)
+            for moment in sorted(created, reverse=True)]
+
+
+def test_keeps_last_copies_and_latest_copy_per_day():
+    now = datetime(2025, 3, 10, 12, 0)
+    backups = infos(*(now - timedelta(hours=6 * index) for index in range(12)))
+    expired = backup.expired_backups(backups, now, keep_last=3, keep_days=14)
+    kept = [info.created_at for info in backups if info not in expired]
+    assert kept == [now, now - timedelta(hours=6), now - timedelta(hours=12), datetime(2025, 3, 9, 18, 0),
+                    datetime(2025, 3, 8, 18, 0), datetime(2025, 3, 7, 18, 0)]
+
+
+def test_copies_older_than_keep_days_expire():
+    now = datetime(2025, 3, 10, 12, 0)
+    backups = infos(now, now - timedelta(days=2), now - timedelta(days=20), now - timedelta(days=30))
+    expired = backup.expired_backups(backups, now, keep_last=1, keep_days=14)
+    assert [info.created_at for info in expired] == [now - timedelta(days=20), now - timedelta(days=30)]
+
+
+def test_keep_last_protects_old_copies():
+    now = datetime(2025, 3, 10, 12, 0)
+    backups = infos(now - timedelta(days=40), now - timedelta(days=50))
+    assert backup.expired_backups(backups, now, keep_last=2, keep_days=14) == []
+
+
+def test_create_verify_and_rotate(database, monkeypatch):
+    monkeypatch.setattr(backup, "BACKUP_KEEP_LAST", 1)
+    monkeypatch.setattr(backup, "BACKUP_KEEP_DAYS", 1)
+    now = datetime(2025, 3, 10, 12, 0)
+    for days in (5, 3, 0):
+        backup.create_backup(now=now - timedelta(days=days))
+    assert len(backup.list_backups()) == 3
+    latest = backup.list_backups()[0]
+    assert backup.verify_backup(latest.path) == {"users": 3, "posts": 0, "scheduled_posts": 0}
+    assert backup.rotate(now=now) == 2
+    assert [info.path for info in backup.list_backups()] == [latest.path]
+    assert not [name for name in os.listdir(backup.BACKUP_DIR) if name.endswith((".db", ".tmp"))]
+
+
+def test_verify_rejects_damaged_copies(database, tmp_path):
+    truncated = tmp_path / "truncated.db.gz"
+    truncated.write_bytes(gzip.compress(os.urandom(4096))[:100])
+    with pytest.raises(backup.BackupError, match="decompress"):
+        backup.verify_backup(str(truncated))
+    garbage = tmp_path / "garbage.db.gz"
+    garbage.write_bytes(gzip.compress(b"not a database" * 100))
+    with pytest.raises(backup.BackupError):
+        backup.verify_backup(str(garbage))
+
+
+def test_verify_rejects_foreign_database(tmp_path):
+    other = tmp_path / "other.db"
+    conn = sqlite3.connect(other)
+    conn.execute("CREATE TABLE users (user_id INTEGER)")
+    conn.commit()
+    conn.close()
+    with pytest.raises(backup.BackupError, match="missing tables: posts, scheduled_posts"):
+        backup.check_database(str(other))
+
+
+def test_restore_brings_back_rows_and_saves_current_state(database):
+    info = backup.create_backup(now=datetime(2025, 3, 10, 12, 0))
+    conn = sqlite3.connect(database)
+    conn.execute("DELETE FROM users")
+    conn.commit()
+    conn.close()
+    counts, safety = backup.restore_backup(info.path)
+    assert counts["users"] == 3
+    assert backup.verify_backup(safety.path)["users"] == 0
+    conn = sqlite3.connect(database)
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 3
+    conn.close()
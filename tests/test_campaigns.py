@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import campaigns
+
+UTC = ZoneInfo("UTC")
+# Понедельник
+START = datetime(2025, 3, 3, 0, 0, tzinfo=UTC)
+
+
+def fire_days(text, count=7):
+    # Дни недели (0 — понедельник) первых count запусков начиная с START
+    trigger = campaigns.parse_recurrence(text, tz=UTC)
+    days = []
+    previous = None
+    now = START
+    for _ in range(count):
+        previous = trigger.get_next_fire_time(previous, now)
+        days.append(previous.weekday())
+        now = previous + timedelta(microseconds=1)
+    return days
+
+
+@pytest.mark.parametrize("field, expected", [
+    ("*", "*"),
+    ("0-6", "*"),
+    ("1-5", "mon,tue,wed,thu,fri"),
+    ("0-5", "sun,mon,tue,wed,thu,fri"),
+    ("*/2", "sun,tue,thu,sat"),
+    ("1/2", "mon,wed,fri"),
+    ("0,7", "sun"),
+    ("5-7", "sun,fri,sat"),
+    ("mon-fri", "mon,tue,wed,thu,fri"),
+])
+def test_cron_days(field, expected):
+    assert campaigns.cron_days(field) == expected
+
+
+@pytest.mark.parametrize("field", ["8", "6-1", "*/0", "*-3", "mo", "1--2"])
+def test_cron_days_rejects_invalid_fields(field):
+    with pytest.raises(campaigns.CampaignError):
+        campaigns.cron_days(field)
+
+
+def test_cron_every_day():
+    assert fire_days("0 9 * * 0-6") == [0, 1, 2, 3, 4, 5, 6]
+
+
+def test_cron_weekdays():
+    assert fire_days("0 9 * * 1-5") == [0, 1, 2, 3, 4, 0, 1]
+
+
+def test_cron_range_starting_on_sunday():
+    assert fire_days("0 9 * * 0-5", count=6) == [0, 1, 2, 3, 4, 6]
+
+
+def test_cron_step():
+    assert fire_days("0 9 * * */2", count=4) == [1, 3, 5, 6]
+
+
+def test_cron_sunday_as_seven():
+    assert fire_days("30 10 * * 7", count=2) == [6, 6]
+
+
+def test_weekly_russian_day_names():
+    assert fire_days("еженедельно пн,чт 10:00", count=4) == [0, 3, 0, 3]
+    assert fire_days("Еженедельно  сб-вс 12:30", count=2) == [5, 6]
+
+
+def test_daily_and_interval():
+    trigger = campaigns.parse_recurrence("ежедневно 10:00", tz=UTC)
+    assert trigger.get_next_fire_time(None, START) == START.replace(hour=10)
+    assert campaigns.parse_recurrence("каждые 6ч", tz=UTC).interval == timedelta(hours=6)
+
+
+@pytest.mark.parametrize("text", ["*/5 * * * *", "каждые 10m", "когда-нибудь", "каждые 2 года", "0 9 * * 9"])
+def test_invalid_or_too_frequent_schedules(text):
+    with pytest.raises(campaigns.CampaignError):
+        campaigns.parse_recurrence(text, tz=UTC)
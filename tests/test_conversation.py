@@ -0,0 +1,121 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+import conversation
+from conversation import Conversation, MediaAlbum, MediaRecord
+
+
+@pytest.fixture(autouse=True)
+def spill_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(conversation, "SPILL_DIR", str(tmp_path / "spill"))
+    monkeypatch.setattr(conversation, "HISTORY_TAIL", 4)
+
+
+def handoff(conv, old_now, new_now):
+    # Как при передаче следующему экземпляру: снимок проходит через JSON, старый чат закрывается
+    state = json.loads(json.dumps(conv.to_state(old_now)))
+    conv.close()
+    return Conversation.from_state(state, new_now)
+
+
+def test_times_are_rebased_to_the_new_loop_clock():
+    conv = Conversation("r1", 10, "user", "en", created_at=1000.0)
+    conv.last_activity = 1300.0
+    conv.notified_at = 1200.0
+    conv.first_response_at = 1100.0
+    restored = handoff(conv, old_now=1500.0, new_now=20.0)
+    assert restored.created_at == pytest.approx(-480.0)
+    assert restored.last_activity == pytest.approx(-180.0)
+    assert restored.notified_at == pytest.approx(-280.0)
+    assert restored.first_response_at == pytest.approx(-380.0)
+    # Возраст чата и время без активности сохраняются
+    assert 20.0 - restored.created_at == pytest.approx(500.0)
+    assert 20.0 - restored.last_activity == pytest.approx(200.0)
+
+
+def test_missing_first_response_stays_none():
+    conv = Conversation("r1", 10, "user", "en", created_at=5.0)
+    assert handoff(conv, old_now=10.0, new_now=3.0).first_response_at is None
+
+
+def test_operator_binding_messages_and_media_survive():
+    conv = Conversation("r1", 10, "user", "uk", created_at=0.0)
+    conv.assigned_operator = 2
+    conv.operator_name = "Анна"
+    conv.operator_messages = {2: 55, 3: 56}
+    conv.additional_operator_messages = [(2, 57)]
+    conv.media_files = [MediaRecord("Фото", "file-1", "подпись", "user", 60, ts=1.0),
+                        MediaAlbum([("photo", "file-2", "a"), ("photo", "file-3", "")], "operator", [61, 62],
+                                   [70, 71], ts=2.0)]
+    restored = handoff(conv, old_now=100.0, new_now=1.0)
+    assert restored.assigned_operator == 2
+    assert restored.operator_name == "Анна"
+    assert restored.operator_messages == {2: 55, 3: 56}
+    assert restored.additional_operator_messages == [(2, 57)]
+    record, album = restored.media_files
+    assert (record.kind, record.file_id, record.message_id, record.ts) == ("Фото", "file-1", 60, 1.0)
+    assert album.items == [("photo", "file-2", "a"), ("photo", "file-3", "")]
+    assert album.user_message_ids() == [70, 71]
+
+
+def test_spilled_history_is_carried_over_in_order():
+    conv = Conversation("r1", 10, "user", "ru", created_at=0.0)
+    for index in range(10):
+        conv.add_message("user", f"m{index}", ts=float(index))
+    assert conv.spilled_count > 0
+    restored = handoff(conv, old_now=50.0, new_now=1.0)
+    assert [message.content for message in restored.iter_history()] == [f"m{index}" for index in range(10)]
+    assert [message.ts for message in restored.iter_history()] == [float(index) for index in range(10)]
+    assert restored.message_count() == 10
+    restored.close()
+
+
+def test_tracked_messages_and_media_are_capped(monkeypatch):
+    monkeypatch.setattr(conversation, "MAX_TRACKED_MESSAGES", 3)
+    monkeypatch.setattr(conversation, "MAX_MEDIA_FILES", 2)
+    conv = Conversation("r1", 10, "user", "ru", created_at=0.0)
+    for message_id in range(5):
+        conv.track_message(2, message_id)
+        conv.add_media(MediaRecord("Фото", f"file-{message_id}", "", "user", message_id, ts=float(message_id)))
+    assert conv.additional_operator_messages == [(2, 2), (2, 3), (2, 4)]
+    assert [media.message_id for media in conv.media_files] == [3, 4]
+    assert conv.dropped_media == 3
+    restored = handoff(conv, old_now=10.0, new_now=1.0)
+    assert restored.dropped_media == 3
+    assert len(restored.media_files) == 2
+
+
+def test_spill_writes_in_a_thread_off_the_loop(monkeypatch):
+    threads = []
+    original = Conversation.flush_spill
+
+    def flush_spill(self):
+        threads.append(threading.current_thread())
+        original(self)
+
+    monkeypatch.setattr(Conversation, "flush_spill", flush_spill)
+
+    async def scenario():
+        conv = Conversation("r1", 10, "user", "ru", created_at=0.0)
+        for index in range(10):
+            conv.add_message("user", f"m{index}", ts=float(index))
+        # До записи в файл вынутые сообщения видны из очереди
+        assert [message.content for message in conv.iter_history()] == [f"m{index}" for index in range(10)]
+        await asyncio.gather(*conversation._spill_tasks)
+        assert not conv.spill_pending
+        assert [message.content for message in conv.iter_history()] == [f"m{index}" for index in range(10)]
+        conv.close()
+
+    asyncio.run(scenario())
+    assert threads and all(thread is not threading.main_thread() for thread in threads)
+
+
+def test_close_drops_pending_spill():
+    conv = Conversation("r1", 10, "user", "ru", created_at=0.0)
+    conv.spill_pending.append(conversation.Message(1.0, "user", "late"))
+    conv.close()
+    conv.flush_spill()
+    assert conv.spill_path is None
@@ -0,0 +1,41 @@
+import pytest
+
+import health
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(health.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(health, "_jobs", {})
+    return now
+
+
+def test_long_running_job_is_not_stale(clock):
+    health.expect_job("check_scheduled_posts", 60)
+    health.job_started("check_scheduled_posts")
+    clock[0] += 60 * health.HEALTH_JOB_GRACE - 1
+    status, details = health.check_jobs()
+    assert status == "ok"
+    assert details["check_scheduled_posts"]["running_seconds"] == pytest.approx(60 * health.HEALTH_JOB_GRACE - 1)
+
+
+def test_job_that_stops_starting_is_stale(clock):
+    health.expect_job("check_timeouts", 60)
+    health.job_started("check_timeouts")
+    health.job_finished("check_timeouts")
+    clock[0] += 60 * health.HEALTH_JOB_GRACE + 1
+    status, details = health.check_jobs()
+    assert status == "fail"
+    assert details["check_timeouts"]["stale"]
+    assert "running_seconds" not in details["check_timeouts"]
+
+
+def test_run_collects_failures_and_exceptions():
+    def broken():
+        raise RuntimeError("boom")
+
+    healthy, body = health.run({"ok": lambda: ("ok", {}), "broken": broken})
+    assert not healthy
+    assert body["checks"]["broken"] == {"status": "fail", "error": "boom"}
+    assert body["checks"]["ok"]["status"] == "ok"
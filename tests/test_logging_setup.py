@@ -0,0 +1,43 @@
+import logging
+
+import pytest
+
+import logging_setup
+
+
+@pytest.fixture
+def log_settings(tmp_path, monkeypatch):
+    monkeypatch.setattr(logging_setup, "LOG_FILE", str(tmp_path / "bot.log"))
+    monkeypatch.setattr(logging_setup, "LOG_STDERR", False)
+    monkeypatch.setattr(logging_setup, "LOG_FORMAT", "text")
+    monkeypatch.setattr(logging_setup, "LOG_SAMPLING", "test.noisy=0.5")
+    yield tmp_path / "bot.log"
+    logging_setup.stop_logging()
+
+
+def queue_handlers():
+    return [handler for handler in logging.getLogger().handlers
+            if isinstance(handler, logging_setup.DroppingQueueHandler)]
+
+
+def test_setup_stop_setup_does_not_duplicate_handlers(log_settings):
+    logging_setup.setup_logging()
+    assert len(queue_handlers()) == 1
+    assert len(logging.getLogger("test.noisy").filters) == 1
+
+    logging_setup.stop_logging()
+    assert queue_handlers() == []
+    assert logging.getLogger("test.noisy").filters == []
+    assert logging_setup.dropped_counts() == {("queue_full",): 0, ("sampled",): 0}
+
+    logging_setup.setup_logging()
+    assert len(queue_handlers()) == 1
+    assert len(logging.getLogger("test.noisy").filters) == 1
+    logging.getLogger("test.once").warning("written once")
+    logging_setup.stop_logging()
+    assert log_settings.read_text().count("written once") == 1
+
+
+def test_stop_without_setup_is_harmless(log_settings):
+    logging_setup.stop_logging()
+    assert queue_handlers() == []
@@ -0,0 +1,105 @@
+import asyncio
+from io import BytesIO
+
+import httpx
+import pytest
+
+import http_client
+import media
+
+
+@pytest.fixture
+def source_dir(tmp_path, monkeypatch):
+    root = tmp_path / "images"
+    root.mkdir()
+    monkeypatch.setattr(media, "MEDIA_SOURCE_DIR", str(root))
+    monkeypatch.setattr(media, "MAX_SOURCE_BYTES", 100)
+    return root
+
+
+@pytest.fixture
+def served(monkeypatch):
+    # Ответы отдаются частями по 10 байт; считается, сколько частей сервер успел отдать
+    state = {"body": b"", "sent": 0, "headers": {}}
+
+    async def chunks():
+        body = state["body"]
+        for start in range(0, len(body), 10):
+            state["sent"] += 1
+            yield body[start:start + 10]
+
+    def handler(request):
+        return httpx.Response(200, headers=state["headers"], content=chunks())
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(http_client, "stream", client.stream)
+    return state
+
+
+def test_local_source_inside_allowed_dir(source_dir):
+    (source_dir / "a.jpg").write_bytes(b"x" * 50)
+    assert asyncio.run(media.fetch_source(str(source_dir / "a.jpg"))) == b"x" * 50
+
+
+def test_local_source_outside_allowed_dir_is_refused(source_dir, tmp_path):
+    (tmp_path / "users.db").write_bytes(b"secret")
+    with pytest.raises(media.MediaError, match="outside"):
+        asyncio.run(media.fetch_source(str(tmp_path / "users.db")))
+    with pytest.raises(media.MediaError, match="outside"):
+        asyncio.run(media.fetch_source(str(source_dir / ".." / "users.db")))
+
+
+def test_local_symlink_out_of_allowed_dir_is_refused(source_dir, tmp_path):
+    (tmp_path / "users.db").write_bytes(b"secret")
+    (source_dir / "link.jpg").symlink_to(tmp_path / "users.db")
+    with pytest.raises(media.MediaError, match="outside"):
+        asyncio.run(media.fetch_source(str(source_dir / "link.jpg")))
+
+
+def test_local_source_too_large(source_dir):
+    (source_dir / "big.jpg").write_bytes(b"x" * 101)
+    with pytest.raises(media.MediaError, match="larger"):
+        asyncio.run(media.fetch_source(str(source_dir / "big.jpg")))
+
+
+def test_url_source_read_in_full(served, source_dir):
+    served["body"] = b"y" * 95
+    assert asyncio.run(media.fetch_source("https://example.com/a.jpg")) == b"y" * 95
+
+
+def test_url_source_aborted_once_limit_exceeded(served, source_dir):
+    served["body"] = b"y" * 1000
+    with pytest.raises(media.MediaError, match="larger"):
+        asyncio.run(media.fetch_source("https://example.com/a.jpg"))
+    assert served["sent"] == 11
+
+
+def test_url_source_refused_by_content_length(served, source_dir):
+    served["body"] = b"y" * 1000
+    served["headers"] = {"Content-Length": "1000"}
+    with pytest.raises(media.MediaError, match="larger"):
+        asyncio.run(media.fetch_source("https://example.com/a.jpg"))
+    assert served["sent"] == 0
+
+
+def encode(image, fmt, **options):
+    buffer = BytesIO()
+    image.save(buffer, fmt, **options)
+    return buffer.getvalue()
+
+
+def test_oversized_image_is_resized_and_reencoded():
+    Image = pytest.importorskip("PIL.Image")
+    source = encode(Image.new("RGBA", (3000, 2000), (200, 10, 10, 128)), "PNG")
+    data, width, height = media.preprocess(source)
+    assert (width, height) == (media.MEDIA_MAX_SIDE, media.MEDIA_MAX_SIDE * 2 // 3)
+    assert data[:3] == b"\xff\xd8\xff"
+    decoded = Image.open(BytesIO(data))
+    assert decoded.format == "JPEG" and decoded.mode == "RGB"
+    assert decoded.size == (width, height)
+
+
+def test_small_jpeg_is_kept_as_is():
+    Image = pytest.importorskip("PIL.Image")
+    source = encode(Image.effect_noise((200, 100), 64).convert("RGB"), "JPEG", quality=50)
+    assert media.preprocess(source) == (source, 200, 100)
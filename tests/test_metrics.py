@@ -0,0 +1,24 @@
+import metrics
+
+
+def test_bot_api_method_labels_methods():
+    assert metrics.bot_api_method("https://api.telegram.org/bot123:ABC/sendMessage") == "sendMessage"
+    assert metrics.bot_api_method("http://localhost:8081/bot123:ABC/getMe") == "getMe"
+
+
+def test_bot_api_method_hides_file_paths():
+    assert metrics.bot_api_method("https://api.telegram.org/file/bot123:ABC/photos/file_1.jpg") == "file"
+    assert metrics.bot_api_method("https://api.telegram.org/file/bot123:ABC/documents/x/y.pdf") == "file"
+    assert metrics.bot_api_method("https://api.telegram.org/") == "other"
+
+
+def test_counter_and_histogram_render():
+    registry = metrics.Registry()
+    counter = registry.register(metrics.Counter("test_total", "Test", ("kind",)))
+    histogram = registry.register(metrics.Histogram("test_seconds", "Test", buckets=(1, 5)))
+    counter.inc(kind='a"b')
+    histogram.observe(2)
+    text = registry.render()
+    assert 'test_total{kind="a\\"b"} 1' in text
+    assert 'test_seconds_bucket{le="1"} 0' in text
+    assert 'test_seconds_bucket{le="5"} 1' in text
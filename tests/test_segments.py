@@ -0,0 +1,114 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+import segments
+
+
+def ago(**delta):
+    return (datetime.now() - timedelta(**delta)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    path = str(tmp_path / "users.db")
+    monkeypatch.setattr(segments.storage, "DB_PATH", path)
+    monkeypatch.setattr(segments, "_dirty", set())
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, phone_number TEXT, "
+                 "first_start TEXT, language TEXT, is_blocked TEXT DEFAULT 'No', last_interaction TEXT)")
+    conn.execute("CREATE TABLE event_users (day TEXT, step TEXT, user_id INTEGER, "
+                 "PRIMARY KEY (day, step, user_id)) WITHOUT ROWID")
+    conn.executemany("INSERT INTO users (user_id, first_start, language, is_blocked, last_interaction) "
+                     "VALUES (?, ?, ?, ?, ?)", [
+                         (1, "2024-05-03 10:00:00", "ru", "No", ago(days=1)),
+                         (2, "2024-06-01 10:00:00", "uk", "No", ago(days=20)),
+                         (3, ago(days=2), "en", "No", ago(hours=1)),
+                         (4, "2024-05-20 10:00:00", "ru", "Yes", ago(days=1)),
+                     ])
+    conn.execute("INSERT INTO event_users (day, step, user_id) VALUES (?, 'register', 2)",
+                 ((datetime.now() - timedelta(days=3)).strftime("%Y-%m-%d"),))
+    conn.commit()
+    conn.close()
+    segments.init_segments()
+    return path
+
+
+def members(definition):
+    return sorted(user_id for ids in segments.audience(definition).values() for user_id in ids)
+
+
+@pytest.mark.parametrize("definition, expected", [
+    ("", [1, 2, 3]),
+    ("lang:ru,uk", [1, 2]),
+    ("active<7d", [1, 3]),
+    ("active>7d", [2]),
+    ("joined<7d", [3]),
+    ("cohort:2024-05", [1]),
+    ("blocked:yes", [4]),
+    ("lang:ru blocked:yes", [4]),
+    ("event:register", [2]),
+    ("event:register<1d", []),
+    ("-lang:ru", [2, 3]),
+    ("lang:en or event:register", [2, 3]),
+    ("(lang:ru or lang:uk) active<7d", [1]),
+    ("id:1,3,4", [1, 3]),
+])
+def test_compile_segment(db, definition, expected):
+    assert members(definition) == expected
+
+
+@pytest.mark.parametrize("definition", ["lang", "active<7x", "cohort:May", "event:unknown", "id:a,b",
+                                        "(lang:ru", "lang:ru )", "or"])
+def test_compile_segment_rejects_invalid(definition):
+    with pytest.raises(segments.SegmentError):
+        segments.compile_segment(definition)
+
+
+def test_saved_segment_is_materialized_and_updated(db):
+    assert segments.save("russian", "lang:ru") == 1
+    assert members("@russian") == [1]
+    conn = sqlite3.connect(db)
+    with conn:
+        conn.execute("UPDATE users SET language = 'ru' WHERE user_id = 3")
+    conn.close()
+    segments.touch(3)
+    assert segments.apply_dirty() == 1
+    assert members("@russian") == [1, 3]
+    assert segments.count("@russian") == 2
+    assert segments.drop("russian")
+    with pytest.raises(segments.SegmentError):
+        segments.count("@russian")
+
+
+def test_saved_segment_name_rules(db):
+    with pytest.raises(segments.SegmentError):
+        segments.save("bad name", "lang:ru")
+    with pytest.raises(segments.SegmentError):
+        segments.save("x" * 33, "lang:ru")
+
+
+def test_button_key_fits_callback_data_for_long_cyrillic_names(db):
+    name = "я" * 32
+    segments.save(name, "lang:ru")
+    callback_data = f"recipient_segment_{segments.button_key(name)}"
+    assert len(callback_data.encode("utf-8")) <= 64
+    assert segments.find_by_key(segments.button_key(name)) == name
+    assert segments.find_by_key("0" * 16) is None
+
+
+def test_time_and_event_segments_are_counted_live(db):
+    assert segments.save("recent", "active<7d") == 2
+    assert segments.save("registered", "event:register") == 1
+    conn = sqlite3.connect(db)
+    with conn:
+        # Без touch: пользователь выпадает из срока, а событие приходит из свёртки events
+        conn.execute("UPDATE users SET last_interaction = ? WHERE user_id = 1", (ago(days=10),))
+        conn.execute("INSERT INTO event_users (day, step, user_id) VALUES (?, 'register', 3)",
+                     (datetime.now().strftime("%Y-%m-%d"),))
+    conn.close()
+    assert segments.count("@recent") == 1
+    assert members("@recent") == [3]
+    assert segments.count("@registered") == 2
+    assert members("@registered") == [2, 3]
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+import tango
+from conversation import Conversation
+
+
+@pytest.fixture
+def support_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(tango.storage, "DB_PATH", str(tmp_path / "users.db"))
+    monkeypatch.setattr(tango, "active_requests", {})
+    monkeypatch.setattr(tango, "active_conversations", {})
+    monkeypatch.setattr(tango, "operator_active", {})
+    monkeypatch.setattr(tango, "waiting_for_question", {})
+    monkeypatch.setattr(tango, "assignment_queue", None)
+    tango.init_db()
+
+
+def conversation_row(request_id, user_id, operator_id=None):
+    conv = Conversation(request_id, user_id, f"user{user_id}", "ru", 0.0)
+    conv.assigned_operator = operator_id
+    return request_id, "conversation", conv.to_state(0.0)
+
+
+def test_rows_of_removed_shards_go_to_the_users_shard(support_db):
+    tango.save_support_state(0, [conversation_row("0.a", 10)])
+    tango.save_support_state(3, [conversation_row("3.b", 11), ("waiting:12", "waiting", {"user_id": 12})])
+    assert [key for key, _, _ in tango.take_support_state(1, 2)] == ["3.b"]
+    assert sorted(key for key, _, _ in tango.take_support_state(0, 2)) == ["0.a", "waiting:12"]
+    assert tango.take_support_state(0, 2) == []
+
+
+def test_state_saved_after_start_is_claimed_later(support_db):
+    async def scenario():
+        tango.restore_support_state(tango.take_support_state(0, 1))
+        assert tango.active_requests == {}
+        # Старый экземпляр сохраняет состояние уже после запуска нового
+        tango.save_support_state(0, [conversation_row("a", 10, operator_id=7), conversation_row("b", 11, operator_id=7),
+                                     ("waiting:12", "waiting", {"user_id": 12})])
+        await tango.claim_support_state(None)
+
+    asyncio.run(scenario())
+    assert set(tango.active_requests) == {"a", "b"}
+    assert tango.waiting_for_question == {12: True}
+    # Второй чат того же оператора возвращается в ожидание
+    assert list(tango.operator_active.values()) == [tango.operator_active[7]]
+    assert sum(conv.assigned_operator == 7 for conv in tango.active_requests.values()) == 1
+    for conv in tango.active_requests.values():
+        conv.close()
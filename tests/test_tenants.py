@@ -0,0 +1,132 @@
+import asyncio
+import copy
+import os
+import sys
+
+import httpx
+import pytest
+
+import campaigns
+import http_client
+import tenants
+
+
+def entry(name, **settings):
+    return {"name": name, "BOT_TOKEN": f"{name}:token", "ADMIN_ID": "1", **settings}
+
+
+def test_parse_config_fills_data_settings(monkeypatch):
+    monkeypatch.setattr(tenants, "TENANTS_DIR", "data")
+    alpha, beta = tenants.parse_config([entry("alpha"), entry("beta", DATA_DIR="/srv/beta", ADMIN_ID=5)])
+    assert alpha.data_dir == os.path.join("data", "alpha")
+    assert alpha.settings["MEDIA_DIR"] == os.path.join("data", "alpha", "media")
+    assert alpha.settings["MEDIA_SOURCE_DIR"] == os.path.join("data", "alpha", "images")
+    assert beta.settings["TRANSCRIPT_DB"] == "/srv/beta/archive.db"
+    assert beta.settings["ADMIN_ID"] == "5"
+    assert "DATA_DIR" not in beta.settings
+
+
+@pytest.mark.parametrize("entries, message", [
+    ([], "непустой список"),
+    ([entry("Alpha")], "неверное имя"),
+    ([entry("alpha"), entry("alpha")], "дважды"),
+    ([entry("alpha"), {**entry("beta"), "BOT_TOKEN": "alpha:token"}], "тот же BOT_TOKEN"),
+    ([{"name": "alpha", "BOT_TOKEN": "x"}], "не задан ADMIN_ID"),
+    ([entry("alpha", ADMIN_ID="admin")], "ADMIN_ID должен быть числом"),
+    ([entry("alpha", HTTP2="0")], "нельзя задать отдельному боту"),
+    ([entry("alpha", OPERATOR_CAPACITY="two")], "неверное значение OPERATOR_CAPACITY"),
+])
+def test_parse_config_rejects(entries, message):
+    with pytest.raises(tenants.TenantError, match=message):
+        tenants.parse_config(entries)
+
+
+def test_module_instances_are_isolated_without_touching_process_state():
+    environ = dict(os.environ)
+    modules = dict(sys.modules)
+    first = tenants.load_modules()
+    second = tenants.load_modules()
+    assert dict(os.environ) == environ
+    assert all(sys.modules.get(name) is modules.get(name) for name in tenants.TENANT_MODULES)
+    assert first["tango"] is not second["tango"]
+    # Модули бота связаны с экземплярами этого же бота, общие модули — одни на процесс
+    assert first["tango"].metrics is first["metrics"]
+    assert first["health"].metrics is first["metrics"]
+    assert second["tango"].events is second["events"]
+    assert first["tango"].http_client is http_client
+    assert first["tango"].active_requests is not second["tango"].active_requests
+
+
+def test_settings_reach_each_bots_modules_at_call_time(tmp_path):
+    first = tenants.load_modules()
+    second = tenants.load_modules()
+    for modules, name, capacity in ((first, "alpha", "3"), (second, "beta", "1")):
+        modules["tango"].translations = copy.deepcopy(modules["tango"].translations)
+        modules["tango"].load_settings({"BOT_TOKEN": f"{name}:token", "ADMIN_ID": "1", "OPERATORS": "2:Анна",
+                                        "DB_PATH": str(tmp_path / f"{name}.db"), "OPERATOR_CAPACITY": capacity})
+    # Путь к базе один на бота и читается при подключении, а не копируется в модули при импорте
+    assert first["segments"].storage is first["storage"] and first["media"].storage is first["storage"]
+    assert first["storage"].DB_PATH == str(tmp_path / "alpha.db")
+    assert second["storage"].DB_PATH == str(tmp_path / "beta.db")
+    first["tango"].init_db()
+    first["canned"].init_canned()
+    assert (tmp_path / "alpha.db").exists() and not (tmp_path / "beta.db").exists()
+    assert first["assignment"].AssignmentQueue([2]).operators[2].capacity == 3
+    assert second["assignment"].AssignmentQueue([2]).operators[2].capacity == 1
+
+
+def test_closing_a_client_keeps_the_shared_pool(monkeypatch):
+    monkeypatch.setattr(http_client, "_transports", {})
+    monkeypatch.setattr(http_client, "_clients", {})
+    closed = []
+
+    async def scenario():
+        transport = http_client.transport_for("example.com")
+
+        async def close_pool():
+            closed.append(transport.host)
+
+        transport.close_pool = close_pool
+        first = httpx.AsyncClient(transport=transport)
+        second = httpx.AsyncClient(transport=transport)
+        await first.aclose()
+        await second.aclose()
+        assert closed == []
+        http_client.client_for("example.com")
+        await http_client.aclose()
+
+    asyncio.run(scenario())
+    assert closed == ["example.com"]
+    assert http_client._transports == {}
+
+
+def test_campaign_store_path_is_resolved_at_call_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(campaigns.storage, "DB_PATH", str(tmp_path / "late.db"))
+    campaigns.init_campaigns()
+    assert campaigns.SQLiteJobStore().path == str(tmp_path / "late.db")
+    assert (tmp_path / "late.db").exists()
+
+
+def test_shared_scheduler_is_stopped_once_by_its_owner(tmp_path, monkeypatch):
+    monkeypatch.setattr(campaigns, "_runners", {})
+    monkeypatch.setattr(campaigns, "_paths", {})
+
+    async def runner(campaign_id):
+        pass
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        for store in ("alpha", "beta"):
+            path = str(tmp_path / f"{store}.db")
+            campaigns.init_campaigns(path)
+            campaigns.start(loop, runner, store=store, path=path)
+        scheduler = campaigns.scheduler
+        campaigns.stop("alpha")
+        campaigns.stop("beta")
+        assert campaigns.scheduler is scheduler and scheduler.running
+        campaigns.shutdown()
+        # AsyncIOScheduler останавливается в следующей итерации цикла
+        await asyncio.sleep(0)
+        assert campaigns.scheduler is None and not scheduler.running
+
+    asyncio.run(scenario())
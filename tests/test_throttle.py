@@ -0,0 +1,141 @@
+import pytest
+
+import throttle
+
+
+class FakeLoop:
+    # Таймеры не запускаются сами: тест вызывает fire()
+    def __init__(self):
+        self.timers = []
+
+    def call_soon_threadsafe(self, callback, *args):
+        callback(*args)
+
+    def call_later(self, delay, callback, *args):
+        self.timers.append((delay, callback, args))
+
+    def fire(self):
+        timers, self.timers = self.timers, []
+        for _, callback, args in timers:
+            callback(*args)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(throttle.time, "monotonic", lambda: now[0])
+    return now
+
+
+def text(user_id, value, **extra):
+    return {"message": {"from": {"id": user_id}, "chat": {"id": user_id}, "text": value, **extra}}
+
+
+def photo(user_id, album=None):
+    message = {"from": {"id": user_id}, "chat": {"id": user_id}, "photo": [{}]}
+    if album:
+        message["media_group_id"] = album
+    return {"message": message}
+
+
+def make_guard(rate=1.0, burst=3, exempt=()):
+    delivered = []
+    guard = throttle.FloodGuard(delivered.append, exempt=exempt, rate=rate, burst=burst, loop=FakeLoop())
+    return guard, delivered
+
+
+def test_burst_passes_then_photos_are_dropped(clock):
+    guard, delivered = make_guard(burst=3)
+    assert [guard.submit(photo(1)) for _ in range(4)] == [True, True, True, False]
+    assert len(delivered) == 3
+    assert throttle.THROTTLED.value(reason="rate") >= 1
+
+
+def test_tokens_refill_with_time(clock):
+    guard, delivered = make_guard(rate=1.0, burst=2)
+    guard.submit(photo(1))
+    guard.submit(photo(1))
+    assert guard.submit(photo(1)) is False
+    clock[0] += 1.0
+    assert guard.submit(photo(1)) is True
+    assert len(delivered) == 3
+
+
+def test_exempt_and_service_updates_are_not_limited(clock):
+    guard, delivered = make_guard(burst=1, exempt=[7])
+    for _ in range(5):
+        guard.submit(photo(7))
+        guard.submit({"my_chat_member": {"chat": {"id": 1}}})
+    assert len(delivered) == 10
+
+
+def test_album_costs_one_token(clock):
+    guard, delivered = make_guard(burst=1)
+    assert all(guard.submit(photo(1, album="g1")) for _ in range(5))
+    assert guard.submit(photo(1, album="g2")) is False
+    assert len(delivered) == 5
+
+
+def test_texts_over_limit_are_coalesced(clock):
+    guard, delivered = make_guard(burst=1)
+    guard.submit(text(1, "first"))
+    assert guard.submit(text(1, "second")) is True
+    assert guard.submit(text(1, "third")) is True
+    assert len(delivered) == 1
+    assert len(guard.loop.timers) == 1
+    clock[0] += 5
+    guard.loop.fire()
+    assert len(delivered) == 2
+    assert delivered[-1]["message"]["text"] == "second\nthird"
+    assert guard._buckets[1].pending == []
+
+
+def test_other_update_flushes_coalesced_texts_first(clock):
+    guard, delivered = make_guard(burst=2)
+    for value in ("a", "b", "c"):
+        guard.submit(text(1, value))
+    clock[0] += 3
+    assert guard.submit(photo(1)) is True
+    assert [item["message"].get("text") for item in delivered] == ["a", "b", "c", None]
+    # Таймер отменённой склейки срабатывает вхолостую
+    guard.loop.fire()
+    assert len(delivered) == 4
+
+
+def test_flushed_texts_do_not_overdraw_tokens(clock):
+    guard, delivered = make_guard(burst=1)
+    guard.submit(text(1, "a"))
+    guard.submit(text(1, "b"))
+    assert guard.submit(photo(1)) is False
+    assert guard._buckets[1].tokens == 0
+    clock[0] += 1
+    assert guard.submit(photo(1)) is True
+    assert [item["message"].get("text") for item in delivered] == ["a", "b", None]
+
+
+def test_repeated_overflow_puts_user_on_cooldown(clock, monkeypatch):
+    monkeypatch.setattr(throttle, "FLOOD_STRIKES", 3)
+    guard, delivered = make_guard(burst=1)
+    guard.submit(photo(1))
+    for _ in range(3):
+        guard.submit(photo(1))
+    assert guard._buckets[1].cooldown_until > clock[0]
+    clock[0] += 10
+    assert guard.submit(photo(1)) is False
+    clock[0] += throttle.FLOOD_COOLDOWN
+    assert guard.submit(photo(1)) is True
+
+
+def test_merge_messages_keeps_last_message_and_drops_entities():
+    merged = throttle.merge_messages([text(1, "a", message_id=1), text(1, "b", message_id=2, entities=[{}])])
+    assert merged["message"]["text"] == "a\nb"
+    assert merged["message"]["message_id"] == 2
+    assert "entities" not in merged["message"]
+
+
+def test_idle_buckets_are_swept(clock):
+    guard, _ = make_guard()
+    guard.submit(photo(1))
+    clock[0] += throttle.IDLE_TTL + throttle.SWEEP_INTERVAL + 1
+    guard.submit(photo(2))
+    assert set(guard._buckets) == {2}
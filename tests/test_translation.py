@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+import translation
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [50.0]
+    monkeypatch.setattr(translation.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def fake_translator(monkeypatch):
+    calls = []
+
+    class FakeTranslator:
+        def __init__(self, source, target):
+            self.target = target
+
+        def translate(self, text):
+            calls.append((self.target, text))
+            if text == "fail":
+                raise RuntimeError("service unavailable")
+            return f"{self.target}:{text}"
+
+    monkeypatch.setattr(translation, "GoogleTranslator", FakeTranslator)
+    monkeypatch.setattr(translation, "breaker", translation.CircuitBreaker(failure_threshold=2, reset_timeout=10))
+    monkeypatch.setattr(translation, "_cache", translation.OrderedDict())
+    return calls
+
+
+def test_breaker_opens_after_failures_and_probes_once(clock):
+    breaker = translation.CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(translation.BreakerOpen):
+        breaker.before_call()
+    clock[0] += 10
+    assert breaker.state == "half_open"
+    breaker.before_call()
+    with pytest.raises(translation.BreakerOpen):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_failed_probe_reopens_breaker(clock):
+    breaker = translation.CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    clock[0] += 10
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_translate_cached_caches_only_successes(fake_translator):
+    assert asyncio.run(translation.translate_cached("hello", "ru")) == "ru:hello"
+    assert asyncio.run(translation.translate_cached("hello", "ru")) == "ru:hello"
+    assert asyncio.run(translation.translate_cached("fail", "ru")) == "fail"
+    assert asyncio.run(translation.translate_cached("fail", "ru")) == "fail"
+    assert fake_translator == [("ru", "hello"), ("ru", "fail"), ("ru", "fail")]
+
+
+def test_open_breaker_returns_source_text_without_calls(fake_translator):
+    for _ in range(2):
+        asyncio.run(translation.translate_text("fail", "en"))
+    assert asyncio.run(translation.translate_text("hello", "en")) == "hello"
+    assert fake_translator == [("en", "fail"), ("en", "fail")]
+
+
+def test_request_translation_limits(fake_translator):
+    assert asyncio.run(translation.request_translation("   ", "en")) == ""
+    with pytest.raises(translation.TranslationError):
+        asyncio.run(translation.request_translation("x" * (translation.MAX_CHARS + 1), "en"))
+    assert fake_translator == []
+
+
+def test_too_long_text_does_not_trip_breaker(fake_translator):
+    too_long = "x" * (translation.MAX_CHARS + 1)
+    for _ in range(3):
+        assert asyncio.run(translation.translate_text(too_long, "en")) == too_long
+    assert translation.breaker.state == "closed" and translation.breaker.failures == 0
+    assert asyncio.run(translation.translate_text("hello", "en")) == "en:hello"
+    assert fake_translator == [("en", "hello")]
@@ -0,0 +1,188 @@
+# Защита от флуда на входе вебхука: у каждого пользователя своё ведро токенов.
+# Апдейты сверх лимита не доходят до Application; быстрые серии текстовых сообщений
+# склеиваются в одно, а пользователь, который продолжает слать сверх лимита, получает паузу
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", 1.0))
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", 8))
+FLOOD_STRIKES = int(os.getenv("FLOOD_STRIKES", 20))
+FLOOD_COOLDOWN = float(os.getenv("FLOOD_COOLDOWN", 60))
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", 2.0))
+COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", 20))
+COALESCE_MAX_CHARS = 4000
+IDLE_TTL = 600
+SWEEP_INTERVAL = 60
+
+# Только эти апдейты исходят от пользователя напрямую; служебные (my_chat_member и т.п.) не ограничиваются
+THROTTLED_KINDS = ("message", "edited_message", "callback_query")
+
+THROTTLED = metrics.counter("tango_throttled_updates_total", "Updates held back by flood protection", ("reason",))
+
+
+class Bucket:
+    __slots__ = ("tokens", "updated", "strikes", "cooldown_until", "pending", "timer", "album")
+
+    def __init__(self, now):
+        self.tokens = FLOOD_BURST
+        self.updated = now
+        self.strikes = 0
+        self.cooldown_until = 0.0
+        self.pending = []
+        self.timer = None
+        # media_group_id последнего альбома: альбом расходует один токен, а не по токену на часть
+        self.album = None
+
+
+def update_user_id(payload):
+    for kind in THROTTLED_KINDS:
+        if kind in payload:
+            sender = payload[kind].get("from")
+            return kind, sender["id"] if sender else None
+    return None, None
+
+
+def is_plain_text(payload):
+    message = payload.get("message")
+    return bool(message and message.get("text") and not message["text"].startswith("/"))
+
+
+class FloodGuard:
+    # deliver(payload) вызывается для пропущенных апдейтов, в том числе из таймера склейки.
+    # Таймеры склейки — call_later в цикле loop (start), а не поток на каждого пользователя
+    def __init__(self, deliver, exempt=(), rate=FLOOD_RATE, burst=FLOOD_BURST, loop=None):
+        self.deliver = deliver
+        self.loop = loop
+        self.exempt = set(exempt)
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        metrics.gauge("tango_flood_buckets", "Users tracked by flood protection", ("state",), self._state_counts)
+
+    def start(self, loop):
+        self.loop = loop
+
+    def _state_counts(self):
+        now = time.monotonic()
+        with self._lock:
+            cooling = sum(1 for bucket in self._buckets.values() if bucket.cooldown_until > now)
+            return {("tracked",): len(self._buckets), ("cooldown",): cooling}
+
+    def _refill(self, bucket, now):
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+        bucket.updated = now
+
+    def submit(self, payload):
+        _, user_id = update_user_id(payload)
+        if user_id is None or user_id in self.exempt:
+            self.deliver(payload)
+            return True
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = Bucket(now)
+            if bucket.cooldown_until > now:
+                THROTTLED.inc(reason="cooldown")
+                return False
+            self._refill(bucket, now)
+            # Следующие части уже пропущенного альбома проходят без токена
+            album = media_group_id(payload)
+            cost = 0 if album is not None and album == bucket.album else 1
+            flushed = None
+            if bucket.pending:
+                # Пока идёт склейка, новые тексты дописываются в неё; другой апдейт сначала выпускает
+                # накопленное, чтобы не нарушить порядок сообщений
+                if is_plain_text(payload):
+                    return self._hold(bucket, user_id, payload)
+                flushed = merge_messages(bucket.pending)
+                self._cancel(bucket)
+                bucket.tokens = max(0.0, bucket.tokens - 1)
+            if bucket.tokens >= cost:
+                bucket.tokens -= cost
+                bucket.strikes = 0
+                bucket.album = album
+            else:
+                if is_plain_text(payload):
+                    return self._hold(bucket, user_id, payload)
+                payload = None
+                self._strike(bucket, user_id, now, "rate")
+        if flushed is not None:
+            self.deliver(flushed)
+        if payload is None:
+            return False
+        self.deliver(payload)
+        return True
+
+    def _strike(self, bucket, user_id, now, reason):
+        THROTTLED.inc(reason=reason)
+        bucket.strikes += 1
+        if bucket.strikes >= FLOOD_STRIKES:
+            bucket.cooldown_until = now + FLOOD_COOLDOWN
+            bucket.strikes = 0
+            self._cancel(bucket)
+            logger.warning(f"User {user_id} put on flood cooldown for {FLOOD_COOLDOWN:.0f}s")
+        return False
+
+    def _hold(self, bucket, user_id, payload):
+        chars = sum(len(item["message"]["text"]) for item in bucket.pending) + len(payload["message"]["text"])
+        if len(bucket.pending) >= COALESCE_MAX_MESSAGES or chars > COALESCE_MAX_CHARS:
+            return self._strike(bucket, user_id, time.monotonic(), "coalesce_overflow")
+        bucket.pending.append(payload)
+        THROTTLED.inc(reason="coalesced")
+        if bucket.timer is None:
+            delay = max(COALESCE_WINDOW, (1 - bucket.tokens) / self.rate)
+            # submit вызывается из потоков Flask, а call_later можно звать только из потока цикла.
+            # Отменённая склейка не снимает таймер, а меняет bucket.timer: сработавший таймер
+            # с чужой меткой ничего не делает
+            bucket.timer = token = object()
+            self.loop.call_soon_threadsafe(self.loop.call_later, delay, self._release, user_id, token)
+        return True
+
+    def _release(self, user_id, token):
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None or bucket.timer is not token or not bucket.pending:
+                return
+            pending, bucket.pending, bucket.timer = bucket.pending, [], None
+            self._refill(bucket, time.monotonic())
+            bucket.tokens = max(0.0, bucket.tokens - 1)
+        self.deliver(merge_messages(pending))
+
+    def _cancel(self, bucket):
+        bucket.timer = None
+        bucket.pending = []
+
+    def _sweep(self, now):
+        if now - self._last_sweep < SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        idle = [user_id for user_id, bucket in self._buckets.items()
+                if now - bucket.updated > IDLE_TTL and bucket.cooldown_until < now and not bucket.pending]
+        for user_id in idle:
+            del self._buckets[user_id]
+
+
+def media_group_id(payload):
+    message = payload.get("message")
+    return message.get("media_group_id") if message else None
+
+
+def merge_messages(payloads):
+    # Склейка серии сообщений в одно: за основу берётся последнее, тексты соединяются построчно
+    if len(payloads) == 1:
+        return payloads[0]
+    merged = dict(payloads[-1])
+    merged["message"] = dict(payloads[-1]["message"])
+    merged["message"]["text"] = "\n".join(item["message"]["text"] for item in payloads)
+    merged["message"].pop("entities", None)
+    return merged
@@ -0,0 +1,152 @@
+# Архив завершённых чатов поддержки: сжатые тексты сообщений в SQLite и полнотекстовый
+# индекс FTS5 по оригиналам и переводам для поиска операторами
+import json
+import logging
+import os
+import re
+import sqlite3
+import zlib
+from datetime import datetime
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DB = os.getenv("TRANSCRIPT_DB", "archive.db")
+
+ARCHIVED = metrics.counter("tango_transcripts_archived_total", "Support transcripts written to the archive")
+SEARCH_LATENCY = metrics.histogram("tango_transcript_search_seconds", "Transcript search latency")
+
+_FILTER_RE = re.compile(r"\b(user|op|since|until):(\S+)")
+
+
+def configure(env):
+    # Архив бота из его настроек (см. storage.configure)
+    global ARCHIVE_DB
+    ARCHIVE_DB = env.get("TRANSCRIPT_DB", "archive.db")
+
+
+def connect():
+    conn = sqlite3.connect(ARCHIVE_DB)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def init_archive():
+    conn = connect()
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS transcripts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    request_id TEXT UNIQUE,
+                    user_id INTEGER,
+                    username TEXT,
+                    operator_id INTEGER,
+                    operator_name TEXT,
+                    language TEXT,
+                    started_at REAL,
+                    ended_at REAL,
+                    message_count INTEGER,
+                    body BLOB
+                 )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transcripts_user ON transcripts (user_id, ended_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transcripts_operator ON transcripts (operator_id, ended_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transcripts_ended ON transcripts (ended_at)")
+    # Индекс без копии текста (content=''): сам текст хранится сжатым в transcripts.body
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS transcripts_fts USING fts5(
+                    original, translated, content='', tokenize='unicode61 remove_diacritics 2'
+                 )''')
+    conn.commit()
+    conn.close()
+
+
+def compress(messages):
+    return zlib.compress(json.dumps(messages, ensure_ascii=False).encode("utf-8"), 6)
+
+
+def decompress(body):
+    return json.loads(zlib.decompress(body).decode("utf-8"))
+
+
+def archive_transcript(request_id, conv, messages):
+    # messages: [(timestamp, sender, content, translation или None), ...]
+    conn = connect()
+    try:
+        with conn:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO transcripts (request_id, user_id, username, operator_id, operator_name, language, "
+                "started_at, ended_at, message_count, body) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (request_id, conv.user_id, conv.username, conv.assigned_operator, conv.operator_name, conv.language,
+                 messages[0][0] if messages else None, datetime.now().timestamp(), len(messages), compress(messages)))
+            if cur.rowcount:
+                conn.execute("INSERT INTO transcripts_fts (rowid, original, translated) VALUES (?, ?, ?)",
+                             (cur.lastrowid, "\n".join(m[2] for m in messages),
+                              "\n".join(m[3] for m in messages if m[3])))
+                ARCHIVED.inc()
+    finally:
+        conn.close()
+
+
+def build_match(text):
+    # Каждое слово — отдельная фраза FTS5, чтобы пользовательский ввод не ломал синтаксис запроса
+    terms = [term.replace('"', '""') for term in text.split()]
+    return " ".join(f'"{term}"' for term in terms)
+
+
+def search(query, limit=10):
+    filters = dict(_FILTER_RE.findall(query))
+    text = _FILTER_RE.sub("", query).strip()
+    where, params = [], []
+    if "user" in filters and filters["user"].isdigit():
+        where.append("t.user_id = ?")
+        params.append(int(filters["user"]))
+    if "op" in filters and filters["op"].isdigit():
+        where.append("t.operator_id = ?")
+        params.append(int(filters["op"]))
+    for key, op in (("since", ">="), ("until", "<")):
+        if key in filters:
+            try:
+                where.append(f"t.ended_at {op} ?")
+                params.append(datetime.strptime(filters[key], "%Y-%m-%d").timestamp())
+            except ValueError:
+                pass
+    with SEARCH_LATENCY.time():
+        conn = connect()
+        try:
+            if text:
+                sql = ("SELECT t.id, t.user_id, t.username, t.operator_name, t.ended_at, t.body "
+                       "FROM transcripts_fts f JOIN transcripts t ON t.id = f.rowid WHERE transcripts_fts MATCH ?")
+                if where:
+                    sql += " AND " + " AND ".join(where)
+                rows = conn.execute(sql + " ORDER BY f.rank LIMIT ?", [build_match(text), *params, limit]).fetchall()
+            else:
+                sql = "SELECT t.id, t.user_id, t.username, t.operator_name, t.ended_at, t.body FROM transcripts t"
+                if where:
+                    sql += " WHERE " + " AND ".join(where)
+                rows = conn.execute(sql + " ORDER BY t.ended_at DESC LIMIT ?", [*params, limit]).fetchall()
+        finally:
+            conn.close()
+    terms = [term.lower() for term in text.split()]
+    results = []
+    for transcript_id, user_id, username, operator_name, ended_at, body in rows:
+        excerpt = ""
+        for ts, sender, content, translation in decompress(body):
+            haystack = f"{content} {translation or ''}".lower()
+            if not terms or any(term in haystack for term in terms):
+                excerpt = content
+                break
+        results.append((transcript_id, user_id, username, operator_name, ended_at, excerpt))
+    return results
+
+
+def get_transcript(transcript_id):
+    conn = connect()
+    try:
+        row = conn.execute("SELECT user_id, username, operator_name, language, body FROM transcripts WHERE id = ?",
+                           (transcript_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    user_id, username, operator_name, language, body = row
+    return {"user_id": user_id, "username": username, "operator_name": operator_name, "language": language,
+            "messages": decompress(body)}
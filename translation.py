@@ -0,0 +1,174 @@
+# Сервис перевода: вызов переводчика с метриками и кэш готовых переводов.
+# deep_translator синхронный (requests), поэтому вызывается в потоке; число одновременных вызовов
+# ограничено TRANSLATION_CONCURRENCY
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from deep_translator import GoogleTranslator
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", 4096))
+
+MAX_CHARS = 5000
+TRANSLATION_CONCURRENCY = int(os.getenv("TRANSLATION_CONCURRENCY", 8))
+TRANSLATION_BREAKER_FAILURES = int(os.getenv("TRANSLATION_BREAKER_FAILURES", 5))
+TRANSLATION_BREAKER_RESET = float(os.getenv("TRANSLATION_BREAKER_RESET", 60))
+
+CACHE_HITS = metrics.counter("tango_translation_cache_total", "Translation cache lookups", ("result",))
+BREAKER_TRIPS = metrics.counter("tango_translation_breaker_trips_total", "Times the translation breaker opened")
+
+
+class BreakerOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # closed — вызовы идут как обычно; после failure_threshold ошибок подряд — open, вызовы сразу
+    # отклоняются; через reset_timeout один пробный вызов (half_open) решает, закрыться или открыться снова
+    def __init__(self, failure_threshold=TRANSLATION_BREAKER_FAILURES, reset_timeout=TRANSLATION_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        with self._lock:
+            state = self.state
+            if state == "open" or (state == "half_open" and self._probing):
+                raise BreakerOpen("translation breaker is open")
+            if state == "half_open":
+                self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self._probing:
+                    BREAKER_TRIPS.inc()
+                    logger.warning(f"Translation breaker opened after {self.failures} failures")
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+
+breaker = CircuitBreaker()
+metrics.gauge("tango_translation_breaker_open", "Translation breaker state (1 = calls are rejected)", (),
+              lambda: {(): 0 if breaker.state == "closed" else 1})
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+# Одновременных запросов к переводчику не больше TRANSLATION_CONCURRENCY, остальные ждут здесь, а не в пуле
+_concurrency = asyncio.Semaphore(TRANSLATION_CONCURRENCY)
+
+
+class TranslationError(Exception):
+    pass
+
+
+def _translate_blocking(text, target_lang):
+    # Переводчик создаётся на каждый вызов: GoogleTranslator хранит параметры запроса в себе
+    # и не рассчитан на одновременные вызовы из разных потоков
+    result = GoogleTranslator(source="auto", target=target_lang).translate(text)
+    if result is None:
+        raise TranslationError("empty translation")
+    return result
+
+
+def check_text(text):
+    # Проверка до обращения к переводчику: слишком длинный текст — ошибка вызывающего, а не сервиса
+    text = text.strip()
+    if len(text) > MAX_CHARS:
+        raise TranslationError(f"text is longer than {MAX_CHARS} characters")
+    return text
+
+
+async def request_translation(text, target_lang):
+    text = check_text(text)
+    if not text:
+        return text
+    return await asyncio.to_thread(_translate_blocking, text, target_lang)
+
+
+async def translate(text: str, target_lang: str) -> str:
+    # Бросает исключение при ошибке переводчика или если предохранитель разомкнут.
+    # Отказ проверки текста не считается сбоем и не влияет на предохранитель
+    try:
+        text = check_text(text)
+    except TranslationError:
+        metrics.TRANSLATION_CALLS.inc(target=target_lang, status="invalid")
+        raise
+    if not text:
+        return text
+    try:
+        breaker.before_call()
+    except BreakerOpen:
+        metrics.TRANSLATION_CALLS.inc(target=target_lang, status="rejected")
+        raise
+    start = time.perf_counter()
+    try:
+        async with _concurrency:
+            result = await request_translation(text, target_lang)
+        metrics.TRANSLATION_CALLS.inc(target=target_lang, status="ok")
+        breaker.record_success()
+        return result
+    except Exception:
+        metrics.TRANSLATION_CALLS.inc(target=target_lang, status="error")
+        breaker.record_failure()
+        raise
+    finally:
+        metrics.TRANSLATION_LATENCY.observe(time.perf_counter() - start, target=target_lang)
+
+
+async def translate_text(text: str, target_lang: str) -> str:
+    try:
+        return await translate(text, target_lang)
+    except BreakerOpen:
+        return text
+    except Exception as e:
+        logger.error(f"Translation error: {e}")
+        return text
+
+
+async def translate_cached(text: str, target_lang: str) -> str:
+    # В кэш попадают только успешные переводы, при ошибке возвращается исходный текст
+    key = (target_lang, text)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            CACHE_HITS.inc(result="hit")
+            return _cache[key]
+    CACHE_HITS.inc(result="miss")
+    try:
+        result = await translate(text, target_lang)
+    except BreakerOpen:
+        return text
+    except Exception as e:
+        logger.error(f"Translation error: {e}")
+        return text
+    with _cache_lock:
+        _cache[key] = result
+        if len(_cache) > TRANSLATION_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
@@ -0,0 +1,277 @@
+# Массовая выгрузка и загрузка таблицы users (CSV или JSONL, можно сжатые gzip).
+# Выгрузка читает таблицу курсором порциями и пишет файл построчно, не собирая его в памяти.
+# Загрузка разбирает файл порциями по IMPORT_BATCH строк, проверяет каждую строку и вставляет
+# порцию одним executemany в отдельной транзакции: блокировка записи держится миллисекунды,
+# и между порциями обработчики бота успевают записать своё. Существующие пользователи
+# обновляются (дата первого запуска — самая ранняя, последнего взаимодействия — самая поздняя).
+# Для файлов больше лимита Bot API на скачивание: python users_io.py import|export файл
+import csv
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+from itertools import islice
+
+import metrics
+import segments
+import storage
+from translations import translations
+
+logger = logging.getLogger(__name__)
+
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", 5000))
+EXPORT_BATCH = 5000
+# Сколько ошибок разбора показывать администратору
+MAX_REPORTED_ERRORS = 10
+FORMATS = ("csv", "jsonl")
+COLUMNS = ("user_id", "username", "phone_number", "first_start", "language", "is_blocked", "last_interaction")
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+_BOOLEAN = {"yes": "Yes", "no": "No", "true": "Yes", "false": "No", "1": "Yes", "0": "No", "да": "Yes", "нет": "No"}
+
+UPSERT_SQL = (
+    "INSERT INTO users (user_id, username, phone_number, first_start, language, is_blocked, last_interaction) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (user_id) DO UPDATE SET "
+    "username = COALESCE(excluded.username, users.username), "
+    "phone_number = COALESCE(excluded.phone_number, users.phone_number), "
+    "first_start = MIN(COALESCE(users.first_start, excluded.first_start), "
+    "COALESCE(excluded.first_start, users.first_start)), "
+    "language = COALESCE(excluded.language, users.language), "
+    "is_blocked = COALESCE(excluded.is_blocked, users.is_blocked), "
+    "last_interaction = MAX(COALESCE(users.last_interaction, excluded.last_interaction), "
+    "COALESCE(excluded.last_interaction, users.last_interaction))"
+)
+
+IMPORTED_ROWS = metrics.counter("tango_users_import_rows_total", "Rows processed by bulk user import", ("result",))
+EXPORTED_ROWS = metrics.counter("tango_users_export_rows_total", "Rows written by bulk user export", ("format",))
+
+
+class UserImportError(ValueError):
+    pass
+
+
+class ImportResult:
+    __slots__ = ("upserted", "invalid", "errors", "seconds")
+
+    def __init__(self):
+        self.upserted = 0
+        self.invalid = 0
+        # (номер строки, описание) первых ошибок
+        self.errors = []
+        self.seconds = 0.0
+
+    def summary(self):
+        message = f"Загружено {self.upserted}, отклонено {self.invalid} строк за {self.seconds:.1f} с"
+        if self.errors:
+            message += "\n" + "\n".join(f"строка {line}: {error}" for line, error in self.errors)
+        return message
+
+
+def _open_text(path, mode):
+    # Сжатие определяется по сигнатуре при чтении и по расширению .gz при записи
+    if "r" in mode:
+        with open(path, "rb") as f:
+            compressed = f.read(2) == b"\x1f\x8b"
+    else:
+        compressed = path.endswith(".gz")
+    if compressed:
+        return gzip.open(path, mode + "t", encoding="utf-8", newline="")
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith(".gz") else path
+    if name.endswith(".jsonl") or name.endswith(".ndjson") or name.endswith(".json"):
+        return "jsonl"
+    if name.endswith(".csv"):
+        return "csv"
+    with _open_text(path, "r") as f:
+        first = f.read(1)
+    return "jsonl" if first == "{" else "csv"
+
+
+def _time(value):
+    if value in (None, ""):
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value).strftime(TIME_FORMAT)
+    value = str(value).strip()
+    try:
+        parsed = datetime.fromisoformat(value)
+        # Значение уже в формате таблицы (так пишет выгрузка) сохраняется без перевода в строку заново
+        return value if len(value) == 19 and value[10] == " " else parsed.strftime(TIME_FORMAT)
+    except ValueError:
+        pass
+    for parse in (lambda: datetime.fromisoformat(value.replace("Z", "+00:00")),
+                  lambda: datetime.strptime(value, "%d.%m.%Y %H:%M:%S")):
+        try:
+            return parse().strftime(TIME_FORMAT)
+        except ValueError:
+            pass
+    raise UserImportError(f"неверная дата {value!r}")
+
+
+def _text(value, limit):
+    if not value:
+        return None
+    value = str(value).strip()
+    if len(value) > limit:
+        raise UserImportError(f"значение длиннее {limit} символов")
+    return value or None
+
+
+def validate(record):
+    # Кортеж для UPSERT_SQL; пустые поля (None) не затирают данные уже известного пользователя
+    try:
+        user_id = int(record.get("user_id"))
+    except (TypeError, ValueError):
+        raise UserImportError(f"неверный user_id {record.get('user_id')!r}")
+    if user_id <= 0:
+        raise UserImportError(f"неверный user_id {user_id}")
+    username = _text(record.get("username"), 64)
+    if username:
+        username = username.lstrip("@")
+    language = _text(record.get("language"), 8)
+    if language is not None:
+        language = language.lower()
+        if language not in translations:
+            raise UserImportError(f"неизвестный язык {language!r}")
+    is_blocked = record.get("is_blocked")
+    if is_blocked not in (None, ""):
+        is_blocked = _BOOLEAN.get(str(is_blocked).strip().lower())
+        if is_blocked is None:
+            raise UserImportError(f"неверное значение is_blocked {record.get('is_blocked')!r}")
+    else:
+        is_blocked = None
+    return (user_id, username, _text(record.get("phone_number"), 32), _time(record.get("first_start")),
+            language, is_blocked, _time(record.get("last_interaction")))
+
+
+def read_records(f, fmt):
+    # (номер строки, словарь или исключение разбора) по одной строке файла
+    if fmt == "csv":
+        reader = csv.DictReader(f)
+        if not reader.fieldnames or "user_id" not in reader.fieldnames:
+            raise UserImportError("в заголовке CSV нет колонки user_id")
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_number, UserImportError(f"неверный JSON: {e}")
+            continue
+        yield line_number, record if isinstance(record, dict) else UserImportError("ожидается объект JSON")
+
+
+def import_users(path, fmt=None, progress=None, batch_size=IMPORT_BATCH):
+    # progress(result) вызывается после каждой записанной порции
+    fmt = fmt or detect_format(path)
+    if fmt not in FORMATS:
+        raise UserImportError(f"неизвестный формат {fmt}")
+    result = ImportResult()
+    start = time.perf_counter()
+    conn = sqlite3.connect(storage.DB_PATH, timeout=30)
+    # В режиме WAL synchronous=NORMAL не рискует целостностью базы, но не ждёт fsync на каждую порцию
+    conn.execute("PRAGMA synchronous=NORMAL")
+    try:
+        with _open_text(path, "r") as f:
+            records = read_records(f, fmt)
+            while True:
+                chunk = list(islice(records, batch_size))
+                if not chunk:
+                    break
+                rows = []
+                for line_number, record in chunk:
+                    try:
+                        if isinstance(record, Exception):
+                            raise record
+                        rows.append(validate(record))
+                    except UserImportError as e:
+                        result.invalid += 1
+                        if len(result.errors) < MAX_REPORTED_ERRORS:
+                            result.errors.append((line_number, str(e)))
+                with conn:
+                    conn.executemany(UPSERT_SQL, rows)
+                result.upserted += len(rows)
+                IMPORTED_ROWS.inc(len(rows), result="upserted")
+                IMPORTED_ROWS.inc(len(chunk) - len(rows), result="invalid")
+                if progress is not None:
+                    progress(result)
+    finally:
+        conn.close()
+    # Членство в сохранённых сегментах пересчитывается один раз на весь файл, а не по пользователю
+    if result.upserted:
+        segments.refresh_all()
+    result.seconds = time.perf_counter() - start
+    logger.info(f"Users imported from {path}: {result.upserted} upserted, {result.invalid} invalid "
+                f"in {result.seconds:.1f}s")
+    return result
+
+
+def export_users(path, fmt="csv"):
+    # Число выгруженных строк; файл пишется по мере чтения курсора
+    if fmt not in FORMATS:
+        raise UserImportError(f"неизвестный формат {fmt}")
+    total = 0
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        cursor = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM users ORDER BY user_id")
+        with _open_text(path, "w") as f:
+            writer = csv.writer(f) if fmt == "csv" else None
+            if writer is not None:
+                writer.writerow(COLUMNS)
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH)
+                if not rows:
+                    break
+                if writer is not None:
+                    writer.writerows(rows)
+                else:
+                    f.write("".join(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + "\n" for row in rows))
+                total += len(rows)
+    finally:
+        conn.close()
+    EXPORTED_ROWS.inc(total, format=fmt)
+    return total
+
+
+def export_to_tempfile(fmt="csv", compress=False):
+    # (путь, число строк); файл удаляет вызывающий
+    suffix = f".{fmt}.gz" if compress else f".{fmt}"
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as temp_file:
+        path = temp_file.name
+    try:
+        return path, export_users(path, fmt)
+    except Exception:
+        os.unlink(path)
+        raise
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if len(sys.argv) < 3 or sys.argv[1] not in ("import", "export"):
+        print("Использование: python users_io.py import|export файл [csv|jsonl]")
+        sys.exit(2)
+    action, path = sys.argv[1], sys.argv[2]
+    fmt = sys.argv[3] if len(sys.argv) > 3 else None
+    if action == "export":
+        name = path[:-3] if path.endswith(".gz") else path
+        total = export_users(path, fmt or ("jsonl" if name.endswith(".jsonl") else "csv"))
+        print(f"Выгружено {total} пользователей в {path}")
+        return
+    result = import_users(path, fmt, progress=lambda r: print(f"\r{r.upserted} строк", end="", file=sys.stderr))
+    print(file=sys.stderr)
+    print(result.summary())
+
+
+if __name__ == "__main__":
+    main()
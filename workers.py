@@ -0,0 +1,157 @@
+# Многопроцессный режим: тонкий фронтенд принимает вебхук и по chat_id отправляет апдейт
+# одному из N воркеров. Каждый воркер — отдельный процесс со своим Application и своим
+# состоянием поддержки. Когда оператор принимает запрос из чужого шарда, воркер-владелец
+# сообщает фронтенду по управляющей очереди, и апдейты оператора идут в этот шард.
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import uuid
+
+import metrics
+import shutdown
+
+logger = logging.getLogger(__name__)
+
+FORWARDED = metrics.counter("tango_frontend_updates_total", "Updates forwarded by the front end", ("shard",))
+
+WORKERS = int(os.getenv("WORKERS", 1))
+
+# Заполняются в процессе воркера
+shard_index = None
+control_queue = None
+
+
+def new_request_id():
+    # Номер шарда в request_id позволяет фронтенду направить "reply_<id>" владельцу запроса
+    if shard_index is None:
+        return str(uuid.uuid4())
+    return f"{shard_index}.{uuid.uuid4()}"
+
+
+def shard_of_request(request_id):
+    shard, sep, _ = request_id.partition(".")
+    if sep and shard.isdigit():
+        return int(shard)
+    return None
+
+
+def owns_global_jobs():
+    # Рассылка запланированных постов выполняется только в одном процессе
+    return shard_index in (None, 0)
+
+
+def bind_operator(operator_id):
+    if control_queue is not None:
+        control_queue.put(("bind", operator_id, shard_index))
+
+
+def release_operator(operator_id):
+    if control_queue is not None:
+        control_queue.put(("release", operator_id, shard_index))
+
+
+def update_chat_id(payload):
+    for key in ("message", "edited_message", "channel_post", "my_chat_member", "chat_member"):
+        if key in payload:
+            return payload[key]["chat"]["id"]
+    callback = payload.get("callback_query")
+    if callback:
+        message = callback.get("message")
+        return message["chat"]["id"] if message else callback["from"]["id"]
+    for value in payload.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"]
+    return 0
+
+
+class ShardRouter:
+    def __init__(self, worker_count):
+        self.worker_count = worker_count
+        self.operator_routes = {}
+        self._lock = threading.Lock()
+
+    def route(self, payload):
+        shard = self._route(payload)
+        FORWARDED.inc(shard=shard)
+        return shard
+
+    def _route(self, payload):
+        callback = payload.get("callback_query")
+        if callback and (callback.get("data") or "").startswith("reply_"):
+            shard = shard_of_request(callback["data"][len("reply_"):])
+            if shard is not None and shard < self.worker_count:
+                return shard
+        chat_id = update_chat_id(payload)
+        with self._lock:
+            shard = self.operator_routes.get(chat_id)
+        if shard is not None:
+            return shard
+        return chat_id % self.worker_count
+
+    def apply(self, action, operator_id, shard):
+        with self._lock:
+            if action == "bind":
+                self.operator_routes[operator_id] = shard
+            elif action == "release" and self.operator_routes.get(operator_id) == shard:
+                del self.operator_routes[operator_id]
+
+
+def worker_main(index, worker_count, inbox, control):
+    global shard_index, control_queue
+    shard_index = index
+    control_queue = control
+    # При spawn запускаемый модуль (python tango.py) уже импортирован как __mp_main__
+    tango = sys.modules.get("__mp_main__")
+    if not hasattr(tango, "create_application"):
+        import tango
+    tango.create_application()
+    asyncio.run(run_worker(tango, inbox))
+
+
+async def run_worker(tango, inbox):
+    from telegram import Update
+    await tango.start_bot(configure=False)
+    loop = asyncio.get_running_loop()
+    # Фронтенд останавливает воркеры через SIGTERM; None в очереди прерывает ожидание апдейтов
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, inbox.put, None)
+    while True:
+        payload = await loop.run_in_executor(None, inbox.get)
+        if payload is None:
+            break
+        await tango.application.update_queue.put(Update.de_json(payload, tango.application.bot))
+    await shutdown.drain()
+
+
+def start_workers(worker_count):
+    context = multiprocessing.get_context("spawn")
+    control = context.Queue()
+    inboxes = []
+    processes = []
+    log_file = os.getenv("LOG_FILE", "bot.log")
+    for index in range(worker_count):
+        inbox = context.Queue()
+        process = context.Process(target=worker_main, args=(index, worker_count, inbox, control),
+                                  name=f"tango-worker-{index}", daemon=True)
+        # Каждый процесс пишет свой лог, чтобы ротация файлов не конфликтовала;
+        # окружение наследуется при запуске, поэтому LOG_FILE подменяется на время start()
+        os.environ["LOG_FILE"] = log_file.replace(".log", f".worker{index}.log")
+        try:
+            process.start()
+        finally:
+            os.environ["LOG_FILE"] = log_file
+        inboxes.append(inbox)
+        processes.append(process)
+    return inboxes, control, processes
+
+
+def listen_control(router, control):
+    while True:
+        message = control.get()
+        if message is None:
+            return
+        router.apply(*message)